@@ -1,14 +1,15 @@
 import logging
 import os
 
-import boto3
-
-from main import calculate_charge_windows, update_inverter_charge_time, update_cloud_watch, get_time_offsets
-
+from project import metrics
+from project.charge_update import program_charge_windows
 from project.api.cloudwatch import CloudWatch
 from project.api.givenergy import GivEnergy
+from project.api.scheduler import create_scheduler
 from project.secrets import get_secret_or_env
-from project.api.sns_email import send_email
+
+# main (pandas, numpy and pytz) and the fleet planner are imported by the commands that use them, so the update
+# command's cold start doesn't pay for them. python -m tools.import_report shows what each command imports
 
 
 logger = logging.getLogger()
@@ -25,28 +26,46 @@ def handler(event, context):
     msg = event["msg"]
     offline_debug = True if os.environ.get("OFFLINE_DEBUG") == 'true' else False
     cloudwatch = CloudWatch(offline_debug)
-    if msg == 'calculate':
-        logger.info("event command: Calculate")
-        charge_times, df_energy_insights = calculate_charge_windows(offline_debug, aws_fields, cloudwatch)
-        logger.info(f"Calculated charge windows: {charge_times}")
-        send_email(offline_debug, charge_times)
-
-        return charge_times
-    elif msg == 'update':
-        logger.info("event command: Update")
-        data = event["data"]
-        giv_energy = GivEnergy(offline_debug, get_secret_or_env("GE_API_KEY"))
-        update_inverter_charge_time(giv_energy, offline_debug,
-                                    data[0]['from_hours_giv'],
-                                    data[0]['too_hours_giv'])
-        updated_charge_times = update_cloud_watch(cloudwatch, data, aws_fields)
-        logger.info(updated_charge_times)
-        return updated_charge_times
-    else:
-        return {
-            'message': 'unknown command'
-        }
+    run_metrics = metrics.start_invocation(msg)
+    try:
+        if msg == 'calculate':
+            logger.info("event command: Calculate")
+            with run_metrics.stage('imports'):
+                from main import calculate_charge_windows
+                from project.api.sns_email import send_email
+            # the event can choose the charging engine, otherwise CHARGE_ENGINE and MAX_CHARGE_WINDOWS apply
+            charge_times, df_energy_insights = calculate_charge_windows(offline_debug, aws_fields, cloudwatch,
+                                                                        create_scheduler(offline_debug),
+                                                                        event.get("engine"),
+                                                                        event.get("max_charge_windows"))
+            logger.info(f"Calculated charge windows: {charge_times}")
+            with run_metrics.stage('email'):
+                send_email(offline_debug, charge_times)
 
+            return charge_times
+        elif msg == 'update':
+            logger.info("event command: Update")
+            data = event["data"]
+            giv_energy = GivEnergy(offline_debug, get_secret_or_env("GE_API_KEY"))
+            # updates registered by the one-shot scheduler only program their own windows, the rest are scheduled
+            chain = cloudwatch if event.get("chain", True) else None
+            _, updated_charge_times = program_charge_windows(giv_energy, offline_debug, data, chain, aws_fields)
+            logger.info(updated_charge_times)
+            return updated_charge_times
+        elif msg == 'batch':
+            logger.info("event command: Batch")
+            with run_metrics.stage('imports'):
+                from project.fleet import plan_fleet
+            with run_metrics.stage('fleet'):
+                response = plan_fleet(event["sites"], offline_debug, apply=event.get("apply", False))
+            logger.info(f"Planned {response['succeeded']} sites, {response['failed']} failed")
+            return response
+        else:
+            return {
+                'message': 'unknown command'
+            }
+    finally:
+        run_metrics.flush()
 
 if __name__ == '__main__':
     # event = {
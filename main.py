@@ -1,10 +1,11 @@
-import time
+import heapq
 from datetime import datetime, timedelta
 import logging
 import json
 import math
 import os
-from typing import Tuple, Any
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Tuple, Any, Optional
 
 
 import numpy as np
@@ -12,8 +13,14 @@ import pandas as pd
 import pytz
 
 from project.api.givenergy import GivEnergy
-from project.api.forecast import Forecast
+from project.api.forecast import Forecast, cached_forecast, resample_to_half_hours
 from project.api.octopus import Octopus
+from project import metrics
+from project.charge_update import program_charge_windows, disable_cloud_watch
+from project.charge_scheduler import solve_charge_schedule
+from project.history_store import EnergyHistoryStore
+from project.profiles import load_profiles, save_profiles
+from project import solar_geometry
 from project.secrets import get_secret_or_env
 
 logger = logging.getLogger(__name__)
@@ -21,6 +28,35 @@ logger = logging.getLogger(__name__)
 # lowest_charge_threshold in kwh, lowest charge point before adding additional charge
 lowest_charge_threshold = 2
 
+# most slots the greedy engine will add on top of the cheapest slots to hold the lowest_charge_threshold
+max_repair_rounds = 30
+
+# most days to request from the GivEnergy energy-flows endpoint in one go
+max_energy_flow_span_days = 14
+
+# most half hour slots to plan over, after 16:00 tomorrow's Agile prices are published so up to 47 hours are known
+planning_horizon_slots = int(os.environ.get("PLANNING_HORIZON_SLOTS", 94))
+
+# Met Office site the forecast is requested for, Lancaster
+forecast_location = os.environ.get("FORECAST_LOCATION", "320301")
+
+# the inverter and CloudWatch schedules are times of day, so only the first 24 hours of the plan are acted on.
+# Every run plans the whole horizon again from the current slot
+execution_horizon_slots = 48
+
+# charging engine the calculate command plans with, 'greedy' or 'exact', see determine_optimal_charging_periods
+charge_engine = os.environ.get("CHARGE_ENGINE", "greedy")
+
+# cap on the number of charge windows the exact engine plans, uncapped when it isn't set
+charge_engine_max_windows = int(os.environ["MAX_CHARGE_WINDOWS"]) if os.environ.get("MAX_CHARGE_WINDOWS") else None
+
+# consumption and solar averages come from the running profiles when there is a history store, set to 0 to
+# average the raw history on every run instead
+use_energy_profiles = os.environ.get("USE_ENERGY_PROFILES", "1") != "0"
+
+# plan on this quantile of each half hour's consumption rather than the mean when set, e.g. 0.9
+consumption_quantile = float(os.environ["CONSUMPTION_QUANTILE"]) if os.environ.get("CONSUMPTION_QUANTILE") else None
+
 
 def get_time_offsets():
     # Calculate between CET and London
@@ -72,69 +108,112 @@ def save_json_file(filename, data):
         json.dump(data, f)
 
 
-def analyse_energy_usage(giv_energy, weeks, time_offsets):
+def analyse_energy_usage(giv_energy, weeks, time_offsets, history_store=None):
     """
     Get the average of the last 4 weekdays energy usage in half hour slots, for the following day
     Tidy data and insert into dataframe. Perform some basic analysis
     """
     previous_dates = get_x_weeks_previous_weekday_dates(weeks)
-    data = get_energy_usage_days(giv_energy, previous_dates, [0, 3, 5])
-    all_days, times = extract_half_hour_data(data)
-    df = add_to_df(all_days, times, time_offsets)
+    data = get_energy_usage_days(giv_energy, previous_dates, [0, 3, 5], history_store=history_store)
+    flows, times = decode_energy_flows(data, [0, 3, 5])
+    df = add_to_df(flows.sum(axis=2), times, time_offsets)
     df = df.rename(columns={'avg': 'avg_consumption_kwh'})
     return df
 
 
-def analyse_solar_production(giv_energy, days, time_offsets):
+def analyse_solar_production(giv_energy, days, time_offsets, history_store=None):
     """
     Get the average of the last x days solar production in half hour slots
     Tidy data and insert into dataframe. Perform some basic analysis
     """
     previous_dates = get_x_previous_days_dates(days)
-    data = get_energy_usage_days(giv_energy, previous_dates, [0, 1, 2])
-    all_days, times = extract_half_hour_data(data)
-    df = add_to_df(all_days, times, time_offsets)
+    data = get_energy_usage_days(giv_energy, previous_dates, [0, 1, 2], history_store=history_store)
+    flows, times = decode_energy_flows(data, [0, 1, 2])
+    df = add_to_df(flows.sum(axis=2), times, time_offsets)
     df = df.rename(columns={'avg': 'avg_production_kwh'})
     return df
 
 
-def analyse_forecast(forecast):
+def analyse_energy_profiles(giv_energy, weeks, days, time_offsets, history_store, quantile=None):
     """
+    Average consumption of today's and tomorrow's weekdays over the last x weeks, and average solar production
+    over the last x days, from the running profiles. The days the profiles haven't seen yet are read from the
+    history store first, so each run adds at most a day to them.
+    quantile plans on that quantile of each half hour's consumption instead of the mean
+    """
+    profiles = load_profiles(giv_energy.inverter_serial_number, weeks, days)
+    yesterday = datetime.today() - timedelta(days=1)
+    missing = profiles.missing_dates(yesterday.strftime('%Y-%m-%d'))
+    if missing:
+        previous_dates = [{'start_date': date, 'end_date': (_parse_date(date) + timedelta(days=1)).strftime('%Y-%m-%d')}
+                          for date in missing]
+        try:
+            data = get_energy_usage_from_store(giv_energy, history_store, previous_dates, [0, 1, 2, 3, 5])
+        except ValueError as error:
+            logger.warning(f"No new days for the energy profiles: {error}")
+            data = []
+        flows, _ = decode_energy_flows(data, [0, 1, 2, 3, 5])
+        for day, day_flows in zip(data, flows):
+            if np.isnan(day_flows).any():
+                continue
+            profiles.add_day(next(iter(day.values()))['start_time'][:10],
+                             day_flows[:, [0, 3, 4]].sum(axis=1), day_flows[:, [0, 1, 2]].sum(axis=1))
+        save_profiles()
+
+    today = datetime.today()
+    consumption = [profiles.consumption_profile(date.strftime('%Y-%m-%d'), quantile)
+                   for date in (today, today + timedelta(days=1))]
+    solar = profiles.solar_profile()
+    if any(profile is None for profile in consumption) or solar is None:
+        raise ValueError("No energy history available for the energy profiles")
+
+    times = [(datetime.min + timedelta(minutes=30 * i)).time() for i in range(2 * len(solar))]
+    df_consumption = add_to_df([np.concatenate(consumption)], times, time_offsets)
+    df_solar = add_to_df([np.tile(solar, 2)], times, time_offsets)
+    return (df_consumption.rename(columns={'avg': 'avg_consumption_kwh'}),
+            df_solar.rename(columns={'avg': 'avg_production_kwh'}))
 
+
+def analyse_clearsky_production(time_offsets, kwp):
+    """
+    Clear sky production of the panels in half hour slots for today and tomorrow, looked up from the solar table.
+    The forecast's solar bias is 2 on a blue sky day, so the clear sky production is halved to match it there.
+    None when there is no solar table
+    """
+    midnight = pytz.timezone('Europe/London').localize(datetime.combine(datetime.today().date(), datetime.min.time()))
+    production = solar_geometry.clearsky_production(midnight, 2 * solar_geometry.slots_per_day, kwp)
+    if production is None:
+        return None
+    times = [(datetime.min + timedelta(minutes=30 * i)).time() for i in range(len(production))]
+    df = add_to_df([production * 0.5], times, time_offsets)
+    df = df.rename(columns={'avg': 'avg_production_kwh'})
+    return df
+
+
+def analyse_forecast(forecast, location=forecast_location):
+    """
+    Solar bias for each half hour of today and tomorrow, from the Met Office forecast for a site location.
+    The frame is cached until the Met Office issues a new forecast, see project.api.forecast.cached_forecast
     """
-    data = forecast.get_forecast_location('320301')
     # Get values for today and tomorrows dates in format "2023-08-18Z"
     today = datetime.today()
     dates = [today.strftime('%Y-%m-%dZ'),
              (today + timedelta(days=1)).strftime('%Y-%m-%dZ')]
     # dates = ['2023-08-18Z', '2023-08-19Z']
-    result = []
-    for day in data['SiteRep']['DV']['Location']['Period']:
-        for count, date in enumerate(dates):
-            if day['value'] == date:
-                for predictions in day["Rep"]:
-                    forecast = {'date': date,
-                                'timer': count * 24 + int(predictions['$']) / 60,
-                                'solar_index': int(predictions['U']),
-                                }
-                    result.append(forecast)
-    df_forecast = pd.DataFrame(result)
+    return cached_forecast(forecast, location, dates, lambda: build_forecast_frame(forecast, location, dates))
+
+
+def build_forecast_frame(forecast, location, dates):
+    """
+    Request the forecast and spread it over half hour slots
+    """
+    date_index, timer, solar_index = forecast.get_solar_index_forecast(location, dates)
+    df_forecast = pd.DataFrame({'date': np.take(dates, date_index),
+                                'timer': timer,
+                                'solar_index': solar_index})
 
     # fill out for half hour slots
-    # Choosing the row with index 1 (second row) to duplicate
-    all_rows = []
-    for row in range(df_forecast.shape[0]):
-        chosen_row = df_forecast.loc[row].copy()
-
-        # Duplicating the row 4 times and increasing the value in column 'A' by 0.5 each time
-        duplicated_rows = []
-        for i in range(5):
-            chosen_row['timer'] += 0.5
-            duplicated_rows.append(chosen_row.copy())
-        all_rows = all_rows + duplicated_rows
-        # Concatenate the duplicated rows to the original dataframe
-    df_forecast = pd.concat([df_forecast, pd.DataFrame(all_rows)], ignore_index=True)
-    df_forecast = df_forecast.sort_values(by=['date', 'timer'])
+    df_forecast = resample_to_half_hours(df_forecast)
 
     convert_solar_index_to_bias(df_forecast)
     return df_forecast
@@ -146,17 +225,16 @@ def convert_solar_index_to_bias(df_forecast):
     Solar index values: In the UK, 0 represents night time and 7 is a blue sky day with intense sun light
     Convert range 0 - 7 to new range 0 - 2
     """
-    df_forecast['solar_bias'] = (((df_forecast['solar_index'] - 1) * 1.9 / 6) + 0.1)
-    df_forecast.loc[df_forecast['solar_bias'] < 0, 'solar_bias'] = 0
+    df_forecast['solar_bias'] = (((df_forecast['solar_index'] - 1) * 1.9 / 6) + 0.1).clip(lower=0)
     return df_forecast
 
 
 def add_to_df(all_days, times, time_offsets):
     """
-    Create dataframe from dictionary data
+    Create dataframe from a days x slots array of half hour totals, one column per day
     """
     # Create dataframe
-    df = pd.DataFrame(all_days).T
+    df = pd.DataFrame(np.asarray(all_days, dtype=float).T)
     # Add average column
     df["avg"] = df.mean(axis=1)
     # Add a time column as floats
@@ -202,18 +280,125 @@ def get_x_previous_days_dates(days):
     return previous_dates
 
 
-def get_energy_usage_days(giv_energy, previous_dates, e_types):
+def get_energy_usage_days(giv_energy, previous_dates, e_types, max_workers=None, single_span=True,
+                          history_store=None):
     """
-    Request energy usage data for the given dates
+    Request energy usage data for the given dates, several requests at a time
+
+    With single_span, overlapping date ranges are downloaded once as one contiguous span and split locally,
+    see get_energy_usage_span. Ranges that are spread out are still requested one by one.
+    With a history_store only the days it doesn't hold yet are requested, see get_energy_usage_from_store.
     """
+    if history_store is not None:
+        return get_energy_usage_from_store(giv_energy, history_store, previous_dates, e_types, max_workers)
+
+    if single_span and len(previous_dates) > 1:
+        span_days = (_parse_date(max(dates['end_date'] for dates in previous_dates)) -
+                     _parse_date(min(dates['start_date'] for dates in previous_dates))).days
+        range_days = sum((_parse_date(dates['end_date']) - _parse_date(dates['start_date'])).days
+                         for dates in previous_dates)
+        if span_days <= range_days:
+            return get_energy_usage_span(giv_energy, previous_dates, e_types, max_workers=max_workers)
+
     data = []
-    for dates in previous_dates:
+    for raw_data in giv_energy.get_energy_usage_ranges(previous_dates, e_types, max_workers):
         # filter the data
-        raw_data = giv_energy.get_energy_usage(dates['start_date'], dates['end_date'], e_types)
         data.append(raw_data['data'])
     return data
 
 
+def get_energy_usage_span(giv_energy, previous_dates, e_types, max_span_days=None, max_workers=None):
+    """
+    Request all the given dates as one contiguous span, in chunks of at most max_span_days,
+    then split it back into one response per date range.
+
+    Each range comes back in the same shape as its own energy-flows response, including the trailing
+    half hour starting at end_date, so extract_half_hour_data treats it the same way.
+    Any range with missing half hours, e.g. a failed chunk or a clock change, is requested on its own.
+    """
+    max_span_days = max_span_days or max_energy_flow_span_days
+    span_start = _parse_date(min(dates['start_date'] for dates in previous_dates))
+    span_end = _parse_date(max(dates['end_date'] for dates in previous_dates))
+
+    chunks = _split_date_range(span_start, span_end, max_span_days)
+
+    # Index every half hour by its start time, chunks share their boundary half hour
+    half_hours = {}
+    for raw_data in giv_energy.get_energy_usage_ranges(chunks, e_types, max_workers):
+        for half_hour in raw_data['data'].values():
+            half_hours[half_hour['start_time']] = half_hour
+
+    data = [None] * len(previous_dates)
+    missing = []
+    for count, dates in enumerate(previous_dates):
+        start = _parse_date(dates['start_date'])
+        slots = (_parse_date(dates['end_date']) - start).days * 48 + 1
+        times = [(start + timedelta(minutes=30 * i)).strftime('%Y-%m-%d %H:%M') for i in range(slots)]
+        if all(time in half_hours for time in times):
+            data[count] = {str(i): half_hours[time] for i, time in enumerate(times)}
+        else:
+            missing.append(count)
+
+    if missing:
+        logger.info(f"Requesting {len(missing)} date ranges missing from the energy usage span individually")
+        raw_data = giv_energy.get_energy_usage_ranges([previous_dates[i] for i in missing], e_types, max_workers)
+        for count, day in zip(missing, raw_data):
+            data[count] = day['data']
+    return data
+
+
+def get_energy_usage_from_store(giv_energy, history_store, previous_dates, e_types, max_workers=None):
+    """
+    Read energy usage for the given dates from the history store, first requesting any days it is missing.
+
+    Failed requests are logged and left as gaps for the next run to fill. Date ranges that still aren't
+    complete are left out of the result, the averages are then taken over the days that are available.
+    """
+    serial = giv_energy.inverter_serial_number
+    missing = [_parse_date(date) for date in history_store.missing_dates(serial, previous_dates, e_types)]
+    if missing:
+        # group missing dates into runs of consecutive days, each run is requested up to the following midnight
+        date_ranges = []
+        run_start = missing[0]
+        for previous, date in zip(missing, missing[1:] + [None]):
+            if date is None or date - previous > timedelta(days=1):
+                date_ranges += _split_date_range(run_start, previous + timedelta(days=1), max_energy_flow_span_days)
+                run_start = date
+        logger.info(f"Requesting {len(missing)} days missing from the energy history store")
+
+        for raw_data in giv_energy.get_energy_usage_ranges(date_ranges, e_types, max_workers, raise_errors=False):
+            if raw_data is not None:
+                history_store.save_energy_flows(serial, raw_data['data'])
+        history_store.backup_store()
+
+    data = []
+    for dates in previous_dates:
+        day = history_store.load_energy_flows(serial, dates['start_date'], dates['end_date'], e_types)
+        if day is None:
+            logger.warning(f"Energy history incomplete for {dates['start_date']} to {dates['end_date']}, skipping")
+        else:
+            data.append(day)
+    if not data:
+        raise ValueError("No complete energy history available for any of the requested dates")
+    return data
+
+
+def _split_date_range(start, end, max_days):
+    """
+    Split the dates from start to end into consecutive ranges of at most max_days
+    """
+    date_ranges = []
+    while start < end:
+        range_end = min(start + timedelta(days=max_days), end)
+        date_ranges.append({'start_date': start.strftime('%Y-%m-%d'), 'end_date': range_end.strftime('%Y-%m-%d')})
+        start = range_end
+    return date_ranges
+
+
+def _parse_date(date):
+    return datetime.strptime(date, '%Y-%m-%d')
+
+
 def extract_half_hour_data(data):
     """
     Average each half hour time slot between the number of weeks
@@ -232,7 +417,38 @@ def extract_half_hour_data(data):
     return all_days, times
 
 
-def calculate_battery_depletion_time(giv_energy: Any, forecast: Any, time_offsets: Any) -> Tuple[pd.DataFrame, Any]:
+def decode_energy_flows(data, e_types=None):
+    """
+    Decode energy-flows responses into a days x slots x flow types numpy array and the time of each slot.
+
+    Each response's trailing half hour (the first slot of its end_date) is dropped, like extract_half_hour_data.
+    Only the first start time is parsed, the slots that follow are every 30 minutes from it.
+    Responses shorter than the longest are padded with NaN, which the averages skip
+    """
+    if not data:
+        return np.zeros((0, 0, len(e_types or []))), []
+    first_half_hour = next(iter(data[0].values()))
+    flow_types = [str(e_type) for e_type in e_types] if e_types is not None else list(first_half_hour['data'])
+    slots = max(len(day) for day in data) - 1
+
+    short_days = [index for index, day in enumerate(data) if len(day) - 1 < slots]
+    if short_days:
+        logger.warning(f"Energy flows for days {short_days} are missing half hours, padding them with NaN")
+    flows = np.full((len(data), slots, len(flow_types)), np.nan)
+    for index, day in enumerate(data):
+        day_flows = [[half_hour['data'][flow_type] for flow_type in flow_types]
+                     for _, half_hour in zip(range(slots), day.values())]
+        if day_flows:
+            flows[index, :len(day_flows)] = day_flows
+
+    start = datetime.strptime(first_half_hour['start_time'], '%Y-%m-%d %H:%M')
+    times = [(start + timedelta(minutes=30 * i)).time() for i in range(slots)]
+    return flows, times
+
+
+def calculate_battery_depletion_time(giv_energy: Any, forecast: Any, time_offsets: Any,
+                                     history_store: Any = None,
+                                     forecast_future: Optional[Future] = None) -> Tuple[pd.DataFrame, Any]:
     """
     Estimates the battery depletion time by analyzing various parameters including
     energy consumption, weather forecast, and solar production.
@@ -242,25 +458,53 @@ def calculate_battery_depletion_time(giv_energy: Any, forecast: Any, time_offset
     and assesses solar panel productivity based on historical data. It then merges
     these data points to calculate the expected energy consumption and production,
     thereby estimating the time until the battery is fully depleted.
+
+    The consumption history, battery state, forecast and solar history are fetched at the same time.
+    forecast_future is an analyse_forecast call the caller has already started, if there is one.
     """
     # get renewable system specs
     giv_energy.extract_system_spec()
 
-    # get average energy consumption
-    df_house_consumption = analyse_energy_usage(giv_energy, 4, time_offsets)
-
-    # get watt hour capacity remaining in battery
-    giv_energy.get_inverter_systems_data()
-    giv_energy.system_specs["battery_spec"]["battery_kwatt_hours_remaining"] = ((giv_energy.inverter_data["data"][
-                                                                                     "battery"]["percent"] / 100) * \
-                                                                                giv_energy.system_specs["battery_spec"][
-                                                                                    "watt_hour"]) / 1000
-
-    # get weather forecast in half hour slots
-    df_forecast = analyse_forecast(forecast)
-
-    # get average production of panels in half hour slots for last 30 days
-    df_solar_production = analyse_solar_production(giv_energy, 40, time_offsets)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        clearsky_future = None
+        if solar_geometry.solar_array_kwp:
+            clearsky_future = executor.submit(analyse_clearsky_production, time_offsets, solar_geometry.solar_array_kwp)
+        if history_store is not None and use_energy_profiles:
+            profiles_future = executor.submit(analyse_energy_profiles, giv_energy, 4, 40, time_offsets, history_store,
+                                              consumption_quantile)
+        else:
+            consumption_future = executor.submit(analyse_energy_usage, giv_energy, 4, time_offsets, history_store)
+            solar_future = None
+            if clearsky_future is None:
+                solar_future = executor.submit(analyse_solar_production, giv_energy, 40, time_offsets, history_store)
+            profiles_future = None
+        battery_future = executor.submit(giv_energy.get_inverter_systems_data)
+        if forecast_future is None:
+            forecast_future = executor.submit(analyse_forecast, forecast)
+
+        # get average energy consumption
+        if profiles_future is not None:
+            df_house_consumption, df_solar_production = profiles_future.result()
+        else:
+            df_house_consumption = consumption_future.result()
+
+        # get watt hour capacity remaining in battery
+        battery_future.result()
+        giv_energy.system_specs["battery_spec"]["battery_kwatt_hours_remaining"] = ((giv_energy.inverter_data["data"][
+                                                                                         "battery"]["percent"] / 100) * \
+                                                                                    giv_energy.system_specs["battery_spec"][
+                                                                                        "watt_hour"]) / 1000
+
+        # get weather forecast in half hour slots
+        df_forecast = forecast_future.result()
+
+        # get clear sky production of the panels, or their average production in half hour slots for last 30 days
+        df_clearsky = clearsky_future.result() if clearsky_future is not None else None
+        if df_clearsky is not None:
+            df_solar_production = df_clearsky
+        elif profiles_future is None:
+            df_solar_production = (solar_future.result() if solar_future is not None else
+                                   analyse_solar_production(giv_energy, 40, time_offsets, history_store))
 
     df_result = df_solar_production[["avg_production_kwh", "timer"]].merge(df_forecast[["solar_bias", "timer"]],
                                                                            how='left', on="timer")
@@ -274,13 +518,10 @@ def calculate_battery_depletion_time(giv_energy: Any, forecast: Any, time_offset
     return df_result, giv_energy
 
 
-def get_agile_data(octopus, time_offsets):
+def get_agile_data(octopus, time_offsets, horizon_slots=planning_horizon_slots):
     """
     Request Agile data from Octopus, add to dataframe and do some basic analysis
     """
-    agile_data = octopus.get_tariff_data()
-    df = pd.DataFrame(agile_data["results"])
-
     now = datetime.now()
     local_time = time_offsets['local_time']
     giv_time = time_offsets['giv_energy_time']
@@ -294,15 +535,19 @@ def get_agile_data(octopus, time_offsets):
 
     # reset seconds and ms
     rounded_time = (now - timedelta(minutes=-minutes_to_add)).replace(second=0, microsecond=0)
-    time = rounded_time.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+    # Only the planning horizon is requested, usually straight from the tariff cache
+    rates = octopus.get_agile_rates(rounded_time, rounded_time + timedelta(minutes=30 * horizon_slots))
 
     # Filter start of data so first row represents current half hour time slot
-    idx = (df['valid_from'] == time).idxmax()
-    df = df.loc[:idx]
-    df = df.iloc[::-1].reset_index(drop=True)
+    idx = rates.slot_index(rounded_time)
+    if idx is None:
+        logger.warning(f"No Agile rate found for {rounded_time}, using the earliest rate available")
+        idx = 0
+    df = rates.to_frame().iloc[idx:].reset_index(drop=True)
 
-    # Filter end of data for 24 hours period
-    df = df.iloc[:48]
+    # Filter end of data to the planning horizon, every price published so far by default
+    df = df.iloc[:horizon_slots]
 
     # Adjust octopus agile api times to match giv time
     df['valid_from_octopus'] = pd.to_datetime(df['valid_from'])
@@ -364,46 +609,22 @@ def merge_consecutive_rows(df_result):
     return pd.DataFrame(merged_rows)
 
 
-def update_inverter_charge_time(giv_energy, offline_debug, from_time, to_time):
+def tile_daily_profile(df_energy_result, slots):
     """
-    Send commands to GivEnergy inverter to charge battery from mains
+    Extend a half hourly frame to slots rows, each new row copying the row from the same slot of the day before.
+    The consumption and solar profiles are per slot of the day, so they carry on across day boundaries
     """
-    if giv_energy is None:
-        giv_energy = GivEnergy(offline_debug, os.environ.get("GE_API_KEY"))
-
-    set_and_check_setting(giv_energy, 64, from_time)
-    set_and_check_setting(giv_energy, 65, to_time)
-    # giv_energy.update_inverter_setting(64, from_time)
-    # giv_energy.update_inverter_setting(65, to_time)    logger.info(f"Inverter set to charge from {from_time} too {to_time}")
-
-
-def set_and_check_setting(giv_energy, setting, value):
-    # Try setting and reading back the inverter setting 3 times
-    for _ in range(3):
-        giv_energy.update_inverter_setting(setting, value)
-        time.sleep(1)
-        result = giv_energy.read_inverter_setting(setting)
-        if result:
-            if result['data']['value'] == value:
-                break
-    return None
-
-
-
-def update_cloud_watch(cloudwatch, cloud_watch_times, aws_fields):
-    if cloud_watch_times and len(cloud_watch_times) > 1:
-        last_time = cloud_watch_times[0]['too_hours_aws']
-        cloud_watch_times = cloud_watch_times[1:]
-        event_json = {'msg': 'update',
-                      'data': cloud_watch_times}
-        cloudwatch.create_event(last_time, aws_fields, event_json)
-    else:
-        event_json = {'msg': 'update',
-                      'data': ''}
-        cloudwatch.send_update('cron(0 1 1 1 ? 2050)', 'DISABLED', aws_fields, event_json)
-        logger.info(f"CloudWatch cron schedule DISABLED")
-
-    return cloud_watch_times
+    if len(df_energy_result) >= slots or len(df_energy_result) == 0:
+        return df_energy_result
+    df_tiled = df_energy_result.reset_index(drop=True).reindex(range(slots))
+    added = np.arange(slots) >= len(df_energy_result)
+    for _ in range(math.ceil(slots / 48)):
+        df_tiled.loc[added] = df_tiled.shift(48).loc[added]
+        if not df_tiled.loc[added, 'timer'].isna().any():
+            break
+    # the timer keeps counting on, it isn't a slot of the day
+    df_tiled['timer'] = df_tiled['timer'].iloc[0] + np.arange(slots) * 0.5
+    return df_tiled
 
 
 def concat_data_sources(df_energy_result, df_agile_data):
@@ -465,30 +686,145 @@ def optimize_charging_for_low_capacity(df_energy_insights: pd.DataFrame, battery
         return df_energy_insights
 
 
-def calculate_running_battery_capacity(df_energy_insights, battery_remaining_capacity,
-                                       battery_max_capacity, battery_charge_rate_hourly):
-    df_energy_insights['running_battery_capacity'] = 0.0
-    df_energy_insights['_new_charged_energy'] = df_energy_insights['charged_energy']
-    for i in range(df_energy_insights.shape[0]):
+def simulate_running_battery_capacity(charged_energy, battery_remaining_capacity,
+                                      battery_max_capacity, battery_charge_rate_hourly):
+    """
+    Simulate the battery state of charge across each half hour slot in a single pass over plain arrays.
+
+    charged_energy is the net energy drawn from the battery in each slot, i.e. energy minus any grid charge.
+    When the battery is within one half hour of charge from full, the surplus that cannot be stored is added
+    back on to that slot's energy, and the running capacity never drops below zero.
+
+    Returns a tuple of numpy arrays (running_battery_capacity, corrected_charged_energy)
+    """
+    energy = np.asarray(charged_energy, dtype=float).tolist()
+    running = [0.0] * len(energy)
+    corrected = list(energy)
+    _simulate_from_slot(energy, running, corrected, 0, battery_remaining_capacity,
+                        battery_max_capacity, battery_charge_rate_hourly)
+    return np.array(running, dtype=float), np.array(corrected, dtype=float)
+
+
+def _simulate_from_slot(energy, running, corrected, start, battery_remaining_capacity,
+                        battery_max_capacity, battery_charge_rate_hourly, settle=False):
+    """
+    Fill running and corrected in place from slot start onwards, reusing running[start - 1] as the starting point.
+    With settle, running already holds a simulation that only differs in energy[start], so it stops at the first
+    slot after start whose level comes out the same, every slot after it is unchanged too
+    """
+    half_hour_charge = battery_charge_rate_hourly / 2
+
+    previous = running[start - 1] if start > 0 else battery_remaining_capacity
+    for i in range(start, len(energy)):
+        corrected[i] = energy[i]
         if i == 0:
-            running_battery_capacity = \
-                battery_remaining_capacity - df_energy_insights.loc[i, '_new_charged_energy']
+            running_battery_capacity = battery_remaining_capacity - corrected[i]
         else:
-            diff_from_max = battery_max_capacity - df_energy_insights["running_battery_capacity"][i - 1]
-
-            if diff_from_max < battery_charge_rate_hourly / 2:
-                df_energy_insights.loc[i,'_new_charged_energy'] = df_energy_insights['_new_charged_energy'][i] + \
-                                                              ((battery_charge_rate_hourly / 2) - diff_from_max)
-            running_battery_capacity = df_energy_insights.loc[i - 1, "running_battery_capacity"] - \
-                                       df_energy_insights.loc[i, '_new_charged_energy']
-        df_energy_insights.loc[i, "running_battery_capacity"] = 0 if running_battery_capacity < 0 else running_battery_capacity
-    df_energy_insights = df_energy_insights.drop('_new_charged_energy', axis=1)
+            diff_from_max = battery_max_capacity - previous
+            if diff_from_max < half_hour_charge:
+                corrected[i] = corrected[i] + (half_hour_charge - diff_from_max)
+            running_battery_capacity = previous - corrected[i]
+        previous = 0 if running_battery_capacity < 0 else running_battery_capacity
+        if settle and i > start and running[i] == previous:
+            return
+        running[i] = previous
+
+
+def repair_charging_with_heap(df_energy_insights: pd.DataFrame, battery_remaining_capacity: float,
+                              lowest_charge_threshold: float, battery_max_capacity,
+                              battery_charge_rate_hourly) -> pd.DataFrame:
+    """
+    Same repair as calling optimize_charging_for_low_capacity up to max_repair_rounds times, without the dataframe work.
+
+    Uncharged slots before the first low point sit in a heap ordered by price then slot, so the cheapest one
+    is found without rescanning the prefix. Slots past the low point wait in a second heap ordered by slot
+    and are moved across as the low point moves later, which it always does as charge is only ever added.
+    After each added slot the battery is only re-simulated from that slot onwards.
+    """
+    charge = df_energy_insights['charge'].to_numpy(dtype=bool).tolist()
+    energy = df_energy_insights['charged_energy'].to_numpy(dtype=float).tolist()
+    running = df_energy_insights['running_battery_capacity'].to_numpy(dtype=float).tolist()
+    prices = df_energy_insights['value_inc_vat'].tolist()
+    corrected = list(energy)
+    slots = len(charge)
+
+    cheapest = []
+    waiting = [i for i in range(slots) if not charge[i]]
+    heapq.heapify(waiting)
+    first_low_slot = 0
+    repair_rounds = 0
+
+    for _ in range(max_repair_rounds):
+        if slots <= 2 or min(running[2:]) >= lowest_charge_threshold:
+            break
+
+        # Find the first slot below the threshold, skipping the first 2 slots if they are already charging
+        search_from = 2 if charge[0] and charge[1] else 0
+        first_low_slot = next(i for i in range(max(search_from, first_low_slot), slots)
+                              if running[i] < lowest_charge_threshold)
+        low_charge_index = 1 if first_low_slot == 0 else first_low_slot
+
+        while waiting and waiting[0] <= low_charge_index:
+            slot = heapq.heappop(waiting)
+            heapq.heappush(cheapest, (prices[slot], slot))
+
+        # are there any non charged slots?
+        if not cheapest:
+            break
+        _, min_price_index = heapq.heappop(cheapest)
+        energy[min_price_index] -= 1.8
+        charge[min_price_index] = True
+        _simulate_from_slot(energy, running, corrected, min_price_index, battery_remaining_capacity,
+                            battery_max_capacity, battery_charge_rate_hourly)
+        repair_rounds += 1
+
+    metrics.current().put('repair_rounds', repair_rounds)
+    df_energy_insights['charge'] = charge
+    df_energy_insights['charged_energy'] = energy
+    df_energy_insights['running_battery_capacity'] = running
+    return df_energy_insights
+
+
+def calculate_running_battery_capacity(df_energy_insights, battery_remaining_capacity,
+                                       battery_max_capacity, battery_charge_rate_hourly):
+    """
+    Add the running_battery_capacity column to the dataframe, see simulate_running_battery_capacity
+    """
+    running_battery_capacity, _ = simulate_running_battery_capacity(df_energy_insights['charged_energy'].to_numpy(),
+                                                                    battery_remaining_capacity,
+                                                                    battery_max_capacity,
+                                                                    battery_charge_rate_hourly)
+    df_energy_insights['running_battery_capacity'] = running_battery_capacity
     return df_energy_insights
 
 
+def determine_exact_charging_periods(df_energy_insights: pd.DataFrame, battery_remaining_capacity: float,
+                                     battery_max_capacity: float, lowest_charge_threshold: float,
+                                     battery_charge_rate_hourly: float, max_charge_windows: int = None) -> pd.DataFrame:
+    """
+    Calculates the cheapest charging times that keep the battery above the lowest charge threshold.
+
+    Unlike the greedy engine this solves the whole horizon at once, see project.charge_scheduler.
+    Optionally caps the number of distinct charge windows to the number the inverter can hold.
+    """
+    df_energy_insights = df_energy_insights.copy()
+    # a slot without a forecast uses nothing, like the greedy engine's requirement sum which skips them
+    df_energy_insights['charge'] = solve_charge_schedule(df_energy_insights['energy'].fillna(0).to_numpy(),
+                                                         df_energy_insights['value_inc_vat'].to_numpy(),
+                                                         battery_remaining_capacity, battery_max_capacity,
+                                                         lowest_charge_threshold, battery_charge_rate_hourly,
+                                                         max_charge_windows)
+    df_energy_insights['charged_energy'] = np.where(df_energy_insights['charge'],
+                                                    df_energy_insights['energy'] - battery_charge_rate_hourly / 2,
+                                                    df_energy_insights['energy'])
+    return calculate_running_battery_capacity(df_energy_insights, battery_remaining_capacity,
+                                              battery_max_capacity, battery_charge_rate_hourly)
+
+
 def determine_optimal_charging_periods(df_energy_insights: pd.DataFrame, battery_remaining_capacity: float,
                                        battery_max_capacity: float, lowest_charge_threshold: float,
-                                       battery_charge_rate_hourly: float) -> pd.DataFrame:
+                                       battery_charge_rate_hourly: float, engine: str = 'greedy',
+                                       max_charge_windows: int = None, repair: str = 'heap') -> pd.DataFrame:
     """
     Calculates optimal times for charging based on energy costs, battery capacity, and charging rate.
 
@@ -496,7 +832,22 @@ def determine_optimal_charging_periods(df_energy_insights: pd.DataFrame, battery
     It calculates the number of charging slots needed based on the energy requirement and the battery's hourly charge rate.
     The function then selects the most cost-effective times for charging and adjusts the charging schedule accordingly.
     It continues to adjust the schedule until the lowest battery capacity threshold is maintained.
+
+    engine='exact' uses determine_exact_charging_periods instead of the greedy repair loop.
+    The greedy repair runs with repair_charging_with_heap, repair='dataframe' uses the original
+    optimize_charging_for_low_capacity rounds, both give the same schedule.
     """
+    if engine == 'exact':
+        return determine_exact_charging_periods(df_energy_insights, battery_remaining_capacity, battery_max_capacity,
+                                                lowest_charge_threshold, battery_charge_rate_hourly,
+                                                max_charge_windows)
+    elif engine != 'greedy':
+        raise ValueError(f"Unknown charging engine: {engine}")
+
+    if len(df_energy_insights) > execution_horizon_slots:
+        return _greedy_over_horizon(df_energy_insights, battery_remaining_capacity, battery_max_capacity,
+                                    lowest_charge_threshold, battery_charge_rate_hourly)
+
     df_energy_insights['charge'] = False
     # Calculate the overall energy requirement
     overall_energy_requirement = round(df_energy_insights['energy'].sum() +
@@ -524,59 +875,174 @@ def determine_optimal_charging_periods(df_energy_insights: pd.DataFrame, battery
     # Calculate the running energy
     df_energy_insights = calculate_running_battery_capacity(df_energy_insights, battery_remaining_capacity,
                                        battery_max_capacity, battery_charge_rate_hourly)
-    for _ in range(30):
+    if repair == 'heap':
+        return repair_charging_with_heap(df_energy_insights, battery_remaining_capacity, lowest_charge_threshold,
+                                         battery_max_capacity, battery_charge_rate_hourly)
+    elif repair != 'dataframe':
+        raise ValueError(f"Unknown repair mode: {repair}")
+
+    repair_rounds = 0
+    for _ in range(max_repair_rounds):
         if df_energy_insights['running_battery_capacity'][2:].min() < lowest_charge_threshold:
             df_energy_insights = optimize_charging_for_low_capacity(df_energy_insights, battery_remaining_capacity,
                                                                     lowest_charge_threshold, battery_max_capacity,
                                                                     battery_charge_rate_hourly)
+            repair_rounds += 1
         else:
             break
+    metrics.current().put('repair_rounds', repair_rounds)
     return df_energy_insights
 
 
-def calculate_charge_windows(offline_debug, aws_fields, cloudwatch):
+def _greedy_over_horizon(df_energy_insights: pd.DataFrame, battery_remaining_capacity: float,
+                         battery_max_capacity: float, lowest_charge_threshold: float,
+                         battery_charge_rate_hourly: float) -> pd.DataFrame:
     """
-    The core calculation function
+    The greedy engine over more than a day. Slots are charged cheapest first across the whole horizon, sized to
+    its energy requirement, then the cheapest slot before each low point is added until the threshold holds.
+    Either way a slot is only charged if the battery has room to keep its charge until the next low point, or the
+    end of the horizon, so cheap prices tomorrow hold back charging today instead of overfilling the battery
     """
-    giv_energy = GivEnergy(offline_debug, get_secret_or_env("GE_API_KEY"))
-    forecast = Forecast(offline_debug, get_secret_or_env("DATAPOINT_API_KEY"))
-    time_offsets = get_time_offsets()
+    df_energy_insights = df_energy_insights.copy()
+    energy = df_energy_insights['energy'].to_numpy(dtype=float)
+    prices = df_energy_insights['value_inc_vat'].to_numpy(dtype=float)
+    slots = len(energy)
+    overall_energy_requirement = round(df_energy_insights['energy'].sum() +
+                                       (battery_max_capacity - battery_remaining_capacity), 2)
+    slots_to_charge = math.ceil((overall_energy_requirement / battery_charge_rate_hourly) * 2)
+
+    # charge all negative priced slots. Slots that energy company pays customer to use energy
+    charge = prices < 0
+    charged_energy = np.where(charge, energy - 1.8, energy)
+
+    # simulate_running_battery_capacity takes a half hour's charge back off whenever the battery is within one of
+    # full, so a slot's charge only lasts if the battery stays below that until it is needed
+    room = battery_max_capacity - battery_charge_rate_hourly / 2
+
+    def following_max(until):
+        # the highest level from each slot up to the one before until, -inf where there are none
+        highest = np.full(until, -np.inf)
+        if until > 1:
+            highest[:until - 1] = np.maximum.accumulate(running[:until - 1][::-1])[::-1]
+        return highest
+
+    def charge_slot(slot):
+        # a charge only changes the levels until the battery next empties or fills, so re-simulate until then
+        charge[slot] = True
+        charged_energy[slot] -= 1.8
+        _simulate_from_slot(charged_energy, running, corrected, slot, battery_remaining_capacity,
+                            battery_max_capacity, battery_charge_rate_hourly, settle=True)
+
+    running, corrected = simulate_running_battery_capacity(charged_energy, battery_remaining_capacity,
+                                                           battery_max_capacity, battery_charge_rate_hourly)
+    highest = following_max(slots)
+    charged_slots = int(charge.sum())
+    for slot in np.argsort(prices, kind='stable'):
+        if charged_slots >= slots_to_charge:
+            break
+        if not charge[slot] and highest[slot] + 1.8 <= room:
+            charge_slot(slot)
+            highest = following_max(slots)
+            charged_slots += 1
+
+    repair_rounds = 0
+    while slots > 2 and running[2:].min() < lowest_charge_threshold:
+        # the first slot below the threshold, skipping the first 2 slots if they are already charging
+        search_from = 2 if charge[0] and charge[1] else 0
+        low_slot = max(1, search_from + int(np.argmax(running[search_from:] < lowest_charge_threshold)))
+        candidates = ~charge[:low_slot + 1] & (following_max(low_slot + 1) + 1.8 <= room)
+        if not candidates.any():
+            break
+        charge_slot(int(np.argmin(np.where(candidates, prices[:low_slot + 1], np.inf))))
+        repair_rounds += 1
 
-    df_energy_result, giv_energy = calculate_battery_depletion_time(giv_energy,
-                                                                    forecast,
-                                                                    time_offsets)
+    metrics.current().put('repair_rounds', repair_rounds)
+    df_energy_insights['charge'] = charge
+    df_energy_insights['charged_energy'] = charged_energy
+    df_energy_insights['running_battery_capacity'] = running
+    return df_energy_insights
 
-    # filter Octopus data to find the cheapest value in time frame available
-    octopus = Octopus(offline_debug, get_secret_or_env("OCTOPUS_API_KEY"))
-    df_agile_data = get_agile_data(octopus, time_offsets)
 
+def plan_charging(df_energy_result, df_agile_data, battery_spec, time_offsets,
+                  threshold=lowest_charge_threshold, engine='greedy', max_charge_windows=None):
+    """
+    Choose the charge slots for the energy estimate and Agile prices, then merge the ones in the first 24 hours
+    into time windows. Returns the planned slots and the charge windows, which is empty if nothing needs charging
+    """
+    # plan over every published price, past the end of the history profiles if need be
+    df_energy_result = tile_daily_profile(df_energy_result, len(df_agile_data))
     df_energy_insights = concat_data_sources(df_energy_result, df_agile_data)
     df_energy_insights = determine_optimal_charging_periods(df_energy_insights,
-                                                  giv_energy.system_specs["battery_spec"][
-                                                      "battery_kwatt_hours_remaining"],
-                                                  giv_energy.system_specs["battery_spec"]["watt_hour"] / 1000,
-                                                  lowest_charge_threshold,
-                                                  giv_energy.system_specs["battery_spec"][
-                                                      "max_charge_rate_watts"] / 1000
-                                                  )
-
-    df_energy_insight_windows = df_energy_insights[df_energy_insights['charge'] == True].copy()
+                                                            battery_spec["battery_kwatt_hours_remaining"],
+                                                            battery_spec["watt_hour"] / 1000,
+                                                            threshold,
+                                                            battery_spec["max_charge_rate_watts"] / 1000,
+                                                            engine=engine,
+                                                            max_charge_windows=max_charge_windows)
+
+    run_metrics = metrics.current()
+    run_metrics.put('planned_slots', len(df_energy_insights.index))
+    df_execution = df_energy_insights.iloc[:execution_horizon_slots]
+    df_energy_insight_windows = df_execution[df_execution['charge'] == True].copy()
+    run_metrics.put('slots_charged', len(df_energy_insight_windows.index))
 
     if len(df_energy_insight_windows.index) > 0:
         df_energy_insight_windows = prepare_time_windows_for_givenergy(df_energy_insight_windows, time_offsets)
+        run_metrics.put('charge_windows', len(df_energy_insight_windows.index))
+    return df_energy_insights, df_energy_insight_windows
+
+
+def calculate_charge_windows(offline_debug, aws_fields, cloudwatch, scheduler=None, engine=None,
+                             max_charge_windows=None):
+    """
+    The core calculation function
 
-        # Set the first time window, send the following windows to cloudwatch
-        update_inverter_charge_time(giv_energy, offline_debug,
-                                    df_energy_insight_windows.iloc[0]["from_hours_giv"],
-                                    df_energy_insight_windows.iloc[0]["too_hours_giv"])
+    The Met Office forecast and Octopus tariffs don't depend on GivEnergy, so they are fetched
+    while the GivEnergy system specs and history are, and joined when the data sources are combined.
+    engine and max_charge_windows default to CHARGE_ENGINE and MAX_CHARGE_WINDOWS, see plan_charging
+    """
+    run_metrics = metrics.current()
+    with run_metrics.stage('secrets'):
+        ge_api_key = get_secret_or_env("GE_API_KEY")
+        forecast = Forecast(offline_debug, get_secret_or_env("DATAPOINT_API_KEY"))
+        octopus = Octopus(offline_debug, get_secret_or_env("OCTOPUS_API_KEY"))
+    time_offsets = get_time_offsets()
+    history_store = None if offline_debug else EnergyHistoryStore.from_env()
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        forecast_future = executor.submit(run_metrics.timed('forecast', analyse_forecast), forecast)
+        # filter Octopus data to find the cheapest value in time frame available
+        agile_future = executor.submit(run_metrics.timed('agile_tariff', get_agile_data), octopus, time_offsets)
+
+        with run_metrics.stage('battery_depletion'):
+            giv_energy = GivEnergy(offline_debug, ge_api_key)
+            df_energy_result, giv_energy = calculate_battery_depletion_time(giv_energy,
+                                                                            forecast,
+                                                                            time_offsets,
+                                                                            history_store,
+                                                                            forecast_future)
+        df_agile_data = agile_future.result()
+
+    with run_metrics.stage('optimize'):
+        df_energy_insights, df_energy_insight_windows = plan_charging(
+            df_energy_result, df_agile_data, giv_energy.system_specs["battery_spec"], time_offsets,
+            engine=engine or charge_engine,
+            max_charge_windows=charge_engine_max_windows if max_charge_windows is None else max_charge_windows)
 
-        cloud_watch_times = df_energy_insight_windows[['from_hours_giv', 'too_hours_giv', 'from_hours_aws', 'too_hours_aws']].to_dict('records')
-        cloud_watch_times = update_cloud_watch(cloudwatch, cloud_watch_times, aws_fields)
+    if len(df_energy_insight_windows.index) > 0:
+        # Program as many windows as the inverter has charge slots for, chain the rest through cloudwatch
+        charge_windows = df_energy_insight_windows[['from_hours_giv', 'too_hours_giv', 'from_hours_aws', 'too_hours_aws']].to_dict('records')
+        program_charge_windows(giv_energy, offline_debug, charge_windows, cloudwatch, aws_fields, scheduler)
 
         # analyse_data(df_house_consumption, df_solar_production)
         times = df_energy_insight_windows[['from_hours_giv', 'too_hours_giv', 'from_hours_aws', 'too_hours_aws']].to_json(orient='records')
         return times, df_energy_insights
     else:
+        if scheduler is not None:
+            # updates scheduled by an earlier plan, or a rule left from chaining, would program their windows again
+            scheduler.sync([], aws_fields)
+            if cloudwatch is not None:
+                disable_cloud_watch(cloudwatch, aws_fields)
         return None, df_energy_insights
 
 
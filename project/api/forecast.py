@@ -4,14 +4,37 @@ https://www.metoffice.gov.uk/binaries/content/assets/metofficegovuk/pdf/data/dat
 """
 
 import copy
+import json
+import logging
 import os
+import tempfile
+import threading
+import time
+from contextlib import closing
 
+import numpy as np
 import pandas as pd
-import requests
 from requests.auth import HTTPBasicAuth
 
+from project.api import http_session
+from project.example_responses.example_data_handler import (ForecastData, get_file_path)
 
-from project.example_responses.example_data_handler import (OctopusData)
+logger = logging.getLogger(__name__)
+
+# Half hour forecast frames are cached per site and day, with the issue time (dataDate) of the forecast they were
+# built from, across warm Lambda invocations and in a file in /tmp
+forecast_cache_path = os.environ.get("FORECAST_CACHE_PATH", "/tmp/forecast_cache.json")
+_forecast_cache = {}
+_forecast_cache_lock = threading.Lock()
+
+# a cached frame is used without asking for the issue time again for this long. Site forecasts are issued hourly
+forecast_revalidate_seconds = int(os.environ.get("FORECAST_REVALIDATE_SECONDS", 900))
+
+try:
+    # ijson parses the responses as a stream, so only the parts that are used are kept in memory
+    import ijson
+except ImportError:
+    ijson = None
 
 
 class Forecast:
@@ -23,21 +46,183 @@ class Forecast:
 
     def get_location_data(self):
         if self.offline_debug:
-            return copy.deepcopy(OctopusData.agile_tariff())
+            return copy.deepcopy(ForecastData.location_data())
         else:
             url = f"{self.base_url}val/wxfcs/all/json/sitelist?res=3hourly&key={self.api_key}"
-            response = requests.get(url)
-            response.raise_for_status()
-            return response.json()
+            # the whole response is returned, but it is parsed from the stream without a copy of its text
+            with closing(self._open_stream(url, ForecastData.location_data_file)) as stream:
+                return json.load(stream)
 
     def get_forecast_location(self, location):
         if self.offline_debug:
-            return copy.deepcopy(OctopusData.agile_tariff())
+            return copy.deepcopy(ForecastData.forecast_location())
         else:
             url = f"{self.base_url}val/wxfcs/all/json/{location}?res=3hourly&key={self.api_key}"
-            response = requests.get(url)
+            # the whole response is returned, but it is parsed from the stream without a copy of its text
+            with closing(self._open_stream(url, ForecastData.forecast_location_file)) as stream:
+                return json.load(stream)
+
+    def get_issue_time(self):
+        """
+        Issue time (dataDate) of the current 3 hourly site forecasts, from the small capabilities response
+        """
+        if self.offline_debug:
+            return ForecastData.forecast_location()['SiteRep']['DV']['dataDate']
+        url = f"{self.base_url}val/wxfcs/all/json/capabilities?res=3hourly&key={self.api_key}"
+        response = http_session.request('GET', url)
+        response.raise_for_status()
+        return response.json()['Resource']['dataDate']
+
+    def find_location(self, location_id=None, name=None):
+        """
+        Stream the site list and return the first site matching the id or name, or None
+        """
+        url = f"{self.base_url}val/wxfcs/all/json/sitelist?res=3hourly&key={self.api_key}"
+        with closing(self._open_stream(url, ForecastData.location_data_file)) as stream:
+            for location in _iter_items(stream, 'Locations.Location.item', ('Locations', 'Location')):
+                if (location_id is not None and location['id'] == str(location_id)) or \
+                        (name is not None and location['name'] == name):
+                    return location
+        return None
+
+    def iter_forecast_periods(self, location, dates):
+        """
+        Stream the 3 hourly site forecast, yielding only the days in dates as (date, period)
+        Dates are in the format "2023-08-18Z"
+        """
+        url = f"{self.base_url}val/wxfcs/all/json/{location}?res=3hourly&key={self.api_key}"
+        with closing(self._open_stream(url, ForecastData.forecast_location_file)) as stream:
+            for period in _iter_items(stream, 'SiteRep.DV.Location.Period.item',
+                                      ('SiteRep', 'DV', 'Location', 'Period')):
+                if period['value'] in dates:
+                    yield period['value'], period
+
+    def get_solar_index_forecast(self, location, dates):
+        """
+        Solar index for each 3 hourly prediction on the given dates, as numpy arrays of
+        (date index, timer, solar_index). timer is hours from midnight of the first date
+        """
+        date_index, timer, solar_index = [], [], []
+        for date, period in self.iter_forecast_periods(location, dates):
+            count = dates.index(date)
+            for predictions in period["Rep"]:
+                date_index.append(count)
+                timer.append(count * 24 + int(predictions['$']) / 60)
+                solar_index.append(int(predictions['U']))
+        return np.array(date_index, dtype=int), np.array(timer, dtype=float), np.array(solar_index, dtype=int)
+
+    def _open_stream(self, url, example_file):
+        if self.offline_debug:
+            return open(get_file_path(example_file), 'rb')
+        response = http_session.request('GET', url, stream=True)
+        try:
             response.raise_for_status()
-            return response.json()
+        except Exception:
+            # an error's body is never read, so release its connection back to the pool
+            response.close()
+            raise
+        response.raw.decode_content = True
+        return response.raw
+
+
+def clear_forecast_cache():
+    """
+    Forget every cached forecast, in memory and in the cache file
+    """
+    with _forecast_cache_lock:
+        _forecast_cache.clear()
+        if forecast_cache_path and os.path.exists(forecast_cache_path):
+            os.remove(forecast_cache_path)
+
+
+def cached_forecast(forecast, location, dates, build, now=None):
+    """
+    The half hour forecast frame for a site and dates, built by calling build() only when the cache doesn't
+    have one from the forecast issued now. A frame checked within forecast_revalidate_seconds is used as it is,
+    after that the issue time is asked for and the frame is rebuilt if a newer forecast has been issued.
+    Offline the frame is always built
+    """
+    if forecast.offline_debug:
+        return build()
+
+    now = now or time.time()
+    key = f"{location}/{dates[0]}"
+    with _forecast_cache_lock:
+        if not _forecast_cache and forecast_cache_path:
+            _forecast_cache.update(_read_file_cache())
+        entry = _forecast_cache.get(key)
+    if entry is not None and now - entry['validated_at'] < forecast_revalidate_seconds:
+        return pd.DataFrame(entry['frame'])
+
+    try:
+        issue_time = forecast.get_issue_time()
+    except Exception as error:
+        logger.warning(f"Couldn't get the forecast issue time, not caching the forecast: {error!r}")
+        issue_time = None
+    if entry is not None and issue_time is not None and entry['issue_time'] == issue_time:
+        with _forecast_cache_lock:
+            entry['validated_at'] = now
+            _write_file_cache(_forecast_cache)
+        return pd.DataFrame(entry['frame'])
+
+    df_forecast = build()
+    if issue_time is not None:
+        with _forecast_cache_lock:
+            _forecast_cache[key] = {'issue_time': issue_time, 'validated_at': now,
+                                    'frame': df_forecast.to_dict('list')}
+            # earlier days are never asked for again
+            for stale in [stale for stale in _forecast_cache if stale.rsplit('/', 1)[-1] < dates[0]]:
+                del _forecast_cache[stale]
+            _write_file_cache(_forecast_cache)
+    return df_forecast
+
+
+def _read_file_cache():
+    try:
+        with open(forecast_cache_path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_file_cache(file_cache):
+    if not forecast_cache_path:
+        return
+    directory = os.path.dirname(os.path.abspath(forecast_cache_path))
+    with tempfile.NamedTemporaryFile('w', dir=directory, delete=False) as file:
+        json.dump(file_cache, file)
+    os.replace(file.name, forecast_cache_path)
+
+
+def _iter_items(stream, prefix, keys):
+    """
+    Yield each item of the array at prefix, streamed with ijson when it is installed
+    """
+    if ijson is not None:
+        yield from ijson.items(stream, prefix)
+    else:
+        data = json.load(stream)
+        for key in keys:
+            data = data[key]
+        yield from data
+
+
+def resample_to_half_hours(df_forecast, hours_per_row=3, interpolate=False, time_column='timer'):
+    """
+    Spread 3 hourly forecast rows over the half hour time grid, each row covers the half hours up to the next row.
+    Times are in hours, with interpolate the solar index is interpolated linearly between rows instead of repeated.
+    """
+    df_forecast = df_forecast.sort_values(by=[column for column in ('date', time_column)
+                                              if column in df_forecast.columns]).reset_index(drop=True)
+    repeats = int(hours_per_row * 2)
+    steps = np.tile(np.arange(repeats), len(df_forecast))
+    df_half_hours = df_forecast.loc[df_forecast.index.repeat(repeats)].reset_index(drop=True)
+    df_half_hours[time_column] = df_half_hours[time_column] + steps * 0.5
+    if interpolate:
+        # rows are evenly spaced, so interpolate on row position
+        df_half_hours['solar_index'] = np.interp(df_half_hours.index // repeats + steps / repeats,
+                                                 df_forecast.index, df_forecast['solar_index'])
+    return df_half_hours
 
 
 if __name__ == '__main__':
@@ -66,18 +251,5 @@ if __name__ == '__main__':
     # $: minutes past midnight
 
     # fill out for half hour slots
-    # Choosing the row with index 1 (second row) to duplicate
-    all_rows = []
-    for row in range(df_forecast.shape[0]):
-        chosen_row = df_forecast.loc[row].copy()
-
-        # Duplicating the row 4 times and increasing the value in column 'A' by 0.5 each time
-        duplicated_rows = []
-        for i in range(5):
-            chosen_row['time'] += 0.5
-            duplicated_rows.append(chosen_row.copy())
-        all_rows = all_rows + duplicated_rows
-        # Concatenate the duplicated rows to the original dataframe
-    df_forecast = pd.concat([df_forecast, pd.DataFrame(all_rows)], ignore_index=True)
-    df_forecast = df_forecast.sort_values(by=['date', 'time'])
-    print(1)
\ No newline at end of file
+    df_forecast = resample_to_half_hours(df_forecast, time_column='time')
+    print(1)
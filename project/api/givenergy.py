@@ -1,7 +1,16 @@
 import copy
+import hashlib
+import json
 import logging
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
 
+from project.api import http_session
 from project.example_responses.example_data_handler import *
 
 logger = logging.getLogger(__name__)
@@ -10,15 +19,128 @@ logger = logging.getLogger(__name__)
 https://givenergy.cloud/docs/api/v1#introduction
 """
 
+# Most energy-flows requests to have in flight at once, the GivEnergy API rate limits per API key
+max_concurrent_requests = int(os.environ.get("GE_MAX_CONCURRENT_REQUESTS", 4))
+_energy_usage_slots = threading.BoundedSemaphore(max_concurrent_requests)
+
+# The communication-device response (battery size, charge rate, inverter serial) hardly ever changes,
+# so it is kept across warm Lambda invocations and optionally in a file, until it is older than the TTL
+system_spec_ttl_seconds = int(os.environ.get("GE_SYSTEM_SPEC_TTL_SECONDS", 24 * 60 * 60))
+system_spec_cache_path = os.environ.get("GE_SYSTEM_SPEC_CACHE_PATH")
+_system_spec_cache = {}
+
+
+def invalidate_system_spec_cache(api_key=None):
+    """
+    Forget the cached system specifications for one API key, or for every key when api_key is None
+    """
+    keys = [_cache_key(api_key)] if api_key is not None else list(_system_spec_cache)
+    for key in keys:
+        _system_spec_cache.pop(key, None)
+    if system_spec_cache_path and os.path.exists(system_spec_cache_path):
+        file_cache = _read_file_cache()
+        for key in keys if api_key is not None else list(file_cache):
+            file_cache.pop(key, None)
+        _write_file_cache(file_cache)
+
+
+def _cache_key(api_key):
+    # never keep the API key itself in the cache file
+    return hashlib.sha256(str(api_key).encode()).hexdigest()[:16]
+
+
+def _read_file_cache():
+    try:
+        with open(system_spec_cache_path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_file_cache(file_cache):
+    directory = os.path.dirname(os.path.abspath(system_spec_cache_path))
+    with tempfile.NamedTemporaryFile('w', dir=directory, delete=False) as file:
+        json.dump(file_cache, file)
+    os.replace(file.name, system_spec_cache_path)
+
+
 class GivEnergy:
-    def __init__(self, offline_debug, api_key):
+    def __init__(self, offline_debug, api_key, inverter_serial_number=None):
         self.offline_debug = offline_debug
         self.base_url = 'https://api.givenergy.cloud'
         self.api_key = api_key
-        self.system_specs_raw = self.get_system_specifications()
-        self.system_specs = {}
+        self.headers = {
+            'Authorization': f'Bearer {self.api_key}',
+            'Content-Type': 'application/json',
+            'Accept': 'application/json'
+        }
+        # system specs and serial number are only requested the first time they are used
+        self._system_specs_raw = None
+        self._system_specs = None
+        self._inverter_serial_number = inverter_serial_number
         self.inverter_data = {}
-        self.inverter_serial_number = self.extract_inverter_serial_number()
+
+    @property
+    def system_specs_raw(self):
+        if self._system_specs_raw is None:
+            self._system_specs_raw = self.get_cached_system_specifications()
+        return self._system_specs_raw
+
+    @system_specs_raw.setter
+    def system_specs_raw(self, value):
+        self._system_specs_raw = value
+
+    @property
+    def system_specs(self):
+        if self._system_specs is None:
+            self.extract_system_spec()
+        return self._system_specs
+
+    @system_specs.setter
+    def system_specs(self, value):
+        self._system_specs = value
+
+    @property
+    def inverter_serial_number(self):
+        if self._inverter_serial_number is None:
+            self._inverter_serial_number = self.extract_inverter_serial_number()
+        return self._inverter_serial_number
+
+    @inverter_serial_number.setter
+    def inverter_serial_number(self, value):
+        self._inverter_serial_number = value
+
+    def get_cached_system_specifications(self):
+        """
+        System specifications from the in memory cache, then the cache file, then the API
+        """
+        if self.offline_debug:
+            return self.get_system_specifications()
+
+        key = _cache_key(self.api_key)
+        cached = _system_spec_cache.get(key)
+        if cached is None and system_spec_cache_path:
+            cached = _read_file_cache().get(key)
+        if cached is not None and time.time() - cached['fetched_at'] < system_spec_ttl_seconds:
+            _system_spec_cache[key] = cached
+            return copy.deepcopy(cached['data'])
+
+        data = self.get_system_specifications()
+        cached = {'fetched_at': time.time(), 'data': data}
+        _system_spec_cache[key] = cached
+        if system_spec_cache_path:
+            file_cache = _read_file_cache()
+            file_cache[key] = cached
+            _write_file_cache(file_cache)
+        return copy.deepcopy(data)
+
+    def invalidate_system_specs(self):
+        """
+        Drop this client's cached system specifications, so they are requested again on next use
+        """
+        invalidate_system_spec_cache(self.api_key)
+        self._system_specs_raw = None
+        self._system_specs = None
 
     def get_system_specifications(self):
         """
@@ -31,13 +153,8 @@ class GivEnergy:
             params = {
                 'page': '1',
             }
-            headers = {
-                'Authorization': f'Bearer {self.api_key}',
-                'Content-Type': 'application/json',
-                'Accept': 'application/json'
-            }
             try:
-                response = requests.request('GET', url, headers=headers, params=params)
+                response = http_session.request('GET', url, headers=self.headers, params=params)
                 response.raise_for_status()
                 return response.json()
             except requests.exceptions.RequestException as error:
@@ -57,16 +174,12 @@ class GivEnergy:
         https://givenergy.cloud/docs/api/v1#inverter-data-GETinverter--inverter_serial_number--system-data-latest
         """
         if self.offline_debug:
-            return copy.deepcopy(GivEnergyData.inverter_systems())
+            self.inverter_data = copy.deepcopy(GivEnergyData.inverter_systems())
+            return self.inverter_data
         else:
             url = f'{self.base_url}/v1/inverter/{self.inverter_serial_number}/system-data/latest'
-            headers = {
-                'Authorization': f'Bearer {self.api_key}',
-                'Content-Type': 'application/json',
-                'Accept': 'application/json'
-            }
             try:
-                response = requests.request('GET', url, headers=headers)
+                response = http_session.request('GET', url, headers=self.headers)
                 response.raise_for_status()
                 self.inverter_data = response.json()
             except requests.exceptions.RequestException as error:
@@ -81,7 +194,11 @@ class GivEnergy:
         https://givenergy.cloud/docs/api/v1#energy-flow-data-POSTinverter--inverter_serial_number--energy-flows
         """
         if self.offline_debug:
-            return copy.deepcopy(GivEnergyData.energy_usage())
+            # the recorded response only has flow types 0, 3 and 5, answer with the types asked for like the API
+            energy_usage = copy.deepcopy(GivEnergyData.energy_usage())
+            for half_hour in energy_usage['data'].values():
+                half_hour['data'] = {str(e_type): half_hour['data'].get(str(e_type), 0.0) for e_type in e_types}
+            return energy_usage
         else:
             payload = {"start_time": start_date,
                        "end_time": end_date,
@@ -89,13 +206,10 @@ class GivEnergy:
                        "types": e_types}
 
             url = f'{self.base_url}/v1/inverter/{self.inverter_serial_number}/energy-flows'
-            headers = {
-                'Authorization': f'Bearer {self.api_key}',
-                'Content-Type': 'application/json',
-                'Accept': 'application/json'
-            }
             try:
-                response = requests.request('POST', url, headers=headers, json=payload)
+                # consumption and solar history are fetched at the same time, keep within the cap across both
+                with _energy_usage_slots:
+                    response = http_session.request('POST', url, headers=self.headers, json=payload)
                 response.raise_for_status()
                 return response.json()
             except requests.exceptions.RequestException as error:
@@ -105,6 +219,34 @@ class GivEnergy:
                 logger.error(f"An unexpected error occurred: {general_error}")
                 raise
 
+    def get_energy_usage_ranges(self, date_ranges, e_types, max_workers=None, raise_errors=True):
+        """
+        Request energy usage for several date ranges in parallel, with at most max_workers requests in flight.
+        date_ranges is a list of {'start_date': .., 'end_date': ..} dicts, results are returned in the same order.
+        Every failed range is logged with its dates and the first failure is raised once all requests finish,
+        or with raise_errors=False failed ranges are returned as None.
+        """
+        if not date_ranges:
+            return []
+        max_workers = max_workers or max_concurrent_requests
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(date_ranges))) as executor:
+            futures = [executor.submit(self.get_energy_usage, dates['start_date'], dates['end_date'], e_types)
+                       for dates in date_ranges]
+
+        results = []
+        errors = []
+        for dates, future in zip(date_ranges, futures):
+            error = future.exception()
+            if error is not None:
+                logger.error(f"Energy usage request failed for {dates['start_date']} to {dates['end_date']}: {error}")
+                errors.append(error)
+                results.append(None)
+            else:
+                results.append(future.result())
+        if errors and raise_errors:
+            raise errors[0]
+        return results
+
     def get_inverter_settings(self):
         """
         https://givenergy.cloud/docs/api/v1#inverter-control-GETinverter--inverter_serial_number--settings
@@ -113,12 +255,8 @@ class GivEnergy:
             return copy.deepcopy(GivEnergyData.inverter_settings())
         else:
             url = f'{self.base_url}/v1/inverter/{self.inverter_serial_number}/settings'
-            headers = {
-                'Authorization': f'Bearer {self.api_key}',
-                'Content-Type': 'application/json',
-                'Accept': 'application/json'}
             try:
-                response = requests.request('GET', url, headers=headers)
+                response = http_session.request('GET', url, headers=self.headers)
                 response.raise_for_status()
                 return response.json()
             except requests.exceptions.RequestException as error:
@@ -136,13 +274,8 @@ class GivEnergy:
             return copy.deepcopy(GivEnergyData.read_inverter_setting())
         else:
             url = f'{self.base_url}/v1/inverter/{self.inverter_serial_number}/settings/{setting}/read'
-            headers = {
-                'Authorization': f'Bearer {self.api_key}',
-                'Content-Type': 'application/json',
-                'Accept': 'application/json'
-            }
             try:
-                response = requests.request('POST', url, headers=headers)
+                response = http_session.request('POST', url, headers=self.headers)
                 response.raise_for_status()
                 return response.json()
             except requests.exceptions.RequestException as error:
@@ -159,12 +292,8 @@ class GivEnergy:
         url = f'{self.base_url}/v1/inverter/{self.inverter_serial_number}/settings/{setting}/write'
         payload = {"value": f"{value}"}
         if not self.offline_debug:
-            headers = {
-                'Authorization': f'Bearer {self.api_key}',
-                'Content-Type': 'application/json',
-                'Accept': 'application/json'}
             try:
-                response = requests.request('POST', url, headers=headers, json=payload)
+                response = http_session.request('POST', url, headers=self.headers, json=payload)
                 response.raise_for_status()
                 return response.json()
             except requests.exceptions.RequestException as error:
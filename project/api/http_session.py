@@ -0,0 +1,112 @@
+import logging
+import os
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+"""
+Shared transport for the GivEnergy, Octopus and Met Office clients.
+One keep-alive session per host, so repeated calls reuse the same connection instead of a new TCP + TLS
+handshake each time, with timeouts and jittered exponential backoff on rate limits and server errors.
+"""
+
+timeout_seconds = float(os.environ.get("HTTP_TIMEOUT_SECONDS", 30))
+max_retries = int(os.environ.get("HTTP_MAX_RETRIES", 3))
+backoff_seconds = float(os.environ.get("HTTP_BACKOFF_SECONDS", 0.5))
+max_backoff_seconds = float(os.environ.get("HTTP_MAX_BACKOFF_SECONDS", 10))
+pool_size = int(os.environ.get("HTTP_POOL_SIZE", 10))
+
+retry_status_codes = {429, 500, 502, 503, 504}
+
+_sessions = {}
+_host_stats = {}
+_lock = threading.Lock()
+
+
+def get_session(url):
+    """
+    Get the shared session for the url's host, creating it the first time the host is used
+    """
+    host = urlsplit(url).netloc
+    with _lock:
+        session = _sessions.get(host)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _sessions[host] = session
+        return session
+
+
+def request(method, url, timeout=None, retries=None, **kwargs):
+    """
+    Send a request on the host's shared session, retrying connection errors and retryable status codes.
+
+    Takes the same keyword arguments as requests.request. The last response is returned as is,
+    so callers still call raise_for_status on it.
+    """
+    session = get_session(url)
+    timeout = timeout or timeout_seconds
+    retries = max_retries if retries is None else retries
+    host = urlsplit(url).netloc
+
+    for attempt in range(retries + 1):
+        start = time.perf_counter()
+        try:
+            response = session.request(method, url, timeout=timeout, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as error:
+            _record(host, time.perf_counter() - start, 0, error=True)
+            if attempt == retries:
+                raise
+            logger.warning(f"{method} {host} failed with {error}, retrying")
+            _sleep_before_retry(attempt, None)
+            continue
+
+        # streamed bodies haven't been read yet, count them by their header instead
+        size = int(response.headers.get('Content-Length', 0)) if kwargs.get('stream') else len(response.content)
+        _record(host, time.perf_counter() - start, size, error=response.status_code >= 400)
+        if response.status_code not in retry_status_codes or attempt == retries:
+            return response
+        logger.warning(f"{method} {host} returned {response.status_code}, retrying")
+        # a streamed body is never read, so release its connection back to the pool
+        response.close()
+        _sleep_before_retry(attempt, response.headers.get('Retry-After'))
+
+
+def _sleep_before_retry(attempt, retry_after):
+    if retry_after is not None and retry_after.isdigit():
+        delay = float(retry_after)
+    else:
+        delay = backoff_seconds * 2 ** attempt * random.uniform(0.5, 1.0)
+    time.sleep(min(delay, max_backoff_seconds))
+
+
+def _record(host, seconds, size, error=False):
+    with _lock:
+        stats = _host_stats.setdefault(host, {'calls': 0, 'errors': 0, 'bytes': 0, 'total_seconds': 0.0,
+                                              'max_seconds': 0.0})
+        stats['calls'] += 1
+        stats['errors'] += error
+        stats['bytes'] += size
+        stats['total_seconds'] += seconds
+        stats['max_seconds'] = max(stats['max_seconds'], seconds)
+
+
+def get_host_stats():
+    """
+    Call count, error count, bytes received and latency for each host since the last reset
+    """
+    with _lock:
+        return {host: dict(stats) for host, stats in _host_stats.items()}
+
+
+def reset_host_stats():
+    with _lock:
+        _host_stats.clear()
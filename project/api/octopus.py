@@ -1,23 +1,219 @@
 import copy
-import requests
+import json
+import logging
+import os
+import tempfile
+import threading
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+import pytz
 from requests.auth import HTTPBasicAuth
 
+from project.api import http_session
 from project.example_responses.example_data_handler import (OctopusData)
 
+logger = logging.getLogger(__name__)
+
+product_code = "AGILE-FLEX-22-11-25"
+# the last letter of a tariff code is the region, its grid supply point group
+default_region = os.environ.get("OCTOPUS_REGION", "G")
+
+# Agile prices up to 23:00 UK time the next day are published once a day, around 16:00 UK time. A day that wasn't
+# complete when it was cached is only requested again once it is missing rates that should have been published
+agile_publish_hour = int(os.environ.get("AGILE_PUBLISH_HOUR", 16))
+
+# least time between requests for a day whose published rates are missing, as publication is sometimes late
+agile_refresh_minutes = int(os.environ.get("AGILE_REFRESH_MINUTES", 15))
+uk_timezone = pytz.timezone('Europe/London')
+
+# Rates are cached per product, tariff code and UTC day, across warm Lambda invocations and in a file in /tmp
+tariff_cache_path = os.environ.get("AGILE_TARIFF_CACHE_PATH", "/tmp/agile_tariff_cache.json")
+_tariff_cache = {}
+_tariff_cache_lock = threading.Lock()
+
+time_format = "%Y-%m-%dT%H:%M:%SZ"
+
+# largest page the standard unit rates endpoint returns, about a month of half hours
+historic_page_size = 1500
+
+
+def clear_tariff_cache():
+    """
+    Forget every cached rate, in memory and in the cache file
+    """
+    with _tariff_cache_lock:
+        _tariff_cache.clear()
+        if tariff_cache_path and os.path.exists(tariff_cache_path):
+            os.remove(tariff_cache_path)
+
+
+def published_until(now):
+    """
+    End of the rates that are expected to be published by now (naive UTC), 23:00 UK time today or,
+    after the publish hour, tomorrow. As a naive UTC datetime
+    """
+    local = pytz.utc.localize(now).astimezone(uk_timezone)
+    day = local.date() if local.hour < agile_publish_hour else local.date() + timedelta(days=1)
+    end = uk_timezone.localize(datetime(day.year, day.month, day.day, 23))
+    return end.astimezone(pytz.utc).replace(tzinfo=None)
+
+
+def _read_file_cache():
+    try:
+        with open(tariff_cache_path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_file_cache(file_cache):
+    directory = os.path.dirname(os.path.abspath(tariff_cache_path))
+    with tempfile.NamedTemporaryFile('w', dir=directory, delete=False) as file:
+        json.dump(file_cache, file)
+    os.replace(file.name, tariff_cache_path)
+
+
+class AgileRates:
+    """
+    Agile unit rates sorted by slot start, with a binary search lookup of the slot covering a time
+    """
+    def __init__(self, results):
+        self.results = sorted(results, key=lambda rate: rate['valid_from'])
+        self.valid_from = np.array([rate['valid_from'].rstrip('Z') for rate in self.results], dtype='datetime64[s]')
+        self.valid_to = np.array([rate['valid_to'].rstrip('Z') for rate in self.results], dtype='datetime64[s]')
+
+    def __len__(self):
+        return len(self.results)
+
+    def slot_index(self, time):
+        """
+        Index of the slot that covers time (naive UTC), or None if there isn't one
+        """
+        time = np.datetime64(time, 's')
+        index = int(np.searchsorted(self.valid_from, time, side='right')) - 1
+        if index < 0 or time >= self.valid_to[index]:
+            return None
+        return index
+
+    def to_frame(self):
+        return pd.DataFrame(self.results)
+
 
 class Octopus:
-    def __init__(self, offline_debug, api_key):
+    def __init__(self, offline_debug, api_key, region=None):
         self.offline_debug = offline_debug
         self.api_key = api_key
         self.base_url = "https://api.octopus.energy"
         self.auth = HTTPBasicAuth(self.api_key, '')
+        self.region = region or default_region
+        self.tariff_code = f"E-1R-{product_code}-{self.region}"
 
-    def get_tariff_data(self):
+    def get_tariff_data(self, period_from=None, period_to=None):
+        """
+        Request the standard unit rates, only between period_from and period_to (naive UTC) when they are given
+        """
         if self.offline_debug:
             return copy.deepcopy(OctopusData.agile_tariff())
         else:
-            product_code = "AGILE-FLEX-22-11-25"
-            tariff_code = f"E-1R-{product_code}-G"
-            tariff_url = f"{self.base_url}/v1/products/{product_code}/electricity-tariffs/{tariff_code}/standard-unit-rates/"
-            response = requests.get(tariff_url, auth=self.auth)
+            tariff_url = f"{self.base_url}/v1/products/{product_code}/electricity-tariffs/{self.tariff_code}/standard-unit-rates/"
+            params = {}
+            if period_from is not None:
+                params['period_from'] = period_from.strftime(time_format)
+            if period_to is not None:
+                params['period_to'] = period_to.strftime(time_format)
+            response = http_session.request('GET', tariff_url, auth=self.auth, params=params)
             return response.json()
+
+    def get_historic_rates(self, period_from, period_to):
+        """
+        Every rate between period_from and period_to (naive UTC), following the result pages.
+        Bypasses the tariff cache, which only keeps the days around now, so it suits backtesting over months
+        """
+        if self.offline_debug:
+            return AgileRates(self.get_tariff_data()['results'])
+
+        tariff_url = f"{self.base_url}/v1/products/{product_code}/electricity-tariffs/{self.tariff_code}/standard-unit-rates/"
+        params = {'period_from': period_from.strftime(time_format),
+                  'period_to': period_to.strftime(time_format),
+                  'page_size': historic_page_size}
+        results = []
+        while tariff_url:
+            response = http_session.request('GET', tariff_url, auth=self.auth, params=params)
+            page = response.json()
+            results.extend(page['results'])
+            # the next link carries the query on to the following page
+            tariff_url, params = page.get('next'), None
+        return AgileRates(results)
+
+    def get_agile_rates(self, period_from, period_to, now=None):
+        """
+        Rates for the slots between period_from and period_to (naive UTC), from the cache where possible.
+
+        Only the days that aren't cached, or weren't complete and may have been published since, are requested
+        """
+        if self.offline_debug:
+            return AgileRates(self.get_tariff_data()['results'])
+
+        now = now or datetime.utcnow()
+        days = pd.date_range(period_from.date(), (period_to - timedelta(microseconds=1)).date(), freq='D')
+        keys = [self._cache_key(day.strftime('%Y-%m-%d')) for day in days]
+
+        with _tariff_cache_lock:
+            if not _tariff_cache and tariff_cache_path:
+                _tariff_cache.update(_read_file_cache())
+
+            stale = [day for day, key in zip(days, keys) if self._needs_refresh(_tariff_cache.get(key), now)]
+            if stale:
+                # ask for the whole of the last day, so later windows find it complete in the cache
+                fetch_from = max(period_from, stale[0].to_pydatetime())
+                fetch_to = days[-1].to_pydatetime() + timedelta(days=1)
+                logger.info(f"Requesting Agile rates from {fetch_from} to {fetch_to}")
+                results = self.get_tariff_data(fetch_from, fetch_to)['results']
+                self._store(results, [key for day, key in zip(days, keys) if day >= stale[0]], now)
+
+            results = []
+            for key in keys:
+                results.extend(rate for rate in _tariff_cache.get(key, {}).get('results', [])
+                               if period_from.strftime(time_format) <= rate['valid_from'] < period_to.strftime(time_format))
+        return AgileRates(results)
+
+    @staticmethod
+    def _needs_refresh(entry, now):
+        if entry is None:
+            return True
+        # a day is complete once its rates run up to midnight, earlier slots that weren't asked for don't matter
+        day_start = datetime.strptime(entry['day'], '%Y-%m-%d')
+        expected_until = min(day_start + timedelta(days=1), published_until(now)).strftime(time_format)
+        cached_until = entry['results'][-1]['valid_to'] if entry['results'] else day_start.strftime(time_format)
+        if cached_until >= expected_until:
+            return False
+        # rates that should be out are missing, because they weren't published yet when the day was fetched
+        # or publication is late, so check again every few minutes until they arrive
+        fetched_at = datetime.strptime(entry['fetched_at'], time_format)
+        return now - fetched_at >= timedelta(minutes=agile_refresh_minutes)
+
+    def _cache_key(self, day):
+        return f"{product_code}/{self.tariff_code}/{day}"
+
+    def _store(self, results, keys, now):
+        fetched_at = now.strftime(time_format)
+        by_day = {key: {} for key in keys}
+        for key in keys:
+            for rate in _tariff_cache.get(key, {}).get('results', []):
+                by_day[key][rate['valid_from']] = rate
+        for rate in results:
+            key = self._cache_key(rate['valid_from'][:10])
+            if key in by_day:
+                by_day[key][rate['valid_from']] = rate
+        for key, rates in by_day.items():
+            _tariff_cache[key] = {'day': key.rsplit('/', 1)[-1], 'fetched_at': fetched_at,
+                                  'results': sorted(rates.values(), key=lambda rate: rate['valid_from'])}
+
+        # days before yesterday are never asked for again
+        oldest = (datetime.strptime(keys[0].rsplit('/', 1)[-1], '%Y-%m-%d') - timedelta(days=1)).strftime('%Y-%m-%d')
+        for key in [key for key in _tariff_cache if key.rsplit('/', 1)[-1] < oldest]:
+            del _tariff_cache[key]
+        if tariff_cache_path:
+            _write_file_cache(_tariff_cache)
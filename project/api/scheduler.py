@@ -0,0 +1,169 @@
+import hashlib
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import boto3
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger(__name__)
+
+"""
+Schedule every chained update at once, as dated one-shot EventBridge Scheduler schedules.
+
+The CloudWatch rule can only hold one daily cron, so each update has to put the rule again for the next one.
+Here all of a plan's updates are registered together, each schedule deletes itself once it has fired, and
+schedules left from an earlier plan are deleted. Names are made from the time and the event, so planning the
+same windows again makes no calls beyond the listing. LocalSchedulerClient stands in for the boto3 client offline.
+"""
+
+# role EventBridge Scheduler assumes to invoke the Lambda, one-shot scheduling is off unless it is set
+scheduler_role_arn = os.environ.get("SCHEDULER_ROLE_ARN")
+scheduler_group_name = os.environ.get("SCHEDULER_GROUP_NAME", "default")
+schedule_name_prefix = "charge-update"
+
+
+class OneShotScheduler:
+    def __init__(self, client, role_arn, group_name=None, name_prefix=schedule_name_prefix,
+                 function_name='calculate_charge_times'):
+        self.client = client
+        self.role_arn = role_arn
+        self.group_name = group_name or scheduler_group_name
+        self.name_prefix = name_prefix
+        self.function_name = function_name
+
+    def schedule_windows(self, windows, slots, aws_fields, now=None):
+        """
+        Schedule an update for each group of slots windows after the first, that programs them into the
+        inverter's charge slots once the last window of the group before has finished
+        """
+        updates = [(windows[start - 1]['too_hours_aws'], {'msg': 'update', 'data': windows[start:start + slots],
+                                                         'chain': False})
+                   for start in range(slots, len(windows), slots)]
+        return self.sync(updates, aws_fields, now)
+
+    def sync(self, updates, aws_fields, now=None):
+        """
+        Make the schedules match updates, a list of ('HH:MM' AWS time, event) in time order. Each time is
+        dated to its next occurrence after now and after the update before it.
+        Returns the names that were created and deleted
+        """
+        schedules = {}
+        fire_time = now or datetime.utcnow()
+        for time_of_day, event in updates:
+            fire_time = next_occurrence(time_of_day, fire_time)
+            schedules[self.schedule_name(fire_time, event)] = (fire_time, event)
+
+        existing = set(self.list_schedule_names())
+        created = [name for name in schedules if name not in existing]
+        stale = sorted(existing - set(schedules))
+        with ThreadPoolExecutor(max_workers=max(1, min(8, len(created) + len(stale)))) as executor:
+            futures = [executor.submit(self.create_schedule, name, *schedules[name], aws_fields) for name in created]
+            futures += [executor.submit(self.delete_schedule, name) for name in stale]
+            for future in futures:
+                future.result()
+        logger.info(f"Scheduled updates {created}, deleted {stale}")
+        return {'created': created, 'deleted': stale}
+
+    def schedule_name(self, fire_time, event):
+        digest = hashlib.sha1(json.dumps(event, sort_keys=True).encode()).hexdigest()[:8]
+        return f"{self.name_prefix}-{fire_time.strftime('%Y%m%dT%H%M')}-{digest}"
+
+    def list_schedule_names(self):
+        names = []
+        kwargs = {'GroupName': self.group_name, 'NamePrefix': self.name_prefix}
+        while True:
+            response = self.client.list_schedules(**kwargs)
+            names.extend(schedule['Name'] for schedule in response['Schedules'])
+            if not response.get('NextToken'):
+                return names
+            kwargs['NextToken'] = response['NextToken']
+
+    def create_schedule(self, name, fire_time, event, aws_fields):
+        self.client.create_schedule(
+            Name=name,
+            GroupName=self.group_name,
+            ScheduleExpression=f"at({fire_time.strftime('%Y-%m-%dT%H:%M:%S')})",
+            ScheduleExpressionTimezone='UTC',
+            FlexibleTimeWindow={'Mode': 'OFF'},
+            ActionAfterCompletion='DELETE',
+            Target={'Arn': f"arn:aws:lambda:{aws_fields['region']}:{aws_fields['account_id']}:function:{self.function_name}",
+                    'RoleArn': self.role_arn,
+                    'Input': json.dumps(event)})
+
+    def delete_schedule(self, name):
+        """
+        Delete a schedule, one that has already fired and deleted itself since it was listed is left as it is
+        """
+        try:
+            self.client.delete_schedule(Name=name, GroupName=self.group_name)
+        except ClientError as error:
+            if error.response['Error']['Code'] != 'ResourceNotFoundException':
+                raise
+            logger.info(f"Schedule {name} was already deleted")
+
+
+class LocalSchedulerClient:
+    """
+    Stand in for the boto3 scheduler client, holding the schedules in memory and counting the calls made
+    """
+    def __init__(self):
+        self.schedules = {}
+        self.calls = {'list_schedules': 0, 'create_schedule': 0, 'delete_schedule': 0}
+
+    def list_schedules(self, GroupName, NamePrefix='', NextToken=None):
+        self.calls['list_schedules'] += 1
+        return {'Schedules': [{'Name': name, 'GroupName': GroupName, 'State': 'ENABLED'}
+                              for (group, name) in sorted(self.schedules)
+                              if group == GroupName and name.startswith(NamePrefix)]}
+
+    def create_schedule(self, Name, GroupName, **kwargs):
+        self.calls['create_schedule'] += 1
+        if (GroupName, Name) in self.schedules:
+            raise _client_error('ConflictException', f"Schedule {Name} already exists", 'CreateSchedule')
+        self.schedules[(GroupName, Name)] = kwargs
+
+    def delete_schedule(self, Name, GroupName):
+        self.calls['delete_schedule'] += 1
+        if self.schedules.pop((GroupName, Name), None) is None:
+            raise _client_error('ResourceNotFoundException', f"Schedule {Name} does not exist", 'DeleteSchedule')
+
+    def due_events(self, now):
+        """
+        Events of the schedules due by now (naive UTC), removing them as EventBridge Scheduler does once they fire
+        """
+        due = sorted((datetime.strptime(schedule['ScheduleExpression'], 'at(%Y-%m-%dT%H:%M:%S)'), key)
+                     for key, schedule in self.schedules.items())
+        events = []
+        for fire_time, key in due:
+            if fire_time <= now:
+                events.append(json.loads(self.schedules.pop(key)['Target']['Input']))
+        return events
+
+
+def next_occurrence(time_of_day, after):
+    """
+    First datetime strictly after 'after' with the 'HH:MM' time of day
+    """
+    hours, minutes = map(int, time_of_day.split(':'))
+    occurrence = after.replace(hour=hours % 24, minute=minutes, second=0, microsecond=0)
+    if occurrence <= after:
+        occurrence += timedelta(days=1)
+    return occurrence
+
+
+def create_scheduler(offline_debug):
+    """
+    OneShotScheduler when SCHEDULER_ROLE_ARN is set, backed by the local stand in offline.
+    None otherwise, leaving updates to be chained through the CloudWatch rule
+    """
+    if not scheduler_role_arn:
+        return None
+    client = LocalSchedulerClient() if offline_debug else boto3.client('scheduler')
+    return OneShotScheduler(client, scheduler_role_arn)
+
+
+def _client_error(code, message, operation_name):
+    return ClientError({'Error': {'Code': code, 'Message': message}}, operation_name)
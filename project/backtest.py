@@ -0,0 +1,297 @@
+import logging
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+import pytz
+
+import main
+from project.api.octopus import uk_timezone
+from project.fleet import create_pool
+from project.history_store import parse_date
+
+logger = logging.getLogger(__name__)
+
+"""
+Replay stored history through charging strategies to see what they would have cost.
+
+Each day is planned on a simulated clock, midnight of that day, from an estimate of its energy built the way
+the Lambda builds it: the average consumption of the same weekday over the previous weeks and the average
+solar production of the previous days. Historic Met Office forecasts aren't kept, so the solar isn't biased.
+The chosen charge slots are then played against what the house actually used and the panels actually made.
+
+A strategy is any callable taking the same arguments as main.determine_optimal_charging_periods
+    (df_energy_insights, battery_remaining_capacity, battery_max_capacity, lowest_charge_threshold,
+     battery_charge_rate_hourly)
+and returning a boolean array, True for each half hour to charge from the grid in. It must be picklable,
+so a module level function or class, as days are planned in worker processes.
+"""
+
+# flow types summed into the house consumption and the solar production, see analyse_energy_usage
+consumption_flow_types = [0, 3, 5]
+solar_flow_types = [0, 1, 2]
+
+# history used for each day's estimate, as the Lambda uses for analyse_energy_usage and analyse_solar_production
+estimate_weeks = 4
+estimate_solar_days = 40
+
+# days planned by a worker at a time, enough to outweigh sending the data to the process
+days_per_task = int(os.environ.get("BACKTEST_DAYS_PER_TASK", 32))
+
+slots_per_day = 48
+
+
+class BacktestData:
+    """
+    Half hourly consumption, solar production (kwh) and Agile prices (pence) as days x 48 arrays.
+    Days may have gaps, where the history or prices weren't complete
+    """
+    def __init__(self, days, consumption, solar, prices):
+        self.days = list(days)
+        self.consumption = np.asarray(consumption, dtype=float).reshape(len(self.days), slots_per_day)
+        self.solar = np.asarray(solar, dtype=float).reshape(len(self.days), slots_per_day)
+        self.prices = np.asarray(prices, dtype=float).reshape(len(self.days), slots_per_day)
+        self.day_index = {day: index for index, day in enumerate(self.days)}
+
+    def __len__(self):
+        return len(self.days)
+
+    @classmethod
+    def from_history(cls, history_store, serial, rates, start_date, end_date):
+        """
+        Load the days from start_date up to end_date ('%Y-%m-%d', end exclusive) that have every half hour
+        in the history store and a price for each in rates, an AgileRates such as Octopus.get_historic_rates gives
+        """
+        e_types = sorted(set(consumption_flow_types) | set(solar_flow_types))
+        days, consumption, solar, prices = [], [], [], []
+        start = parse_date(start_date)
+        for offset in range((parse_date(end_date) - start).days):
+            day = start + timedelta(days=offset)
+            date = day.strftime('%Y-%m-%d')
+            data = history_store.load_energy_flows(serial, date, (day + timedelta(days=1)).strftime('%Y-%m-%d'),
+                                                   e_types)
+            day_prices = day_rates(rates, day)
+            if data is None or day_prices is None:
+                logger.info(f"Skipping {date}, its history or prices aren't complete")
+                continue
+            flows, _ = main.decode_energy_flows([data], e_types)
+            if flows.shape[1] != slots_per_day or np.isnan(flows).any():
+                logger.info(f"Skipping {date}, its history is missing half hours")
+                continue
+            days.append(date)
+            consumption.append(flows[0][:, [e_types.index(e_type) for e_type in consumption_flow_types]].sum(axis=1))
+            solar.append(flows[0][:, [e_types.index(e_type) for e_type in solar_flow_types]].sum(axis=1))
+            prices.append(day_prices)
+        return cls(days, consumption, solar, prices)
+
+    def estimate_energy(self, index):
+        """
+        Estimated energy drawn from the battery in each half hour of a day, from the history before it.
+        None when there is no earlier same weekday to base the consumption on
+        """
+        day = parse_date(self.days[index])
+        same_weekdays = self._indexes(day - timedelta(weeks=week) for week in range(1, estimate_weeks + 1))
+        previous_days = self._indexes(day - timedelta(days=days) for days in range(1, estimate_solar_days + 1))
+        if not same_weekdays:
+            return None
+        energy = self.consumption[same_weekdays].mean(axis=0)
+        if previous_days:
+            energy = energy - self.solar[previous_days].mean(axis=0)
+        return energy
+
+    def _indexes(self, days):
+        return [self.day_index[day] for day in (day.strftime('%Y-%m-%d') for day in days) if day in self.day_index]
+
+
+def day_rates(rates, day):
+    """
+    Price of each half hour of a UK day, or None if any is missing. History start times are UK local time,
+    the rates are UTC
+    """
+    prices = []
+    for slot in range(slots_per_day):
+        local = uk_timezone.localize(day + timedelta(minutes=30 * slot))
+        index = rates.slot_index(local.astimezone(pytz.utc).replace(tzinfo=None))
+        if index is None:
+            return None
+        prices.append(rates.results[index]['value_inc_vat'])
+    return prices
+
+
+def greedy_strategy(df_energy_insights, battery_remaining_capacity, battery_max_capacity, lowest_charge_threshold,
+                    battery_charge_rate_hourly):
+    return main.determine_optimal_charging_periods(df_energy_insights, battery_remaining_capacity,
+                                                   battery_max_capacity, lowest_charge_threshold,
+                                                   battery_charge_rate_hourly)['charge'].to_numpy(dtype=bool)
+
+
+def exact_strategy(df_energy_insights, battery_remaining_capacity, battery_max_capacity, lowest_charge_threshold,
+                   battery_charge_rate_hourly):
+    return main.determine_optimal_charging_periods(df_energy_insights, battery_remaining_capacity,
+                                                   battery_max_capacity, lowest_charge_threshold,
+                                                   battery_charge_rate_hourly,
+                                                   engine='exact')['charge'].to_numpy(dtype=bool)
+
+
+def no_charge_strategy(df_energy_insights, battery_remaining_capacity, battery_max_capacity, lowest_charge_threshold,
+                       battery_charge_rate_hourly):
+    return np.zeros(len(df_energy_insights), dtype=bool)
+
+
+class FixedWindowStrategy:
+    """
+    Charge in the same window every night, like a timed charge set on the inverter
+    """
+    def __init__(self, from_time='00:30', to_time='04:30'):
+        self.from_time = datetime.strptime(from_time, '%H:%M').time()
+        self.to_time = datetime.strptime(to_time, '%H:%M').time()
+
+    def __call__(self, df_energy_insights, battery_remaining_capacity, battery_max_capacity, lowest_charge_threshold,
+                 battery_charge_rate_hourly):
+        return np.array([self.from_time <= hours < self.to_time for hours in df_energy_insights['hours']], dtype=bool)
+
+
+default_strategies = {'greedy': greedy_strategy,
+                      'exact': exact_strategy,
+                      'fixed_window': FixedWindowStrategy(),
+                      'no_charge': no_charge_strategy}
+
+
+def simulate_day(charge, consumption, solar, prices, battery_remaining_capacity, battery_max_capacity,
+                 lowest_charge_threshold, battery_charge_rate_hourly):
+    """
+    Play a day's charge slots against what really happened. A charging slot takes up to half the hourly
+    charge rate from the grid, as much as fits in the battery. The house runs off the battery, solar beyond
+    a full battery is exported and anything the empty battery can't supply comes from the grid.
+
+    Returns a dict of the day's totals and the battery capacity at the end of the day
+    """
+    half_hour_charge = battery_charge_rate_hourly / 2
+    capacity = battery_remaining_capacity
+    cost = grid_charge_total = shortfall_total = export_total = 0.0
+    min_capacity = capacity
+    violations = 0
+    for i in range(len(prices)):
+        grid_charge = min(half_hour_charge, max(0.0, battery_max_capacity - capacity)) if charge[i] else 0.0
+        capacity += grid_charge - (consumption[i] - solar[i])
+        shortfall = export = 0.0
+        if capacity > battery_max_capacity:
+            export, capacity = capacity - battery_max_capacity, battery_max_capacity
+        elif capacity < 0:
+            shortfall, capacity = -capacity, 0.0
+        cost += prices[i] * (grid_charge + shortfall)
+        grid_charge_total += grid_charge
+        shortfall_total += shortfall
+        export_total += export
+        min_capacity = min(min_capacity, capacity)
+        violations += capacity < lowest_charge_threshold
+    return {'cost_pence': cost,
+            'grid_charge_kwh': grid_charge_total,
+            'grid_import_kwh': grid_charge_total + shortfall_total,
+            'export_kwh': export_total,
+            'min_battery_kwh': min_capacity,
+            'threshold_violations': violations,
+            'end_battery_kwh': capacity}
+
+
+def plan_day(strategy, energy, prices, day, battery_remaining_capacity, battery_max_capacity,
+             lowest_charge_threshold, battery_charge_rate_hourly):
+    """
+    Run a strategy for one day on its simulated clock, in place of datetime.now and get_time_offsets
+    """
+    valid_from = pd.Timestamp(day) + pd.to_timedelta(np.arange(slots_per_day) * 30, unit='min')
+    df_energy_insights = pd.DataFrame({'timer': np.arange(slots_per_day) * 0.5,
+                                       'hours': valid_from.time,
+                                       'energy': energy,
+                                       'value_inc_vat': prices,
+                                       'valid_from_giv': valid_from,
+                                       'valid_to_giv': valid_from + pd.Timedelta(minutes=30)})
+    charge = np.asarray(strategy(df_energy_insights, battery_remaining_capacity, battery_max_capacity,
+                                 lowest_charge_threshold, battery_charge_rate_hourly), dtype=bool)
+    if len(charge) != slots_per_day:
+        raise ValueError(f"Strategy returned {len(charge)} slots for {day}, expected {slots_per_day}")
+    return charge
+
+
+def run_days(name, strategy, days, energy, consumption, solar, prices, battery, carry_over=False):
+    """
+    Plan and score a run of days with one strategy. With carry_over each day starts with the battery the
+    day before ended with, otherwise every day starts from the battery spec's remaining capacity
+    """
+    remaining = battery['battery_kwatt_hours_remaining']
+    rows = []
+    for day, day_energy, day_consumption, day_solar, day_prices in zip(days, energy, consumption, solar, prices):
+        charge = plan_day(strategy, day_energy, day_prices, day, remaining, battery['battery_max_capacity'],
+                          battery['lowest_charge_threshold'], battery['battery_charge_rate_hourly'])
+        row = simulate_day(charge, day_consumption, day_solar, day_prices, remaining,
+                           battery['battery_max_capacity'], battery['lowest_charge_threshold'],
+                           battery['battery_charge_rate_hourly'])
+        row.update(strategy=name, date=day, slots_charged=int(charge.sum()), start_battery_kwh=remaining)
+        rows.append(row)
+        if carry_over:
+            remaining = row['end_battery_kwh']
+    return rows
+
+
+def run_backtest(data, battery_spec, strategies=None, lowest_charge_threshold=main.lowest_charge_threshold,
+                 carry_over=False, max_workers=None, perfect_estimate=False, start_battery_kwh=None):
+    """
+    Backtest each strategy over the days in data, returning a frame with a row per strategy and day.
+
+    battery_spec has the keys of GivEnergy's system_specs["battery_spec"]. Each day starts with start_battery_kwh,
+    or the spec's battery_kwatt_hours_remaining when it has one, which only a calculate run fills in, or else
+    the lowest charge threshold. Days are independent and planned in parallel. carry_over plays each
+    strategy's days in order instead, so only the strategies run in parallel.
+    perfect_estimate plans with the day's real energy instead of the estimate from the history before it.
+    Days without an earlier same weekday to estimate from are left out
+    """
+    strategies = strategies or default_strategies
+    if start_battery_kwh is None:
+        start_battery_kwh = battery_spec.get("battery_kwatt_hours_remaining", lowest_charge_threshold)
+    battery = {'battery_kwatt_hours_remaining': start_battery_kwh,
+               'battery_max_capacity': battery_spec["watt_hour"] / 1000,
+               'lowest_charge_threshold': lowest_charge_threshold,
+               'battery_charge_rate_hourly': battery_spec["max_charge_rate_watts"] / 1000}
+
+    indexes, energy = [], []
+    for index in range(len(data)):
+        day_energy = data.consumption[index] - data.solar[index] if perfect_estimate else data.estimate_energy(index)
+        if day_energy is not None:
+            indexes.append(index)
+            energy.append(day_energy)
+    energy = np.array(energy).reshape(len(indexes), slots_per_day)
+    chunk = len(indexes) if carry_over else days_per_task
+
+    rows = []
+    with create_pool(max_workers) as pool:
+        futures = [pool.submit(run_days, name, strategy, [data.days[index] for index in indexes[start:start + chunk]],
+                               energy[start:start + chunk], data.consumption[indexes[start:start + chunk]],
+                               data.solar[indexes[start:start + chunk]], data.prices[indexes[start:start + chunk]],
+                               battery, carry_over)
+                   for name, strategy in strategies.items()
+                   for start in range(0, len(indexes), chunk or 1)]
+        for future in futures:
+            rows.extend(future.result())
+    return pd.DataFrame(rows, columns=['strategy', 'date', 'cost_pence', 'grid_charge_kwh', 'grid_import_kwh',
+                                       'export_kwh', 'slots_charged', 'start_battery_kwh', 'min_battery_kwh',
+                                       'end_battery_kwh', 'threshold_violations'])
+
+
+def summarise_backtest(df_days, baseline=None):
+    """
+    Totals per strategy from run_backtest's rows. With a baseline strategy name, also the saving against it
+    """
+    df_summary = df_days.groupby('strategy', sort=False).agg(days=('date', 'count'),
+                                                              cost_pence=('cost_pence', 'sum'),
+                                                              grid_import_kwh=('grid_import_kwh', 'sum'),
+                                                              grid_charge_kwh=('grid_charge_kwh', 'sum'),
+                                                              export_kwh=('export_kwh', 'sum'),
+                                                              min_battery_kwh=('min_battery_kwh', 'min'),
+                                                              threshold_violations=('threshold_violations', 'sum'),
+                                                              violation_days=('threshold_violations',
+                                                                              lambda violations: (violations > 0).sum()))
+    df_summary['cost_per_day_pence'] = df_summary['cost_pence'] / df_summary['days']
+    if baseline is not None:
+        df_summary['saving_pence'] = df_summary.loc[baseline, 'cost_pence'] - df_summary['cost_pence']
+    return df_summary
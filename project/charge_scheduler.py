@@ -0,0 +1,129 @@
+import logging
+import math
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Penalty per kwh the battery drops below the threshold. Large enough that any schedule that holds the
+# threshold is always cheaper than one that doesn't, but still lets infeasible days find the least-bad plan
+shortfall_penalty = 1e6
+
+# First slot the threshold is checked from, matching the greedy engine. The first hour can't be changed in time
+first_checked_slot = 2
+
+
+def solve_charge_schedule(energy, prices, battery_remaining_capacity: float, battery_max_capacity: float,
+                          lowest_charge_threshold: float, battery_charge_rate_hourly: float,
+                          max_charge_windows: int = None, soc_step: float = 0.05) -> np.ndarray:
+    """
+    Find the cheapest set of half hour slots to charge in, using dynamic programming over a
+    discretised battery state of charge.
+
+    The battery model matches main.simulate_running_battery_capacity, each charged slot adds half the
+    hourly charge rate, charge above a half hour from full is lost and the battery never drops below zero.
+    Paths are grouped into soc_step kwh wide state of charge buckets and only the cheapest path into each
+    bucket is kept, but every path carries its exact state of charge so the threshold is checked exactly.
+
+    The state is (state of charge, charge windows used, was the previous slot charging), so an optional
+    max_charge_windows caps the number of distinct consecutive charge windows in the schedule.
+    If no schedule can hold the threshold, the one with the smallest total shortfall is returned.
+
+    Returns a boolean numpy array, True for each slot that should charge
+    """
+    energy = np.asarray(energy, dtype=float)
+    prices = np.asarray(prices, dtype=float)
+    slots = len(energy)
+    if slots == 0:
+        return np.zeros(0, dtype=bool)
+
+    half_hour_charge = battery_charge_rate_hourly / 2
+    full_cap = battery_max_capacity - half_hour_charge
+    soc_max = max(battery_max_capacity, battery_remaining_capacity) + half_hour_charge
+    states = int(math.floor(soc_max / soc_step)) + 1
+
+    windows = max_charge_windows + 1 if max_charge_windows is not None else 1
+    shape = (windows, 2, states)
+    size = windows * states * 2
+    window_used, was_charging, _ = np.unravel_index(np.arange(size), shape)
+
+    cost = np.full(size, np.inf)
+    running_soc = np.zeros(size)
+    total_shortfall = np.zeros(size)
+    back_pointers = []
+
+    for i in range(slots):
+        candidate_targets = []
+        candidate_costs = []
+        candidate_running = []
+        candidate_shortfall = []
+        candidate_sources = []
+        for charge in (0, 1):
+            charged_energy = energy[i] - half_hour_charge * charge
+            if i == 0:
+                running = np.array([battery_remaining_capacity - charged_energy])
+                sources = np.array([0])
+                base_cost = np.array([0.0])
+                base_shortfall = np.array([0.0])
+                source_windows, source_charging = np.array([0]), np.array([0])
+            else:
+                sources = np.flatnonzero(np.isfinite(cost))
+                base_cost = cost[sources]
+                base_shortfall = total_shortfall[sources]
+                running = np.minimum(running_soc[sources], full_cap) - charged_energy
+                source_windows, source_charging = window_used[sources], was_charging[sources]
+            running = np.maximum(running, 0)
+            target_soc = np.minimum(np.floor(running / soc_step), states - 1).astype(int)
+
+            target_windows = source_windows
+            if max_charge_windows is not None and charge:
+                target_windows = source_windows + (source_charging == 0)
+                allowed = target_windows < windows
+                sources, base_cost, running = sources[allowed], base_cost[allowed], running[allowed]
+                base_shortfall = base_shortfall[allowed]
+                target_soc, target_windows = target_soc[allowed], target_windows[allowed]
+
+            step_cost = base_cost + prices[i] * charge
+            step_shortfall = base_shortfall
+            if i >= first_checked_slot:
+                step_shortfall = step_shortfall + np.maximum(lowest_charge_threshold - running, 0)
+                step_cost = step_cost + np.maximum(lowest_charge_threshold - running, 0) * shortfall_penalty
+
+            candidate_targets.append(np.ravel_multi_index((target_windows, np.full_like(target_soc, charge),
+                                                           target_soc), shape))
+            candidate_costs.append(step_cost)
+            candidate_running.append(running)
+            candidate_shortfall.append(step_shortfall)
+            candidate_sources.append(sources)
+
+        targets = np.concatenate(candidate_targets)
+        costs = np.concatenate(candidate_costs)
+        running = np.concatenate(candidate_running)
+        shortfall = np.concatenate(candidate_shortfall)
+        sources = np.concatenate(candidate_sources)
+
+        # keep the cheapest way into each target state, on a tie keep the one with the most charge left
+        order = np.lexsort((-running, costs, targets))
+        targets, costs, running, sources = targets[order], costs[order], running[order], sources[order]
+        shortfall = shortfall[order]
+        first = np.ones(len(targets), dtype=bool)
+        first[1:] = targets[1:] != targets[:-1]
+
+        cost = np.full(size, np.inf)
+        cost[targets[first]] = costs[first]
+        running_soc[targets[first]] = running[first]
+        total_shortfall[targets[first]] = shortfall[first]
+        pointer = np.full(size, -1)
+        pointer[targets[first]] = sources[first]
+        back_pointers.append(pointer)
+
+    # walk back from the cheapest final state, the charge flag of each slot is part of its state
+    state = int(np.argmin(cost))
+    if total_shortfall[state] > 0:
+        logger.warning(f"No charge schedule keeps the battery above the lowest charge threshold, "
+                       f"total shortfall {total_shortfall[state]:.2f} kwh")
+    charge_slots = np.zeros(slots, dtype=bool)
+    for i in range(slots - 1, -1, -1):
+        charge_slots[i] = was_charging[state] == 1
+        state = back_pointers[i][state]
+    return charge_slots
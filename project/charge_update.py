@@ -0,0 +1,227 @@
+import logging
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from project import metrics
+from project.api.givenergy import GivEnergy
+
+logger = logging.getLogger(__name__)
+
+"""
+Setting a charge window on the inverter and scheduling the next one in CloudWatch.
+The update command only needs these, so this module keeps away from pandas and numpy to start up quickly.
+"""
+
+# inverter settings holding the first AC charge window
+charge_start_setting = 64
+charge_end_setting = 65
+
+# the inverter's AC charge slots are found by their setting names, 'AC Charge 2 Start Time' and so on
+charge_slot_setting_name = re.compile(r'AC Charge (\d+) (Start|End) Time')
+
+# most AC charge slots to program, windows beyond them are chained through CloudWatch. 1 uses the first slot only
+max_charge_slots = int(os.environ.get("MAX_CHARGE_SLOTS", 10))
+
+# written to both times of a slot that has no window, a slot that starts and ends together never charges
+unused_slot_time = '00:00'
+
+# a written setting is first read back after this many seconds, the wait doubles after each read up to the max
+setting_poll_initial_seconds = float(os.environ.get("SETTING_POLL_INITIAL_SECONDS", 0.25))
+setting_poll_max_seconds = float(os.environ.get("SETTING_POLL_MAX_SECONDS", 2))
+
+# how long to keep reading settings back before reporting them as unconfirmed
+setting_verify_deadline_seconds = float(os.environ.get("SETTING_VERIFY_DEADLINE_SECONDS", 8))
+
+# times a setting is written when the inverter reads back a different value
+max_setting_writes = 3
+
+
+def program_charge_windows(giv_energy, offline_debug, windows, cloudwatch=None, aws_fields=None, scheduler=None):
+    """
+    Write as many of the day's charge windows as the inverter has AC charge slots in one write and verify,
+    clearing the slots left over. Windows that don't fit are chained through CloudWatch, an update event at the
+    end of the last programmed window programs them next. With a scheduler, see project.api.scheduler, an update
+    for each later group of windows is scheduled at once instead. With neither they are only returned.
+
+    windows are the records of prepare_time_windows_for_givenergy, in time order.
+    Returns the write_and_verify_settings result and the windows left for a later update
+    """
+    if giv_energy is None:
+        giv_energy = GivEnergy(offline_debug, os.environ.get("GE_API_KEY"))
+    windows = list(windows or [])
+    run_metrics = metrics.current()
+
+    with run_metrics.stage('inverter_update'):
+        charge_slots = get_charge_slots(giv_energy)
+        settings = {}
+        for (start_setting, end_setting), window in zip(charge_slots, windows + [None] * len(charge_slots)):
+            settings[start_setting] = window['from_hours_giv'] if window else unused_slot_time
+            settings[end_setting] = window['too_hours_giv'] if window else unused_slot_time
+        deadline_seconds = 0 if offline_debug else setting_verify_deadline_seconds
+        results = write_and_verify_settings(giv_energy, settings, deadline_seconds=deadline_seconds)
+    programmed = windows[:len(charge_slots)]
+    run_metrics.put('charge_slots_programmed', len(programmed))
+    logger.info(f"Inverter charge slots set to "
+                f"{[(window['from_hours_giv'], window['too_hours_giv']) for window in programmed]}")
+
+    remaining = windows[len(charge_slots):]
+    if scheduler is not None:
+        with run_metrics.stage('schedule_update'):
+            scheduler.schedule_windows(windows, len(charge_slots), aws_fields)
+            if cloudwatch is not None:
+                # a rule left enabled from chaining would program its stale windows again every day
+                disable_cloud_watch(cloudwatch, aws_fields)
+    elif cloudwatch is not None:
+        # the chain starts from the last programmed window, or is disabled when nothing is left over
+        with run_metrics.stage('cloudwatch_update'):
+            update_cloud_watch(cloudwatch, windows[len(charge_slots) - 1:], aws_fields)
+    elif remaining:
+        logger.warning(f"{len(remaining)} charge windows don't fit in the inverter's slots and aren't scheduled")
+    run_metrics.put('windows_chained', len(remaining))
+    return results, remaining
+
+
+def get_charge_slots(giv_energy):
+    """
+    (start time setting, end time setting) of each AC charge slot the inverter has, in slot order, up to
+    max_charge_slots. Only the first slot is used if the inverter's settings can't be listed
+    """
+    try:
+        inverter_settings = giv_energy.get_inverter_settings()['data']
+    except Exception as error:
+        logger.warning(f"Couldn't list the inverter settings, using the first charge slot only: {error!r}")
+        return [(charge_start_setting, charge_end_setting)]
+
+    slots = {}
+    for setting in inverter_settings:
+        match = charge_slot_setting_name.fullmatch(setting['name'])
+        if match:
+            slots.setdefault(int(match.group(1)), {})[match.group(2)] = setting['id']
+    charge_slots = [(slot['Start'], slot['End']) for _, slot in sorted(slots.items()) if len(slot) == 2]
+    return charge_slots[:max_charge_slots] or [(charge_start_setting, charge_end_setting)]
+
+
+def update_inverter_charge_time(giv_energy, offline_debug, from_time, to_time):
+    """
+    Send commands to GivEnergy inverter to charge battery from mains.
+    Returns the write_and_verify_settings result of the start and end time settings
+    """
+    if giv_energy is None:
+        giv_energy = GivEnergy(offline_debug, os.environ.get("GE_API_KEY"))
+
+    # the offline example read back is always an inverter timeout, so there is nothing to wait for
+    deadline_seconds = 0 if offline_debug else setting_verify_deadline_seconds
+    results = write_and_verify_settings(giv_energy, {charge_start_setting: from_time, charge_end_setting: to_time},
+                                        deadline_seconds=deadline_seconds)
+    if all(result['confirmed'] for result in results.values()):
+        logger.info(f"Inverter set to charge from {from_time} too {to_time}")
+    else:
+        logger.warning(f"Inverter charge from {from_time} too {to_time} not confirmed: {results}")
+    return results
+
+
+def set_and_check_setting(giv_energy, setting, value):
+    """
+    Write one setting and read it back until it is confirmed, see write_and_verify_settings
+    """
+    return write_and_verify_settings(giv_energy, {setting: value})[setting]
+
+
+def write_and_verify_settings(giv_energy, settings, deadline_seconds=None, initial_delay_seconds=None,
+                              max_delay_seconds=None, sleep=time.sleep, clock=time.monotonic):
+    """
+    Write every setting at once, then read back the ones that aren't confirmed yet until they all are or the
+    deadline passes. The first read back is after initial_delay_seconds, each wait after that doubles up to
+    max_delay_seconds. A setting whose write fails or that reads back with another value is written again on the
+    next poll, up to max_setting_writes, a read that fails (the inverter often times out) is just tried again.
+
+    settings is a dict of setting id to value. Returns a dict keyed by setting id of
+    {'value', 'confirmed', 'writes', 'reads', 'read_value', 'error'}
+    """
+    deadline_seconds = setting_verify_deadline_seconds if deadline_seconds is None else deadline_seconds
+    delay = setting_poll_initial_seconds if initial_delay_seconds is None else initial_delay_seconds
+    max_delay_seconds = setting_poll_max_seconds if max_delay_seconds is None else max_delay_seconds
+    deadline = clock() + deadline_seconds
+    results = {setting: {'value': value, 'confirmed': False, 'writes': 0, 'reads': 0, 'read_value': None,
+                         'error': None}
+               for setting, value in settings.items()}
+
+    with ThreadPoolExecutor(max_workers=max(1, len(settings))) as executor:
+        failed = _write_settings(executor, giv_energy, results, list(settings))
+        pending = list(settings)
+        while pending:
+            sleep(max(0.0, min(delay, deadline - clock())))
+            # a write that failed is tried again rather than read back, until it is out of writes
+            rewrite = [setting for setting in failed if results[setting]['writes'] < max_setting_writes]
+            reads = {setting: executor.submit(giv_energy.read_inverter_setting, setting)
+                     for setting in pending if setting not in rewrite}
+            for setting, future in reads.items():
+                result = results[setting]
+                result['reads'] += 1
+                try:
+                    data = (future.result() or {}).get('data') or {}
+                except Exception as error:
+                    result['error'] = repr(error)
+                    continue
+                if data.get('success') is False:
+                    result['error'] = data.get('message')
+                    continue
+                result['read_value'] = data.get('value')
+                if str(data.get('value')) == str(result['value']):
+                    result['confirmed'], result['error'] = True, None
+                elif result['writes'] < max_setting_writes:
+                    rewrite.append(setting)
+                else:
+                    result['error'] = f"read back {data.get('value')!r} after {result['writes']} writes"
+
+            pending = [setting for setting in pending if not results[setting]['confirmed']]
+            failed = _write_settings(executor, giv_energy, results, rewrite)
+            if clock() >= deadline:
+                break
+            delay = min(delay * 2, max_delay_seconds)
+
+    unconfirmed = [setting for setting, result in results.items() if not result['confirmed']]
+    metrics.current().add('settings_unconfirmed', len(unconfirmed))
+    for setting in unconfirmed:
+        logger.warning(f"Inverter setting {setting} not confirmed as {results[setting]['value']}: "
+                       f"{results[setting]['error']}")
+    return results
+
+
+def _write_settings(executor, giv_energy, results, settings):
+    """
+    Write the settings in parallel, returning the ones whose write raised an error
+    """
+    writes = {setting: executor.submit(giv_energy.update_inverter_setting, setting, results[setting]['value'])
+              for setting in settings}
+    failed = []
+    for setting, future in writes.items():
+        results[setting]['writes'] += 1
+        try:
+            future.result()
+        except Exception as error:
+            results[setting]['error'] = repr(error)
+            failed.append(setting)
+    return failed
+
+
+def update_cloud_watch(cloudwatch, cloud_watch_times, aws_fields):
+    if cloud_watch_times and len(cloud_watch_times) > 1:
+        last_time = cloud_watch_times[0]['too_hours_aws']
+        cloud_watch_times = cloud_watch_times[1:]
+        event_json = {'msg': 'update',
+                      'data': cloud_watch_times}
+        cloudwatch.create_event(last_time, aws_fields, event_json)
+    else:
+        disable_cloud_watch(cloudwatch, aws_fields)
+
+    return cloud_watch_times
+
+
+def disable_cloud_watch(cloudwatch, aws_fields):
+    event_json = {'msg': 'update',
+                  'data': ''}
+    cloudwatch.send_update('cron(0 1 1 1 ? 2050)', 'DISABLED', aws_fields, event_json)
+    logger.info(f"CloudWatch cron schedule DISABLED")
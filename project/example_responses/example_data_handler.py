@@ -1,18 +1,25 @@
 import json
 import os
 
-import pandas as pd
+
+def get_file_path(file_name):
+    """
+    Full path of an example response file
+    """
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), file_name)
 
 
 def get_data(file_name):
     """
     A function that corrects the file path, adds in the file name and returns a json file as a dict
     """
-    file_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), file_name)
+    file_path = get_file_path(file_name)
     if 'json' in file_name:
         with open(file_path) as file:
             data = json.load(file)
     elif 'csv' in file_name:
+        # only the csv examples need pandas, the GivEnergy client imports this module on the update path
+        import pandas as pd
         data = pd.read_csv(file_path)
     return data
 
@@ -45,6 +52,19 @@ class OctopusData:
         return get_data('AGILE-18-02-21.json')
 
 
+class ForecastData:
+    location_data_file = 'forecast_location_data.json'
+    forecast_location_file = 'lancaster_forecast.json'
+
+    @staticmethod
+    def location_data():
+        return get_data(ForecastData.location_data_file)
+
+    @staticmethod
+    def forecast_location():
+        return get_data(ForecastData.forecast_location_file)
+
+
 class CalculatedData:
     @staticmethod
     def read_energy_data():
@@ -0,0 +1,162 @@
+import logging
+import os
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+
+import main
+from project.api.forecast import Forecast
+from project.api.givenergy import GivEnergy
+from project.api.octopus import Octopus, default_region
+from project.history_store import EnergyHistoryStore
+from project.secrets import get_secret_or_env
+
+logger = logging.getLogger(__name__)
+
+"""
+Plan the charge windows of many inverters in one invocation.
+The Agile prices of each tariff region and the forecast of each Met Office site are fetched once and shared,
+then each site is planned in its own process.
+
+A site config is a dict;
+    site_id                 name reported back with the result, defaults to the site's position in the list
+    ge_api_key              GivEnergy API key, required
+    inverter_serial_number  skips looking the serial up when given
+    tariff_region           Agile region letter, defaults to OCTOPUS_REGION or G
+    forecast_location       Met Office site id, defaults to main.forecast_location
+    lowest_charge_threshold kwh to keep in the battery, defaults to main.lowest_charge_threshold
+    engine                  'greedy' or 'exact', defaults to main.charge_engine
+    max_charge_windows      cap on charge windows for the exact engine, defaults to main.charge_engine_max_windows
+"""
+
+# sites planned at once, defaults to the number of CPUs
+fleet_max_workers = int(os.environ.get("FLEET_MAX_WORKERS", 0)) or None
+
+
+def plan_fleet(sites, offline_debug=False, apply=False, max_workers=None):
+    """
+    Plan every site, returning one result per site in the order given and counts of the successes and failures.
+    A site that fails, or whose shared tariff or forecast couldn't be fetched, is reported as an error
+    without stopping the others. apply=True also programs each site's charge windows into its inverter's slots
+    """
+    time_offsets = main.get_time_offsets()
+    sites = [dict(site, site_id=site.get('site_id', str(index))) for index, site in enumerate(sites)]
+    agile_data, forecasts = fetch_shared_inputs(sites, offline_debug, time_offsets)
+    # the store is restored from its backup once here, the workers open the same file without a backup
+    # and it is backed up once they have all finished
+    history_store = None if offline_debug else EnergyHistoryStore.from_env()
+    history_path = history_store.path if history_store is not None else None
+
+    results = [None] * len(sites)
+    with create_pool(max_workers or fleet_max_workers) as pool:
+        futures = {}
+        for index, site in enumerate(sites):
+            error = _shared_input_error(site, agile_data, forecasts)
+            if error is not None:
+                results[index] = {'site_id': site['site_id'], 'status': 'error', 'error': error}
+                continue
+            futures[index] = pool.submit(plan_site, site, forecasts[_location(site)], agile_data[_region(site)],
+                                         time_offsets, offline_debug, apply, history_path)
+        for index, future in futures.items():
+            try:
+                results[index] = future.result()
+            except Exception as error:
+                logger.error(f"Planning site {sites[index]['site_id']} failed: {error!r}")
+                results[index] = {'site_id': sites[index]['site_id'], 'status': 'error', 'error': repr(error)}
+
+    if history_store is not None:
+        history_store.backup_store()
+    succeeded = sum(result['status'] == 'ok' for result in results)
+    return {'sites': results, 'succeeded': succeeded, 'failed': len(results) - succeeded}
+
+
+def fetch_shared_inputs(sites, offline_debug, time_offsets):
+    """
+    Fetch the Agile prices for each region and the forecast for each location the sites use, at the same time.
+    Returns two dicts keyed by region and by location, holding the frame or the exception that was raised
+    """
+    octopus_api_key = get_secret_or_env("OCTOPUS_API_KEY")
+    forecast = Forecast(offline_debug, get_secret_or_env("DATAPOINT_API_KEY"))
+    regions = sorted({_region(site) for site in sites})
+    locations = sorted({_location(site) for site in sites})
+
+    with ThreadPoolExecutor(max_workers=max(1, min(8, len(regions) + len(locations)))) as executor:
+        agile_futures = {region: executor.submit(main.get_agile_data, Octopus(offline_debug, octopus_api_key, region),
+                                                 time_offsets)
+                         for region in regions}
+        forecast_futures = {location: executor.submit(main.analyse_forecast, forecast, location)
+                            for location in locations}
+        return ({region: _result_or_error(future) for region, future in agile_futures.items()},
+                {location: _result_or_error(future) for location, future in forecast_futures.items()})
+
+
+def plan_site(site, df_forecast, df_agile_data, time_offsets, offline_debug=False, apply=False, history_path=None):
+    """
+    Plan one site from the shared forecast and prices. Runs in a worker process, so everything it is given
+    and returns is picklable. history_path is the energy history store plan_fleet restored, if there is one
+    """
+    if not site.get('ge_api_key'):
+        raise ValueError("site config has no ge_api_key")
+    giv_energy = GivEnergy(offline_debug, site['ge_api_key'], site.get('inverter_serial_number'))
+    history_store = EnergyHistoryStore(history_path) if history_path else None
+
+    forecast_future = Future()
+    forecast_future.set_result(df_forecast)
+    df_energy_result, giv_energy = main.calculate_battery_depletion_time(giv_energy, None, time_offsets,
+                                                                         history_store, forecast_future)
+    df_energy_insights, df_windows = main.plan_charging(
+        df_energy_result, df_agile_data, giv_energy.system_specs["battery_spec"], time_offsets,
+        threshold=site.get('lowest_charge_threshold', main.lowest_charge_threshold),
+        engine=site.get('engine', main.charge_engine),
+        max_charge_windows=site.get('max_charge_windows', main.charge_engine_max_windows))
+
+    charge_times = []
+    if len(df_windows.index) > 0:
+        charge_times = df_windows[['from_hours_giv', 'too_hours_giv', 'from_hours_aws', 'too_hours_aws']] \
+            .to_dict('records')
+        if apply:
+            main.program_charge_windows(giv_energy, offline_debug, charge_times)
+
+    half_hour_charge = giv_energy.system_specs["battery_spec"]["max_charge_rate_watts"] / 1000 / 2
+    df_charged = df_energy_insights.iloc[:main.execution_horizon_slots]
+    df_charged = df_charged[df_charged['charge'] == True]
+    return {'site_id': site['site_id'],
+            'status': 'ok',
+            'inverter_serial_number': giv_energy.inverter_serial_number,
+            'charge_times': charge_times,
+            'slots_charged': len(df_charged.index),
+            'charge_cost_pence': round(float(df_charged['value_inc_vat'].sum() * half_hour_charge), 2)}
+
+
+def create_pool(max_workers):
+    """
+    Process pool for CPU bound work, or a thread pool where processes can't be created
+    """
+    # Lambda has no /dev/shm, so the process pool's queues can't be created there
+    try:
+        return ProcessPoolExecutor(max_workers=max_workers)
+    except (OSError, NotImplementedError) as error:
+        logger.warning(f"No process pool available, planning sites on threads: {error}")
+        return ThreadPoolExecutor(max_workers=max_workers)
+
+
+def _region(site):
+    return site.get('tariff_region') or default_region
+
+
+def _location(site):
+    return str(site.get('forecast_location') or main.forecast_location)
+
+
+def _result_or_error(future):
+    try:
+        return future.result()
+    except Exception as error:
+        logger.error(f"Fetching shared input failed: {error!r}")
+        return error
+
+
+def _shared_input_error(site, agile_data, forecasts):
+    if isinstance(agile_data[_region(site)], Exception):
+        return f"Agile prices for region {_region(site)}: {agile_data[_region(site)]!r}"
+    if isinstance(forecasts[_location(site)], Exception):
+        return f"Forecast for location {_location(site)}: {forecasts[_location(site)]!r}"
+    return None
@@ -0,0 +1,169 @@
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+
+import boto3
+
+logger = logging.getLogger(__name__)
+
+"""
+Local store of GivEnergy energy-flows half hours, so each run only downloads the days it hasn't seen before.
+Lambda keeps /tmp between warm invocations, a backup such as S3 can carry the store between cold starts.
+"""
+
+
+class S3HistoryBackup:
+    def __init__(self, bucket, key='energy_history.sqlite'):
+        self.bucket = bucket
+        self.key = key
+        self.s3_client = boto3.client('s3')
+
+    def download(self, path):
+        try:
+            self.s3_client.download_file(self.bucket, self.key, path)
+            return True
+        except Exception as error:
+            logger.info(f"No energy history backup downloaded from s3://{self.bucket}/{self.key}: {error}")
+            return False
+
+    def upload(self, path):
+        self.s3_client.upload_file(path, self.bucket, self.key)
+
+
+class LocalHistoryBackup:
+    """
+    Stand in for S3HistoryBackup that copies the store to another local folder
+    """
+    def __init__(self, directory, key='energy_history.sqlite'):
+        self.path = os.path.join(directory, key)
+
+    def download(self, path):
+        if not os.path.exists(self.path):
+            return False
+        shutil.copyfile(self.path, path)
+        return True
+
+    def upload(self, path):
+        shutil.copyfile(path, self.path)
+
+
+class EnergyHistoryStore:
+    def __init__(self, path=None, backup=None):
+        self.path = path or os.environ.get("HISTORY_STORE_PATH", "/tmp/energy_history.sqlite")
+        self.backup = backup
+        if self.backup is not None and not os.path.exists(self.path):
+            self.backup.download(self.path)
+        # consumption and solar history are read from separate threads, they share the connection under the lock
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS energy_flows (
+                                       serial TEXT NOT NULL,
+                                       date TEXT NOT NULL,
+                                       slot INTEGER NOT NULL,
+                                       flow_type INTEGER NOT NULL,
+                                       start_time TEXT NOT NULL,
+                                       end_time TEXT NOT NULL,
+                                       value REAL NOT NULL,
+                                       PRIMARY KEY (serial, date, slot, flow_type))""")
+
+    @classmethod
+    def from_env(cls):
+        """
+        Create the store from HISTORY_STORE_PATH, backed up to HISTORY_STORE_BUCKET on S3 when it is set
+        """
+        bucket = os.environ.get("HISTORY_STORE_BUCKET")
+        return cls(backup=S3HistoryBackup(bucket) if bucket else None)
+
+    def save_energy_flows(self, serial, data, now=None):
+        """
+        Save the half hours from an energy-flows response 'data' dict, skipping any that haven't finished yet
+        """
+        now = (now or datetime.now()).strftime('%Y-%m-%d %H:%M')
+        rows = []
+        for half_hour in data.values():
+            if half_hour['end_time'] > now:
+                continue
+            date, slot = split_start_time(half_hour['start_time'])
+            for flow_type, value in half_hour['data'].items():
+                rows.append((serial, date, slot, int(flow_type), half_hour['start_time'], half_hour['end_time'],
+                             value))
+        with self.lock, self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO energy_flows VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        return len(rows)
+
+    def missing_dates(self, serial, date_ranges, e_types):
+        """
+        Dates that don't have every half hour and flow type needed by the date ranges,
+        each range needs its whole days plus the first half hour of its end_date
+        """
+        needed = {}
+        for dates in date_ranges:
+            start, end = parse_date(dates['start_date']), parse_date(dates['end_date'])
+            for day in range((end - start).days):
+                needed[(start + timedelta(days=day)).strftime('%Y-%m-%d')] = 48
+            needed.setdefault(dates['end_date'], 1)
+        if not needed:
+            return []
+
+        counts = self._slot_counts(serial, needed.keys(), e_types)
+        return sorted(date for date, slots in needed.items()
+                      if sum(1 for slot in range(slots) if counts.get((date, slot), 0) == len(e_types)) < slots)
+
+    def load_energy_flows(self, serial, start_date, end_date, e_types):
+        """
+        Rebuild an energy-flows response 'data' dict for the date range, or None if any half hour is missing
+        """
+        start = parse_date(start_date)
+        slots = (parse_date(end_date) - start).days * 48 + 1
+        with self.lock:
+            rows = self.connection.execute(
+                f"""SELECT date, slot, flow_type, start_time, end_time, value FROM energy_flows
+                    WHERE serial = ? AND date BETWEEN ? AND ? AND flow_type IN ({",".join("?" * len(e_types))})""",
+                (serial, start_date, end_date, *[int(e_type) for e_type in e_types])).fetchall()
+
+        half_hours = {}
+        for date, slot, flow_type, start_time, end_time, value in rows:
+            half_hour = half_hours.setdefault((date, slot), {'start_time': start_time, 'end_time': end_time,
+                                                             'values': {}})
+            half_hour['values'][flow_type] = value
+
+        data = {}
+        for i in range(slots):
+            half_hour = half_hours.get(split_start_time((start + timedelta(minutes=30 * i)).strftime('%Y-%m-%d %H:%M')))
+            if half_hour is None or len(half_hour['values']) < len(e_types):
+                return None
+            data[str(i)] = {'start_time': half_hour['start_time'],
+                            'end_time': half_hour['end_time'],
+                            'data': {str(e_type): half_hour['values'][int(e_type)] for e_type in e_types}}
+        return data
+
+    def backup_store(self):
+        if self.backup is not None:
+            with self.lock:
+                self.backup.upload(self.path)
+
+    def _slot_counts(self, serial, dates, e_types):
+        dates = list(dates)
+        with self.lock:
+            rows = self.connection.execute(
+                f"""SELECT date, slot, COUNT(*) FROM energy_flows
+                    WHERE serial = ? AND date IN ({",".join("?" * len(dates))})
+                    AND flow_type IN ({",".join("?" * len(e_types))})
+                    GROUP BY date, slot""",
+                (serial, *dates, *[int(e_type) for e_type in e_types])).fetchall()
+        return {(date, slot): count for date, slot, count in rows}
+
+
+def split_start_time(start_time):
+    """
+    Split a '%Y-%m-%d %H:%M' start time into its date and half hour slot of the day
+    """
+    time = datetime.strptime(start_time, '%Y-%m-%d %H:%M')
+    return time.strftime('%Y-%m-%d'), time.hour * 2 + time.minute // 30
+
+
+def parse_date(date):
+    return datetime.strptime(date, '%Y-%m-%d')
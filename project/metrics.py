@@ -0,0 +1,176 @@
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+from project.api import http_session
+
+logger = logging.getLogger(__name__)
+
+"""
+Per invocation stage timings and counts, written as CloudWatch Embedded Metric Format (EMF) log lines.
+CloudWatch turns each line into metrics without any API calls, and the lines can be checked offline with
+validate_emf_record. Off unless METRICS_ENABLED is 'true', when stage and timed hand back no-op wrappers.
+"""
+
+metrics_enabled = os.environ.get("METRICS_ENABLED") == 'true'
+metrics_namespace = os.environ.get("METRICS_NAMESPACE", "SmartPower")
+
+# hosts of the shared http_session, reported under the API's name
+api_hosts = {'api.givenergy.cloud': 'GivEnergy',
+             'datapoint.metoffice.gov.uk': 'MetOffice',
+             'api.octopus.energy': 'Octopus'}
+
+valid_units = {'Seconds', 'Milliseconds', 'Bytes', 'Count', 'None'}
+
+_disabled_stage = nullcontext()
+
+
+class Metrics:
+    def __init__(self, command, namespace=None, enabled=None):
+        self.command = command
+        self.namespace = namespace or metrics_namespace
+        self.enabled = metrics_enabled if enabled is None else enabled
+        self.values = {}
+        self.units = {}
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        if self.enabled:
+            http_session.reset_host_stats()
+
+    def put(self, name, value, unit='Count'):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.values[name] = value
+            self.units[name] = unit
+
+    def add(self, name, value=1, unit='Count'):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.values[name] = self.values.get(name, 0) + value
+            self.units[name] = unit
+
+    def stage(self, name):
+        """
+        Context manager recording the wall time of a stage as '<name>_ms'
+        """
+        if not self.enabled:
+            return _disabled_stage
+        return self._timed_stage(name)
+
+    @contextmanager
+    def _timed_stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(f"{name}_ms", (time.perf_counter() - start) * 1000, 'Milliseconds')
+
+    def timed(self, name, function):
+        """
+        Wrap function so each call is recorded as a stage, for work handed to an executor
+        """
+        if not self.enabled:
+            return function
+
+        def timed_function(*args, **kwargs):
+            with self.stage(name):
+                return function(*args, **kwargs)
+        return timed_function
+
+    def records(self, timestamp=None):
+        """
+        EMF records for the invocation, one for the stages and one for each API that was called
+        """
+        if not self.enabled:
+            return []
+        timestamp = int((timestamp if timestamp is not None else time.time()) * 1000)
+        with self.lock:
+            values = dict(self.values)
+            units = dict(self.units)
+        values['total_ms'] = (time.perf_counter() - self.started) * 1000
+        units['total_ms'] = 'Milliseconds'
+
+        records = [self._record(timestamp, {'Command': self.command}, values, units)]
+        for host, stats in http_session.get_host_stats().items():
+            api = api_hosts.get(host, host)
+            records.append(self._record(
+                timestamp, {'Command': self.command, 'Api': api},
+                {'http_calls': stats['calls'], 'http_errors': stats['errors'], 'http_bytes': stats['bytes'],
+                 'http_total_ms': stats['total_seconds'] * 1000, 'http_max_ms': stats['max_seconds'] * 1000},
+                {'http_calls': 'Count', 'http_errors': 'Count', 'http_bytes': 'Bytes',
+                 'http_total_ms': 'Milliseconds', 'http_max_ms': 'Milliseconds'}))
+        return records
+
+    def flush(self, write=None):
+        """
+        Write each EMF record as a single JSON line, by default straight to stdout so the Lambda log
+        formatter doesn't prefix it. Returns the records
+        """
+        records = self.records()
+        write = write or (lambda line: print(line, flush=True))
+        for record in records:
+            write(json.dumps(record))
+        return records
+
+    def _record(self, timestamp, dimensions, values, units):
+        record = {'_aws': {'Timestamp': timestamp,
+                           'CloudWatchMetrics': [{'Namespace': self.namespace,
+                                                  'Dimensions': [list(dimensions)],
+                                                  'Metrics': [{'Name': name, 'Unit': units[name]}
+                                                              for name in values]}]}}
+        record.update(dimensions)
+        record.update(values)
+        return record
+
+
+def validate_emf_record(record):
+    """
+    Check a record against the parts of the EMF specification CloudWatch enforces, raising ValueError if it breaks them
+    """
+    if isinstance(record, str):
+        record = json.loads(record)
+    metadata = record.get('_aws')
+    if not isinstance(metadata, dict) or not isinstance(metadata.get('Timestamp'), int):
+        raise ValueError("EMF record needs an _aws object with an integer Timestamp")
+    directives = metadata.get('CloudWatchMetrics')
+    if not isinstance(directives, list) or not directives:
+        raise ValueError("EMF record needs at least one CloudWatchMetrics directive")
+    for directive in directives:
+        if not directive.get('Namespace'):
+            raise ValueError("EMF directive needs a Namespace")
+        for dimension_set in directive.get('Dimensions', []):
+            if len(dimension_set) > 30:
+                raise ValueError("EMF dimension sets hold at most 30 dimensions")
+            for dimension in dimension_set:
+                if not isinstance(record.get(dimension), str):
+                    raise ValueError(f"EMF dimension {dimension} needs a string value in the record")
+        if len(directive.get('Metrics', [])) > 100:
+            raise ValueError("EMF directives hold at most 100 metrics")
+        for metric in directive.get('Metrics', []):
+            value = record.get(metric.get('Name'))
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                raise ValueError(f"EMF metric {metric.get('Name')} needs a numeric value in the record")
+            if metric.get('Unit', 'None') not in valid_units:
+                raise ValueError(f"EMF metric {metric['Name']} has an unknown unit {metric['Unit']}")
+    return record
+
+
+_current = Metrics(None, enabled=False)
+
+
+def start_invocation(command, enabled=None):
+    """
+    Start collecting metrics for a new invocation, replacing the previous one
+    """
+    global _current
+    _current = Metrics(command, enabled=enabled)
+    return _current
+
+
+def current():
+    return _current
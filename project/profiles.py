@@ -0,0 +1,170 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+from collections import deque
+from datetime import datetime, timedelta
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+"""
+Running half hour profiles of house consumption and solar production, updated a day at a time.
+
+Consumption is kept per weekday over the last weeks of that weekday, solar over the last days, the windows
+analyse_energy_usage and analyse_solar_production average over. Each window holds its days and a running sum,
+so adding a day and evicting the oldest is O(48) and so is reading a mean profile. Quantile profiles are taken
+from the days the windows already hold, so they cost nothing to fetch.
+"""
+
+slots_per_day = 48
+
+# profiles are kept per inverter serial across warm Lambda invocations and in a file in /tmp
+profile_store_path = os.environ.get("PROFILE_STORE_PATH", "/tmp/energy_profiles.json")
+_profiles = {}
+_profiles_lock = threading.Lock()
+
+
+class ProfileWindow:
+    """
+    The half hour totals of up to size days no more than span_days apart, with their running sum
+    """
+    def __init__(self, size, span_days):
+        self.size = size
+        self.span_days = span_days
+        self.days = deque()
+        self.total = np.zeros(slots_per_day)
+
+    def __len__(self):
+        return len(self.days)
+
+    def add(self, date, values):
+        values = np.asarray(values, dtype=float)
+        self.days.append((date, values))
+        self.total += values
+        oldest = (_parse_date(date) - timedelta(days=self.span_days)).strftime('%Y-%m-%d')
+        while len(self.days) > self.size or self.days[0][0] <= oldest:
+            _, evicted = self.days.popleft()
+            self.total -= evicted
+
+    def mean(self):
+        if not self.days:
+            return None
+        return self.total / len(self.days)
+
+    def quantile(self, q):
+        if not self.days:
+            return None
+        return np.quantile(np.stack([values for _, values in self.days]), q, axis=0)
+
+
+class ProfileAggregator:
+    """
+    Consumption windows for each weekday and one solar window, for one inverter
+    """
+    def __init__(self, weeks=4, solar_days=40):
+        self.weeks = weeks
+        self.solar_days = solar_days
+        self.consumption = [ProfileWindow(weeks, weeks * 7) for _ in range(7)]
+        self.solar = ProfileWindow(solar_days, solar_days)
+        self.last_date = None
+
+    def add_day(self, date, consumption, solar):
+        """
+        Add a day's half hour totals, days must be added in date order and any already added are ignored
+        """
+        if self.last_date is not None and date <= self.last_date:
+            return False
+        self.consumption[_parse_date(date).weekday()].add(date, consumption)
+        self.solar.add(date, solar)
+        self.last_date = date
+        return True
+
+    def consumption_profile(self, date, q=None):
+        """
+        Mean half hour consumption of the date's weekday, or its q quantile. None if there is no history for it
+        """
+        window = self.consumption[_parse_date(date).weekday()]
+        return window.mean() if q is None else window.quantile(q)
+
+    def solar_profile(self, q=None):
+        return self.solar.mean() if q is None else self.solar.quantile(q)
+
+    def missing_dates(self, through_date):
+        """
+        Dates after the last one added, up to and including through_date, that the windows could still hold
+        """
+        through = _parse_date(through_date)
+        start = through - timedelta(days=max(self.weeks * 7, self.solar_days) - 1)
+        if self.last_date is not None:
+            start = max(start, _parse_date(self.last_date) + timedelta(days=1))
+        return [(start + timedelta(days=day)).strftime('%Y-%m-%d') for day in range((through - start).days + 1)]
+
+    def to_dict(self):
+        consumption = {date: values.tolist() for window in self.consumption for date, values in window.days}
+        return {'weeks': self.weeks,
+                'solar_days': self.solar_days,
+                'last_date': self.last_date,
+                'consumption': consumption,
+                'solar': {date: values.tolist() for date, values in self.solar.days}}
+
+    @classmethod
+    def from_dict(cls, data):
+        profiles = cls(data['weeks'], data['solar_days'])
+        for date in sorted(data['consumption']):
+            profiles.consumption[_parse_date(date).weekday()].add(date, data['consumption'][date])
+        for date in sorted(data['solar']):
+            profiles.solar.add(date, data['solar'][date])
+        profiles.last_date = data['last_date']
+        return profiles
+
+
+def load_profiles(serial, weeks=4, solar_days=40):
+    """
+    The aggregator for an inverter, from memory or the profile file, or a new empty one
+    """
+    with _profiles_lock:
+        if not _profiles and profile_store_path:
+            for key, data in _read_file_cache().items():
+                _profiles[key] = ProfileAggregator.from_dict(data)
+        profiles = _profiles.get(serial)
+        if profiles is None or (profiles.weeks, profiles.solar_days) != (weeks, solar_days):
+            profiles = _profiles[serial] = ProfileAggregator(weeks, solar_days)
+        return profiles
+
+
+def save_profiles():
+    with _profiles_lock:
+        if profile_store_path:
+            _write_file_cache({serial: profiles.to_dict() for serial, profiles in _profiles.items()})
+
+
+def clear_profiles():
+    """
+    Forget every profile, in memory and in the profile file
+    """
+    with _profiles_lock:
+        _profiles.clear()
+        if profile_store_path and os.path.exists(profile_store_path):
+            os.remove(profile_store_path)
+
+
+def _read_file_cache():
+    try:
+        with open(profile_store_path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_file_cache(file_cache):
+    directory = os.path.dirname(os.path.abspath(profile_store_path))
+    with tempfile.NamedTemporaryFile('w', dir=directory, delete=False) as file:
+        json.dump(file_cache, file)
+    os.replace(file.name, profile_store_path)
+
+
+def _parse_date(date):
+    return datetime.strptime(date, '%Y-%m-%d')
@@ -0,0 +1,124 @@
+import logging
+import os
+import tempfile
+import threading
+from datetime import timezone
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+"""
+Clear sky solar geometry for every half hour of the year, looked up by slot.
+
+The table holds the sun's elevation and azimuth and the clear sky global horizontal irradiance at the middle of
+each half hour, UTC, for one latitude and longitude. It is computed in one vectorised pvlib call and saved as a
+.npy array, so planning only indexes into it. pvlib is only needed to build a table that isn't on disk yet, the
+Docker image ships one built by tools.build_solar_table so the function itself doesn't need pvlib.
+"""
+
+try:
+    import pvlib
+except ImportError:
+    pvlib = None
+
+# site the tables are computed for, Lancaster by default like the forecast location
+solar_latitude = float(os.environ.get("SOLAR_LATITUDE", 54.0466))
+solar_longitude = float(os.environ.get("SOLAR_LONGITUDE", -2.8007))
+
+# peak output of the panels in kW. When it is set the clear sky baseline replaces the 40 day solar history
+solar_array_kwp = float(os.environ["SOLAR_ARRAY_KWP"]) if os.environ.get("SOLAR_ARRAY_KWP") else None
+
+# share of the panels' rated output that reaches the inverter
+performance_ratio = 0.8
+
+# directory the tables are read from, the Docker image ships its table in project/solar_tables
+solar_table_directory = os.environ.get("SOLAR_TABLE_DIRECTORY",
+                                       os.path.join(os.path.dirname(os.path.abspath(__file__)), "solar_tables"))
+
+# a leap year, so every date has a day in the table
+table_year = 2024
+slots_per_day = 48
+table_rows = ['elevation', 'azimuth', 'ghi']
+
+_tables = {}
+_tables_lock = threading.Lock()
+
+
+def build_solar_table(latitude, longitude):
+    """
+    Elevation and azimuth in degrees and clear sky GHI in W/m2 at the middle of every half hour of the year,
+    as a 3 x 366*48 float32 array
+    """
+    times = pd.date_range(f'{table_year}-01-01 00:15', periods=366 * slots_per_day, freq='30min', tz='UTC')
+    location = pvlib.location.Location(latitude, longitude)
+    position = location.get_solarposition(times)
+    clearsky = location.get_clearsky(times, solar_position=position)
+    return np.array([position['apparent_elevation'], position['azimuth'], clearsky['ghi']], dtype=np.float32)
+
+
+def load_solar_table(latitude=None, longitude=None):
+    """
+    The table for a site from memory or disk, building and saving it when pvlib is installed.
+    None when there is no table and pvlib isn't installed
+    """
+    latitude = solar_latitude if latitude is None else latitude
+    longitude = solar_longitude if longitude is None else longitude
+    path = solar_table_path(latitude, longitude)
+    with _tables_lock:
+        if path in _tables:
+            return _tables[path]
+        try:
+            table = np.load(path)
+        except (OSError, ValueError):
+            if pvlib is None:
+                logger.warning(f"No solar table at {path} and pvlib isn't installed to build it")
+                return None
+            table = build_solar_table(latitude, longitude)
+            try:
+                _save_table(path, table)
+            except OSError as e:
+                logger.warning(f"Couldn't save the solar table to {path}, it is kept in memory: {e}")
+        _tables[path] = table
+        return table
+
+
+def solar_table_path(latitude, longitude):
+    return os.path.join(solar_table_directory, f"solar_table_{latitude:.4f}_{longitude:.4f}.npy")
+
+
+def table_slots(start, slots):
+    """
+    Table columns of the slots half hours from start, a timezone aware datetime or naive UTC.
+    Each slot is looked up by its own date, so outside leap years 28 February is followed by 1 March
+    """
+    if start.tzinfo is not None:
+        start = start.astimezone(timezone.utc)
+    times = pd.date_range(start, periods=slots, freq='30min')
+    # the table is a leap year, days after 28 February are one further in than in other years
+    table_day = times.dayofyear - 1 + ((times.month > 2) & ~times.is_leap_year)
+    return np.asarray(table_day * slots_per_day + times.hour * 2 + times.minute // 30)
+
+
+def clearsky_production(start, slots, kwp, latitude=None, longitude=None):
+    """
+    kWh the panels would produce in each half hour from start under a clear sky, None when there is no table
+    """
+    table = load_solar_table(latitude, longitude)
+    if table is None:
+        return None
+    ghi = table[table_rows.index('ghi'), table_slots(start, slots)].astype(float)
+    return kwp * ghi / 1000 * performance_ratio * 0.5
+
+
+def clear_solar_tables():
+    with _tables_lock:
+        _tables.clear()
+
+
+def _save_table(path, table):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(path)), suffix='.npy', delete=False) as file:
+        np.save(file, table)
+    os.replace(file.name, path)
@@ -0,0 +1,125 @@
+from datetime import date, datetime, timedelta
+
+import numpy as np
+import pytest
+
+from project import backtest
+from project.api.octopus import AgileRates
+from project.history_store import EnergyHistoryStore
+
+battery_spec = {'battery_kwatt_hours_remaining': 4.0, 'watt_hour': 9500, 'max_charge_rate_watts': 3600}
+
+
+@pytest.fixture()
+def backtest_data():
+    days = [(date(2024, 3, 1) + timedelta(days=i)).isoformat() for i in range(10)]
+    hour = (np.arange(10 * 48) % 48) / 2
+    consumption = 0.2 + 0.5 * ((hour >= 17) & (hour < 22))
+    solar = np.clip(np.sin((hour - 6) / 12 * np.pi), 0, None)
+    prices = 15 + 20 * ((hour >= 16) & (hour < 19)) - 10 * (hour < 5)
+    return backtest.BacktestData(days, consumption, solar, prices)
+
+
+def test_simulate_day_accounts_for_grid_and_export():
+    # Given
+    charge = [True, False, False, False]
+    consumption = [0.5, 0.5, 0.0, 3.0]
+    solar = [0.0, 0.0, 6.0, 0.0]
+    prices = [10.0, 20.0, 30.0, 40.0]
+
+    # When
+    actual_result = backtest.simulate_day(charge, consumption, solar, prices, 1.0, 5.0, 0.5, 3.6)
+
+    # Then
+    # 1.0 + 1.8 - 0.5 = 2.3, 1.8, 7.8 capped at 5.0 so 2.8 is exported, then 2.0
+    assert actual_result['grid_charge_kwh'] == pytest.approx(1.8)
+    assert actual_result['export_kwh'] == pytest.approx(2.8)
+    assert actual_result['cost_pence'] == pytest.approx(18.0)
+    assert actual_result['min_battery_kwh'] == pytest.approx(1.0)
+    assert actual_result['end_battery_kwh'] == pytest.approx(2.0)
+    assert actual_result['threshold_violations'] == 0
+
+
+def test_simulate_day_buys_what_the_empty_battery_cannot_supply():
+    # When
+    actual_result = backtest.simulate_day([False, False], [1.0, 1.0], [0.0, 0.0], [10.0, 30.0], 1.5, 5.0, 1.0, 3.6)
+
+    # Then
+    assert actual_result['grid_import_kwh'] == pytest.approx(0.5)
+    assert actual_result['cost_pence'] == pytest.approx(15.0)
+    assert actual_result['threshold_violations'] == 2
+
+
+def test_run_backtest_scores_every_strategy(backtest_data):
+    # When
+    df_days = backtest.run_backtest(backtest_data, battery_spec, max_workers=2)
+    df_summary = backtest.summarise_backtest(df_days, baseline='no_charge')
+
+    # Then
+    # the first week has no earlier same weekday to estimate from
+    assert list(df_summary.index) == list(backtest.default_strategies)
+    assert (df_summary['days'] == 3).all()
+    assert df_summary.loc['no_charge', 'grid_charge_kwh'] == 0
+    # every day is the same, so the estimate is exact and the exact engine holds the threshold
+    assert df_summary.loc['exact', 'threshold_violations'] == 0
+    assert df_summary.loc['no_charge', 'saving_pence'] == 0
+    assert (df_days['start_battery_kwh'] == battery_spec['battery_kwatt_hours_remaining']).all()
+
+
+def test_run_backtest_carries_the_battery_over(backtest_data):
+    # When
+    df_days = backtest.run_backtest(backtest_data, battery_spec, {'greedy': backtest.greedy_strategy},
+                                    carry_over=True, perfect_estimate=True, max_workers=1)
+
+    # Then
+    assert len(df_days) == 10
+    assert df_days['start_battery_kwh'].iloc[1:].tolist() == pytest.approx(df_days['end_battery_kwh'].iloc[:-1].tolist())
+
+
+def test_run_backtest_with_a_live_battery_spec(backtest_data):
+    # Given
+    live_battery_spec = {'watt_hour': 9500, 'max_charge_rate_watts': 3600}
+
+    # When
+    df_default = backtest.run_backtest(backtest_data, live_battery_spec, {'greedy': backtest.greedy_strategy},
+                                       lowest_charge_threshold=2.0, max_workers=1)
+    df_given = backtest.run_backtest(backtest_data, live_battery_spec, {'greedy': backtest.greedy_strategy},
+                                     max_workers=1, start_battery_kwh=6.0)
+
+    # Then
+    assert (df_default['start_battery_kwh'] == 2.0).all()
+    assert (df_given['start_battery_kwh'] == 6.0).all()
+
+
+def test_fixed_window_strategy(backtest_data):
+    # When
+    df_days = backtest.run_backtest(backtest_data, battery_spec,
+                                    {'fixed': backtest.FixedWindowStrategy('01:00', '03:00')}, max_workers=1)
+
+    # Then
+    assert (df_days['slots_charged'] == 4).all()
+
+
+def test_backtest_data_from_history(tmp_path):
+    # Given
+    history_store = EnergyHistoryStore(str(tmp_path / 'history.sqlite'))
+    start = datetime(2024, 7, 1)
+    history_store.save_energy_flows('EA1', {
+        str(i): {'start_time': (start + timedelta(minutes=30 * i)).strftime('%Y-%m-%d %H:%M'),
+                 'end_time': (start + timedelta(minutes=30 * (i + 1))).strftime('%Y-%m-%d %H:%M'),
+                 'data': {'0': 0.1, '1': 0.2, '2': 0.0, '3': 0.3, '5': 0.4}}
+        for i in range(49)}, now=datetime(2024, 7, 3))
+    # rates are UTC, the day starts at 23:00 UTC in summer
+    rates = AgileRates([{'value_inc_vat': float(i),
+                         'valid_from': (datetime(2024, 6, 30, 23) + timedelta(minutes=30 * i)).strftime('%Y-%m-%dT%H:%M:%SZ'),
+                         'valid_to': (datetime(2024, 6, 30, 23) + timedelta(minutes=30 * (i + 1))).strftime('%Y-%m-%dT%H:%M:%SZ')}
+                        for i in range(60)])
+
+    # When
+    actual_result = backtest.BacktestData.from_history(history_store, 'EA1', rates, '2024-07-01', '2024-07-03')
+
+    # Then
+    assert actual_result.days == ['2024-07-01']
+    assert actual_result.consumption[0] == pytest.approx(np.full(48, 0.8))
+    assert actual_result.solar[0] == pytest.approx(np.full(48, 0.3))
+    assert actual_result.prices[0].tolist() == [float(i) for i in range(48)]
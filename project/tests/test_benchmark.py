@@ -0,0 +1,55 @@
+import main
+from tools.benchmark import (FixtureForecast, compare_results, run_benchmarks, synthetic_agile_data,
+                             synthetic_energy_result)
+
+
+def test_compare_results_flags_regressions():
+    # Given
+    baseline = {'results': [{'stage': 'a', 'params': {'slots': 48}, 'median_seconds': 0.010},
+                            {'stage': 'b', 'params': {}, 'median_seconds': 0.010},
+                            {'stage': 'c', 'params': {}, 'median_seconds': 0.0001}]}
+    results = [{'stage': 'a', 'params': {'slots': 48}, 'median_seconds': 0.011},
+               {'stage': 'b', 'params': {}, 'median_seconds': 0.020},
+               {'stage': 'c', 'params': {}, 'median_seconds': 0.0005},
+               {'stage': 'd', 'params': {}, 'median_seconds': 1.0}]
+
+    # When
+    actual_result = compare_results(results, baseline, threshold=0.25)
+
+    # Then
+    assert [(comparison['stage'], comparison['regression']) for comparison in actual_result] == \
+           [('a', False), ('b', True), ('c', False)]
+
+
+def test_synthetic_data_feeds_the_pipeline():
+    # Given
+    energy_result, agile_data = synthetic_energy_result(480), synthetic_agile_data(480)
+
+    # When
+    insights = main.concat_data_sources(energy_result, agile_data)
+    actual_result = main.determine_optimal_charging_periods(insights, 4.0, 9.5, main.lowest_charge_threshold, 3.6)
+
+    # Then
+    assert len(actual_result) == 480
+    assert actual_result['charge'].any()
+
+
+def test_fixture_forecast_serves_requested_dates():
+    # When
+    date_index, timer, solar_index = FixtureForecast().get_solar_index_forecast('320301',
+                                                                               ['2030-01-01Z', '2030-01-02Z'])
+
+    # Then
+    assert set(date_index.tolist()) == {0, 1}
+    assert len(solar_index) > 0
+
+
+def test_run_benchmarks_times_every_stage():
+    # When
+    actual_result = run_benchmarks(slots=[48], days=[2], repeat=1)
+
+    # Then
+    assert {result['stage'] for result in actual_result} == {
+        'extract_half_hour_data', 'decode_energy_flows', 'analyse_forecast', 'get_agile_data',
+        'concat_data_sources', 'determine_optimal_charging_periods', 'prepare_time_windows_for_givenergy'}
+    assert all(result['min_seconds'] > 0 for result in actual_result)
@@ -0,0 +1,42 @@
+import numpy as np
+
+from project.charge_scheduler import solve_charge_schedule
+
+
+def test_solve_charge_schedule_picks_cheapest_slot_before_depletion():
+    # Given
+    energy = [0.5, 0.5, 1.0, 1.0, 1.0, 1.0]
+    prices = [30, 10, 5, 20, 1, 40]
+
+    # When
+    actual_result = solve_charge_schedule(energy, prices, 4.0, 9.0, 2.0, 3.6)
+
+    # Then
+    assert actual_result.tolist() == [False, False, True, False, True, False]
+
+
+def test_solve_charge_schedule_charges_negative_prices():
+    # Given
+    energy = [0.1, 0.1, 0.1, 0.1]
+    prices = [10, -2, 10, -1]
+
+    # When
+    actual_result = solve_charge_schedule(energy, prices, 5.0, 9.0, 2.0, 3.6)
+
+    # Then
+    assert actual_result.tolist() == [False, True, False, True]
+
+
+def test_solve_charge_schedule_caps_charge_windows():
+    # Given
+    energy = [1.5] * 8
+    prices = [5, 30, 5, 30, 5, 30, 5, 30]
+
+    # When
+    uncapped = solve_charge_schedule(energy, prices, 3.0, 9.0, 2.0, 3.6)
+    capped = solve_charge_schedule(energy, prices, 3.0, 9.0, 2.0, 3.6, max_charge_windows=1)
+
+    # Then
+    starts = np.flatnonzero(np.diff(np.concatenate([[0], capped.astype(int)])) == 1)
+    assert len(starts) == 1
+    assert np.dot(uncapped, prices) <= np.dot(capped, prices)
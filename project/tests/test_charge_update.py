@@ -0,0 +1,229 @@
+import threading
+
+import pytest
+
+from project.api.givenergy import GivEnergy
+from project.api.scheduler import LocalSchedulerClient, OneShotScheduler
+from project import charge_update
+from project.charge_update import (get_charge_slots, program_charge_windows, set_and_check_setting,
+                                   update_inverter_charge_time, write_and_verify_settings)
+
+
+class FakeInverter:
+    """
+    Holds written settings, each read returns the next of the queued responses for that setting
+    then the written value, each write raises the next of the queued write errors for that setting
+    """
+    def __init__(self, reads=None, barrier=None, settings=None, write_errors=None):
+        self.settings = settings
+        self.values = {}
+        self.writes = []
+        self.reads = {setting: list(responses) for setting, responses in (reads or {}).items()}
+        self.write_errors = {setting: list(errors) for setting, errors in (write_errors or {}).items()}
+        self.barrier = barrier
+
+    def update_inverter_setting(self, setting, value):
+        if self.barrier is not None:
+            self.barrier.wait()
+        self.writes.append((setting, value))
+        if self.write_errors.get(setting):
+            raise self.write_errors[setting].pop(0)
+        self.values[setting] = value
+
+    def get_inverter_settings(self):
+        if self.settings is None:
+            raise ConnectionError('settings unavailable')
+        return {'data': self.settings}
+
+    def read_inverter_setting(self, setting):
+        if self.reads.get(setting):
+            response = self.reads[setting].pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response
+        return {'data': {'value': self.values.get(setting), 'success': True, 'message': 'Read successfully'}}
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+    def clock(self):
+        return self.now
+
+
+class FakeCloudWatch:
+    def __init__(self):
+        self.events = []
+
+    def create_event(self, too_hours, aws_fields, input_json):
+        self.events.append(('ENABLED', too_hours, input_json))
+
+    def send_update(self, cron_expression, state, aws_fields, input_json):
+        self.events.append((state, cron_expression, input_json))
+
+
+charge_slot_settings = [{'id': 28, 'name': 'AC Charge 2 Start Time'}, {'id': 29, 'name': 'AC Charge 2 End Time'},
+                        {'id': 64, 'name': 'AC Charge 1 Start Time'}, {'id': 65, 'name': 'AC Charge 1 End Time'},
+                        {'id': 66, 'name': 'AC Charge Enable'}]
+
+
+def make_windows(*times):
+    return [{'from_hours_giv': start, 'too_hours_giv': end, 'from_hours_aws': start, 'too_hours_aws': end}
+            for start, end in times]
+
+
+timeout = {'data': {'value': -1, 'success': False, 'message': 'Inverter Timeout'}}
+
+
+def test_writes_both_settings_in_parallel_and_confirms_them():
+    # Given
+    inverter = FakeInverter(barrier=threading.Barrier(2, timeout=5))
+    fake_clock = FakeClock()
+
+    # When
+    actual_result = write_and_verify_settings(inverter, {64: '01:30', 65: '02:30'}, deadline_seconds=5,
+                                              initial_delay_seconds=0.25, sleep=fake_clock.sleep,
+                                              clock=fake_clock.clock)
+
+    # Then
+    assert all(result['confirmed'] for result in actual_result.values())
+    assert actual_result[64]['reads'] == 1
+    assert fake_clock.sleeps == [0.25]
+
+
+def test_backs_off_while_the_inverter_times_out():
+    # Given
+    inverter = FakeInverter(reads={64: [timeout, ConnectionError('reset')], 65: [timeout]})
+    fake_clock = FakeClock()
+
+    # When
+    actual_result = write_and_verify_settings(inverter, {64: '01:30', 65: '02:30'}, deadline_seconds=5,
+                                              initial_delay_seconds=0.25, max_delay_seconds=0.75,
+                                              sleep=fake_clock.sleep, clock=fake_clock.clock)
+
+    # Then
+    assert fake_clock.sleeps == [0.25, 0.5, 0.75]
+    assert actual_result[64] == {'value': '01:30', 'confirmed': True, 'writes': 1, 'reads': 3,
+                                 'read_value': '01:30', 'error': None}
+    assert actual_result[65]['reads'] == 2
+    assert len(inverter.writes) == 2
+
+
+def test_rewrites_a_setting_that_reads_back_wrong():
+    # Given
+    inverter = FakeInverter(reads={64: [{'data': {'value': '00:00', 'success': True}}]})
+
+    # When
+    actual_result = set_and_check_setting(inverter, 64, '01:30')
+
+    # Then
+    assert actual_result['confirmed']
+    assert actual_result['writes'] == 2
+
+
+def test_rewrites_a_setting_whose_write_failed():
+    # Given
+    inverter = FakeInverter(write_errors={64: [TimeoutError('write timed out')] * 2})
+    fake_clock = FakeClock()
+
+    # When
+    actual_result = write_and_verify_settings(inverter, {64: '01:30', 65: '02:30'}, deadline_seconds=5,
+                                              initial_delay_seconds=0.25, sleep=fake_clock.sleep,
+                                              clock=fake_clock.clock)
+
+    # Then
+    assert actual_result[64] == {'value': '01:30', 'confirmed': True, 'writes': 3, 'reads': 1,
+                                 'read_value': '01:30', 'error': None}
+    assert actual_result[65]['writes'] == 1
+    assert fake_clock.sleeps == [0.25, 0.5, 1.0]
+
+
+def test_reports_unconfirmed_settings_at_the_deadline():
+    # Given
+    inverter = FakeInverter(reads={64: [timeout] * 10})
+    fake_clock = FakeClock()
+
+    # When
+    actual_result = write_and_verify_settings(inverter, {64: '01:30'}, deadline_seconds=1, initial_delay_seconds=0.25,
+                                              sleep=fake_clock.sleep, clock=fake_clock.clock)
+
+    # Then
+    assert not actual_result[64]['confirmed']
+    assert actual_result[64]['error'] == 'Inverter Timeout'
+    assert sum(fake_clock.sleeps) == pytest.approx(1)
+
+
+def test_update_inverter_charge_time_offline_does_not_wait():
+    # Given
+    giv_energy = GivEnergy(True, 'key', 'EA2302G694')
+
+    # When
+    actual_result = update_inverter_charge_time(giv_energy, True, '01:30', '02:30')
+
+    # Then
+    assert set(actual_result) == {64, 65}
+    assert not actual_result[64]['confirmed']
+    assert actual_result[64]['reads'] == 1
+
+
+def test_get_charge_slots_from_the_settings_list():
+    # When / Then
+    assert get_charge_slots(FakeInverter(settings=charge_slot_settings)) == [(64, 65), (28, 29)]
+    assert get_charge_slots(FakeInverter()) == [(64, 65)]
+
+
+def test_program_charge_windows_fills_every_slot_and_clears_the_rest(monkeypatch):
+    # Given
+    monkeypatch.setattr(charge_update, 'setting_poll_initial_seconds', 0)
+    inverter = FakeInverter(settings=charge_slot_settings)
+    cloudwatch = FakeCloudWatch()
+
+    # When
+    results, remaining = program_charge_windows(inverter, False, make_windows(('01:00', '02:00')), cloudwatch, {})
+
+    # Then
+    assert inverter.values == {64: '01:00', 65: '02:00', 28: '00:00', 29: '00:00'}
+    assert all(result['confirmed'] for result in results.values())
+    assert remaining == []
+    assert [event[0] for event in cloudwatch.events] == ['DISABLED']
+
+
+def test_program_charge_windows_chains_windows_that_do_not_fit(monkeypatch):
+    # Given
+    monkeypatch.setattr(charge_update, 'setting_poll_initial_seconds', 0)
+    inverter = FakeInverter(settings=charge_slot_settings)
+    cloudwatch = FakeCloudWatch()
+    windows = make_windows(('01:00', '02:00'), ('04:00', '05:00'), ('13:00', '14:00'), ('15:00', '15:30'))
+
+    # When
+    _, remaining = program_charge_windows(inverter, False, windows, cloudwatch, {})
+
+    # Then
+    assert inverter.values == {64: '01:00', 65: '02:00', 28: '04:00', 29: '05:00'}
+    assert remaining == windows[2:]
+    assert cloudwatch.events == [('ENABLED', '05:00', {'msg': 'update', 'data': windows[2:]})]
+
+
+def test_program_charge_windows_schedules_the_rest_at_once(monkeypatch):
+    # Given
+    monkeypatch.setattr(charge_update, 'setting_poll_initial_seconds', 0)
+    inverter = FakeInverter(settings=charge_slot_settings)
+    cloudwatch = FakeCloudWatch()
+    scheduler = OneShotScheduler(LocalSchedulerClient(), 'arn:aws:iam::1:role/scheduler')
+    windows = make_windows(('01:00', '02:00'), ('04:00', '05:00'), ('13:00', '14:00'), ('15:00', '15:30'),
+                           ('17:00', '17:30'))
+
+    # When
+    _, remaining = program_charge_windows(inverter, False, windows, cloudwatch, {'region': 'eu-west-2',
+                                                                                 'account_id': '1'}, scheduler)
+
+    # Then
+    assert remaining == windows[2:]
+    assert [event[0] for event in cloudwatch.events] == ['DISABLED']
+    assert len(scheduler.list_schedule_names()) == 2
@@ -0,0 +1,117 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import main
+from project import fleet
+from project.history_store import EnergyHistoryStore, LocalHistoryBackup
+
+
+@pytest.fixture()
+def shared_calls(monkeypatch):
+    calls = {'agile': [], 'forecast': []}
+    get_agile_data = main.get_agile_data
+
+    def fake_get_agile_data(octopus, time_offsets):
+        calls['agile'].append(octopus.region)
+        return get_agile_data(octopus, time_offsets)
+
+    def fake_analyse_forecast(forecast, location=main.forecast_location):
+        # the offline forecast is for the fixture's dates, so give every half hour of today and tomorrow a bias
+        calls['forecast'].append(location)
+        return pd.DataFrame({'timer': np.arange(96) * 0.5, 'solar_bias': 1.0})
+
+    monkeypatch.setattr(main, 'get_agile_data', fake_get_agile_data)
+    monkeypatch.setattr(main, 'analyse_forecast', fake_analyse_forecast)
+    return calls
+
+
+def test_plan_fleet_shares_inputs_and_isolates_failures(shared_calls):
+    # Given
+    sites = [{'site_id': 'a', 'ge_api_key': 'key_a'},
+             {'site_id': 'b', 'ge_api_key': 'key_b', 'tariff_region': 'C', 'engine': 'exact'},
+             {'ge_api_key': 'key_c', 'forecast_location': '310012'},
+             {'site_id': 'd'}]
+
+    # When
+    actual_result = fleet.plan_fleet(sites, offline_debug=True, max_workers=2)
+
+    # Then
+    assert sorted(shared_calls['agile']) == ['C', fleet.default_region]
+    assert sorted(shared_calls['forecast']) == sorted(['310012', main.forecast_location])
+    assert [site['site_id'] for site in actual_result['sites']] == ['a', 'b', '2', 'd']
+    assert [site['status'] for site in actual_result['sites']] == ['ok', 'ok', 'ok', 'error']
+    assert 'ge_api_key' in actual_result['sites'][3]['error']
+    assert actual_result['succeeded'] == 3
+    assert actual_result['failed'] == 1
+    for site in actual_result['sites'][:3]:
+        assert site['inverter_serial_number'] == 'EA2302G694'
+        assert site['slots_charged'] >= len(site['charge_times'])
+
+
+def test_plan_fleet_reports_failed_shared_input(shared_calls, monkeypatch):
+    # Given
+    def failing_forecast(forecast, location=main.forecast_location):
+        raise ConnectionError("Met Office unavailable")
+
+    monkeypatch.setattr(main, 'analyse_forecast', failing_forecast)
+
+    # When
+    actual_result = fleet.plan_fleet([{'site_id': 'a', 'ge_api_key': 'key_a'}], offline_debug=True, max_workers=1)
+
+    # Then
+    assert actual_result['failed'] == 1
+    assert 'Met Office unavailable' in actual_result['sites'][0]['error']
+
+
+def test_plan_fleet_falls_back_to_threads(shared_calls, monkeypatch):
+    # Given
+    def no_process_pool(max_workers=None):
+        raise OSError("no /dev/shm")
+
+    monkeypatch.setattr(fleet, 'ProcessPoolExecutor', no_process_pool)
+
+    # When
+    actual_result = fleet.plan_fleet([{'site_id': 'a', 'ge_api_key': 'key_a'}], offline_debug=True)
+
+    # Then
+    assert actual_result['succeeded'] == 1
+
+
+def test_plan_fleet_restores_and_backs_up_the_history_store_once(monkeypatch, tmp_path):
+    # Given
+    backup_directory = tmp_path / 'backup'
+    backup_directory.mkdir()
+    uploads = []
+    stores = []
+
+    class CountingBackup(LocalHistoryBackup):
+        def upload(self, path):
+            uploads.append(path)
+            super().upload(path)
+
+    def from_env():
+        stores.append(EnergyHistoryStore(str(tmp_path / 'history.sqlite'), CountingBackup(str(backup_directory))))
+        return stores[-1]
+
+    def plan_site(site, df_forecast, df_agile_data, time_offsets, offline_debug, apply, history_path):
+        return {'site_id': site['site_id'], 'status': 'ok', 'history_path': history_path}
+
+    def no_process_pool(max_workers=None):
+        raise OSError("no /dev/shm")
+
+    monkeypatch.setattr(fleet.EnergyHistoryStore, 'from_env', staticmethod(from_env))
+    monkeypatch.setattr(fleet, 'fetch_shared_inputs', lambda sites, offline_debug, time_offsets: (
+        {fleet.default_region: pd.DataFrame()}, {main.forecast_location: pd.DataFrame()}))
+    monkeypatch.setattr(fleet, 'plan_site', plan_site)
+    monkeypatch.setattr(fleet, 'ProcessPoolExecutor', no_process_pool)
+
+    # When
+    actual_result = fleet.plan_fleet([{'site_id': 'a', 'ge_api_key': 'key_a'}, {'site_id': 'b', 'ge_api_key': 'key_b'}],
+                                     offline_debug=False, max_workers=2)
+
+    # Then
+    assert actual_result['succeeded'] == 2
+    assert len(stores) == 1
+    assert [site['history_path'] for site in actual_result['sites']] == [stores[0].path] * 2
+    assert uploads == [stores[0].path]
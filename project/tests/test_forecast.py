@@ -0,0 +1,155 @@
+import pandas as pd
+import pytest
+import requests
+
+from project.api import forecast as forecast_module
+from project.api.forecast import Forecast, cached_forecast, resample_to_half_hours
+
+
+@pytest.fixture()
+def three_hourly_forecast():
+    return pd.DataFrame({'date': ['2023-08-18Z', '2023-08-18Z', '2023-08-19Z'],
+                         'timer': [21.0, 18.0, 24.0],
+                         'solar_index': [1, 3, 0]})
+
+
+def test_resample_to_half_hours_repeats_each_row(three_hourly_forecast):
+    # When
+    actual_result = resample_to_half_hours(three_hourly_forecast)
+
+    # Then
+    assert actual_result['timer'].tolist() == [18 + 0.5 * i for i in range(18)]
+    assert actual_result['solar_index'].tolist() == [3] * 6 + [1] * 6 + [0] * 6
+    assert actual_result['date'].tolist() == ['2023-08-18Z'] * 12 + ['2023-08-19Z'] * 6
+
+
+def test_resample_to_half_hours_interpolates(three_hourly_forecast):
+    # When
+    actual_result = resample_to_half_hours(three_hourly_forecast, interpolate=True)
+
+    # Then
+    assert actual_result['solar_index'].tolist()[:7] == pytest.approx([3, 8 / 3, 7 / 3, 2, 5 / 3, 4 / 3, 1])
+    assert actual_result['solar_index'].tolist()[-6:] == [0] * 6
+
+
+@pytest.fixture(params=['ijson', 'json'])
+def offline_forecast(request, monkeypatch):
+    if request.param == 'json':
+        monkeypatch.setattr(forecast_module, 'ijson', None)
+    return Forecast(True, 'api_key')
+
+
+def test_get_solar_index_forecast_only_keeps_requested_dates(offline_forecast):
+    # When
+    date_index, timer, solar_index = offline_forecast.get_solar_index_forecast('320301', ['2023-08-19Z'])
+
+    # Then
+    assert date_index.tolist() == [0] * 8
+    assert timer.tolist() == [0, 3, 6, 9, 12, 15, 18, 21]
+    assert solar_index.tolist() == [0, 0, 1, 3, 5, 3, 1, 0]
+
+
+def test_find_location(offline_forecast):
+    # When
+    by_name = offline_forecast.find_location(name='Lancaster')
+    by_id = offline_forecast.find_location(location_id=320301)
+    missing = offline_forecast.find_location(name='Atlantis')
+
+    # Then
+    assert by_name['id'] == '320301'
+    assert by_id == by_name
+    assert missing is None
+
+
+def test_open_stream_closes_a_failed_response(monkeypatch):
+    # Given
+    class FailedResponse:
+        closed = False
+
+        def raise_for_status(self):
+            raise requests.exceptions.HTTPError("500 Server Error")
+
+        def close(self):
+            self.closed = True
+
+    response = FailedResponse()
+    monkeypatch.setattr(forecast_module.http_session, 'request', lambda *args, **kwargs: response)
+
+    # When
+    with pytest.raises(requests.exceptions.HTTPError):
+        Forecast(False, 'api_key').get_forecast_location('320301')
+
+    # Then
+    assert response.closed
+
+
+class IssuedForecast:
+    """
+    Online forecast stand in, whose issue time can be changed
+    """
+    offline_debug = False
+
+    def __init__(self, issue_time='2024-03-04T12:00:00Z'):
+        self.issue_time = issue_time
+        self.issue_time_requests = 0
+
+    def get_issue_time(self):
+        self.issue_time_requests += 1
+        return self.issue_time
+
+
+@pytest.fixture()
+def forecast_cache(monkeypatch, tmp_path):
+    monkeypatch.setattr(forecast_module, 'forecast_cache_path', str(tmp_path / 'forecast_cache.json'))
+    monkeypatch.setattr(forecast_module, '_forecast_cache', {})
+    builds = []
+
+    def build():
+        builds.append(1)
+        return pd.DataFrame({'date': ['2024-03-04Z'] * 2, 'timer': [12.0, 12.5], 'solar_index': [len(builds)] * 2,
+                             'solar_bias': [0.5, 0.5]})
+    return builds, build
+
+
+def test_cached_forecast_only_rebuilds_for_a_new_issue(forecast_cache, monkeypatch):
+    # Given
+    builds, build = forecast_cache
+    forecast = IssuedForecast()
+    dates = ['2024-03-04Z', '2024-03-05Z']
+    first = cached_forecast(forecast, '320301', dates, build, now=1000)
+
+    # When
+    within_revalidate = cached_forecast(forecast, '320301', dates, build, now=1100)
+    same_issue = cached_forecast(forecast, '320301', dates, build, now=3000)
+    forecast.issue_time = '2024-03-04T13:00:00Z'
+    new_issue = cached_forecast(forecast, '320301', dates, build, now=5000)
+    other_site = cached_forecast(forecast, '310012', dates, build, now=5000)
+
+    # Then
+    assert len(builds) == 3
+    assert forecast.issue_time_requests == 4
+    pd.testing.assert_frame_equal(within_revalidate, first)
+    pd.testing.assert_frame_equal(same_issue, first)
+    assert new_issue['solar_index'].tolist() == [2, 2]
+    assert other_site['solar_index'].tolist() == [3, 3]
+
+    # the cache file is read by a cold start
+    monkeypatch.setattr(forecast_module, '_forecast_cache', {})
+    pd.testing.assert_frame_equal(cached_forecast(forecast, '320301', dates, build, now=5100), new_issue)
+    assert len(builds) == 3
+
+
+def test_cached_forecast_without_an_issue_time_is_not_cached(forecast_cache):
+    # Given
+    builds, build = forecast_cache
+
+    class Unavailable(IssuedForecast):
+        def get_issue_time(self):
+            raise ConnectionError("capabilities unavailable")
+
+    # When
+    cached_forecast(Unavailable(), '320301', ['2024-03-04Z'], build, now=1000)
+    cached_forecast(Unavailable(), '320301', ['2024-03-04Z'], build, now=1001)
+
+    # Then
+    assert len(builds) == 2
@@ -0,0 +1,136 @@
+import time
+
+import pytest
+
+from project.api.givenergy import GivEnergy
+
+
+@pytest.fixture()
+def giv_energy():
+    return GivEnergy(True, None)
+
+
+@pytest.fixture()
+def date_ranges():
+    return [{'start_date': '2024-07-01', 'end_date': '2024-07-03'},
+            {'start_date': '2024-07-02', 'end_date': '2024-07-04'},
+            {'start_date': '2024-07-03', 'end_date': '2024-07-05'}]
+
+
+def test_offline_energy_usage_has_the_requested_flow_types(giv_energy):
+    # When
+    actual_result = giv_energy.get_energy_usage('2024-07-03', '2024-07-04', [0, 1, 2])
+
+    # Then
+    assert all(list(half_hour['data']) == ['0', '1', '2'] for half_hour in actual_result['data'].values())
+
+
+def test_get_energy_usage_ranges_keeps_input_order(giv_energy, date_ranges, monkeypatch):
+    # Given
+    delays = {'2024-07-01': 0.03, '2024-07-02': 0.0, '2024-07-03': 0.01}
+
+    def get_energy_usage(start_date, end_date, e_types):
+        time.sleep(delays[start_date])
+        return {'data': start_date}
+
+    monkeypatch.setattr(giv_energy, 'get_energy_usage', get_energy_usage)
+
+    # When
+    actual_result = giv_energy.get_energy_usage_ranges(date_ranges, [0, 1, 2], max_workers=3)
+
+    # Then
+    assert [result['data'] for result in actual_result] == ['2024-07-01', '2024-07-02', '2024-07-03']
+
+
+def test_get_energy_usage_ranges_raises_request_error(giv_energy, date_ranges, monkeypatch):
+    # Given
+    def get_energy_usage(start_date, end_date, e_types):
+        if start_date == '2024-07-02':
+            raise ValueError(start_date)
+        return {'data': start_date}
+
+    monkeypatch.setattr(giv_energy, 'get_energy_usage', get_energy_usage)
+
+    # When / Then
+    with pytest.raises(ValueError, match='2024-07-02'):
+        giv_energy.get_energy_usage_ranges(date_ranges, [0, 1, 2])
+
+
+@pytest.fixture()
+def spec_requests(monkeypatch):
+    from project.api import givenergy
+    from project.example_responses.example_data_handler import GivEnergyData
+
+    requests = []
+
+    def get_system_specifications(self):
+        requests.append(self.api_key)
+        return GivEnergyData.system_specification()
+
+    monkeypatch.setattr(GivEnergy, 'get_system_specifications', get_system_specifications)
+    monkeypatch.setattr(givenergy, '_system_spec_cache', {})
+    monkeypatch.setattr(givenergy, 'system_spec_cache_path', None)
+    return requests
+
+
+def test_system_specs_are_requested_lazily(spec_requests):
+    # When
+    giv_energy = GivEnergy(False, 'key')
+
+    # Then
+    assert spec_requests == []
+    assert giv_energy.inverter_serial_number == 'EA2302G694'
+    assert giv_energy.system_specs['battery_spec']['max_charge_rate_watts'] == 3600
+    assert spec_requests == ['key']
+
+
+def test_system_specs_are_cached_between_clients(spec_requests):
+    # When
+    GivEnergy(False, 'key').extract_system_spec()
+    GivEnergy(False, 'key').extract_system_spec()
+    GivEnergy(False, 'other key').extract_system_spec()
+
+    # Then
+    assert spec_requests == ['key', 'other key']
+
+
+def test_system_specs_cache_expires(spec_requests, monkeypatch):
+    from project.api import givenergy
+
+    # Given
+    GivEnergy(False, 'key').extract_system_spec()
+    monkeypatch.setattr(givenergy, 'system_spec_ttl_seconds', 0)
+
+    # When
+    GivEnergy(False, 'key').extract_system_spec()
+
+    # Then
+    assert spec_requests == ['key', 'key']
+
+
+def test_system_specs_cache_file_and_invalidate(spec_requests, monkeypatch, tmp_path):
+    from project.api import givenergy
+
+    # Given
+    monkeypatch.setattr(givenergy, 'system_spec_cache_path', str(tmp_path / 'system_spec.json'))
+    GivEnergy(False, 'key').extract_system_spec()
+    monkeypatch.setattr(givenergy, '_system_spec_cache', {})
+
+    # When
+    GivEnergy(False, 'key').extract_system_spec()
+    giv_energy = GivEnergy(False, 'key')
+    giv_energy.invalidate_system_specs()
+    giv_energy.extract_system_spec()
+
+    # Then
+    assert spec_requests == ['key', 'key']
+    assert 'key' not in (tmp_path / 'system_spec.json').read_text()
+
+
+def test_inverter_serial_number_can_be_given(spec_requests):
+    # When
+    giv_energy = GivEnergy(False, 'key', inverter_serial_number='EA1')
+
+    # Then
+    assert giv_energy.inverter_serial_number == 'EA1'
+    assert spec_requests == []
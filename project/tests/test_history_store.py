@@ -0,0 +1,76 @@
+from datetime import datetime
+
+import pytest
+
+from project.history_store import EnergyHistoryStore, LocalHistoryBackup, split_start_time
+
+
+@pytest.fixture()
+def energy_flows():
+    return {'0': {'start_time': '2024-03-01 23:30', 'end_time': '2024-03-02 00:00', 'data': {'0': 0.1, '3': 0.2}},
+            '1': {'start_time': '2024-03-02 00:00', 'end_time': '2024-03-02 00:30', 'data': {'0': 0.3, '3': 0.4}}}
+
+
+def test_split_start_time():
+    assert split_start_time('2024-03-02 13:30') == ('2024-03-02', 27)
+
+
+def test_save_and_load_energy_flows(tmp_path, energy_flows):
+    # Given
+    history_store = EnergyHistoryStore(str(tmp_path / 'history.sqlite'))
+    day = {str(i): {'start_time': f'2024-03-01 {i // 2:02d}:{30 * (i % 2):02d}',
+                    'end_time': '', 'data': {'0': i / 10, '3': 1.0}} for i in range(48)}
+    for i, half_hour in enumerate(day.values()):
+        half_hour['end_time'] = day[str(i + 1)]['start_time'] if i < 47 else '2024-03-02 00:00'
+
+    # When
+    history_store.save_energy_flows('EA1', day)
+    history_store.save_energy_flows('EA1', energy_flows)
+
+    # Then
+    actual_result = history_store.load_energy_flows('EA1', '2024-03-01', '2024-03-02', [0, 3])
+    assert len(actual_result) == 49
+    assert actual_result['47'] == energy_flows['0']
+    assert actual_result['48'] == energy_flows['1']
+    assert history_store.load_energy_flows('EA1', '2024-03-01', '2024-03-02', [0, 3, 5]) is None
+    assert history_store.load_energy_flows('EA2', '2024-03-01', '2024-03-02', [0, 3]) is None
+
+
+def test_missing_dates(tmp_path, energy_flows):
+    # Given
+    history_store = EnergyHistoryStore(str(tmp_path / 'history.sqlite'))
+    history_store.save_energy_flows('EA1', energy_flows)
+
+    # When
+    actual_result = history_store.missing_dates('EA1', [{'start_date': '2024-03-01', 'end_date': '2024-03-02'}],
+                                                [0, 3])
+
+    # Then
+    assert actual_result == ['2024-03-01']
+
+
+def test_save_energy_flows_skips_unfinished_half_hours(tmp_path, energy_flows):
+    # Given
+    history_store = EnergyHistoryStore(str(tmp_path / 'history.sqlite'))
+
+    # When
+    saved = history_store.save_energy_flows('EA1', energy_flows, now=datetime(2024, 3, 2, 0, 10))
+
+    # Then
+    assert saved == 2
+    assert history_store.missing_dates('EA1', [{'start_date': '2024-03-02', 'end_date': '2024-03-02'}], [0, 3]) == \
+        ['2024-03-02']
+
+
+def test_history_store_restores_from_backup(tmp_path, energy_flows):
+    # Given
+    backup = LocalHistoryBackup(str(tmp_path))
+    history_store = EnergyHistoryStore(str(tmp_path / 'first.sqlite'), backup=backup)
+    history_store.save_energy_flows('EA1', energy_flows)
+    history_store.backup_store()
+
+    # When
+    restored = EnergyHistoryStore(str(tmp_path / 'second.sqlite'), backup=backup)
+
+    # Then
+    assert restored.missing_dates('EA1', [{'start_date': '2024-03-02', 'end_date': '2024-03-02'}], [0, 3]) == []
@@ -0,0 +1,97 @@
+import pytest
+import requests
+
+from project.api import http_session
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.content = b'{}'
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture()
+def fake_session(monkeypatch):
+    http_session.reset_host_stats()
+    session = http_session.get_session('https://api.example.com')
+    responses = []
+    calls = []
+
+    def request(method, url, timeout=None, **kwargs):
+        calls.append((method, url, timeout))
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    sleeps = []
+    monkeypatch.setattr(session, 'request', request)
+    monkeypatch.setattr(http_session.time, 'sleep', sleeps.append)
+    return responses, calls, sleeps
+
+
+def test_get_session_is_shared_per_host():
+    assert http_session.get_session('https://api.example.com/a') is http_session.get_session('https://api.example.com/b')
+    assert http_session.get_session('https://api.example.com') is not http_session.get_session('https://example.org')
+
+
+def test_request_retries_retryable_status_codes(fake_session):
+    # Given
+    responses, calls, sleeps = fake_session
+    retried = [FakeResponse(503), FakeResponse(429, {'Retry-After': '2'})]
+    responses += retried + [FakeResponse(200)]
+
+    # When
+    actual_result = http_session.request('GET', 'https://api.example.com/v1/thing', timeout=5)
+
+    # Then
+    assert actual_result.status_code == 200
+    assert len(calls) == 3
+    assert 0.25 <= sleeps[0] <= 0.5
+    assert sleeps[1] == 2
+    assert http_session.get_host_stats()['api.example.com']['calls'] == 3
+    assert http_session.get_host_stats()['api.example.com']['errors'] == 2
+    assert all(response.closed for response in retried)
+    assert not actual_result.closed
+
+
+def test_request_returns_last_response_when_out_of_retries(fake_session):
+    # Given
+    responses, calls, sleeps = fake_session
+    responses += [FakeResponse(500), FakeResponse(500)]
+
+    # When
+    actual_result = http_session.request('GET', 'https://api.example.com/v1/thing', retries=1)
+
+    # Then
+    assert actual_result.status_code == 500
+    assert len(calls) == 2
+
+
+def test_request_does_not_retry_client_errors(fake_session):
+    # Given
+    responses, calls, sleeps = fake_session
+    responses += [FakeResponse(404)]
+
+    # When
+    actual_result = http_session.request('GET', 'https://api.example.com/v1/thing')
+
+    # Then
+    assert actual_result.status_code == 404
+    assert sleeps == []
+
+
+def test_request_raises_connection_error_when_out_of_retries(fake_session):
+    # Given
+    responses, calls, sleeps = fake_session
+    responses += [requests.exceptions.ConnectionError('reset'), requests.exceptions.ConnectionError('reset')]
+
+    # When / Then
+    with pytest.raises(requests.exceptions.ConnectionError):
+        http_session.request('GET', 'https://api.example.com/v1/thing', retries=1)
+    assert len(calls) == 2
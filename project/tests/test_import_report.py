@@ -0,0 +1,26 @@
+from tools import import_report
+
+
+def test_update_command_does_not_import_pandas():
+    # When
+    actual_result = import_report.report(['update'])
+
+    # Then
+    assert actual_result['update']['forbidden'] == []
+    assert 'lambda_handler' in actual_result['update']['imported']
+    assert 'project.charge_update' in actual_result['update']['imported']
+
+
+def test_summarise_imports():
+    # Given
+    imports = [{'module': 'numpy.core', 'self_us': 3000, 'cumulative_us': 3000, 'depth': 1},
+               {'module': 'numpy', 'self_us': 1000, 'cumulative_us': 4000, 'depth': 0},
+               {'module': 'json', 'self_us': 500, 'cumulative_us': 500, 'depth': 0}]
+
+    # When
+    actual_result = import_report.summarise_imports(imports, top=1)
+
+    # Then
+    assert actual_result['total_ms'] == 4.5
+    assert actual_result['slowest_packages'] == [{'package': 'numpy', 'ms': 4.0}]
+    assert actual_result['imported'] == ['json', 'numpy', 'numpy.core']
@@ -40,4 +40,25 @@ def test_handler_update():
     handler(event_data, None)
 
     # Then
-    assert 1 == 1
\ No newline at end of file
+    assert 1 == 1
+
+
+def test_handler_calculate_uses_the_event_engine(monkeypatch):
+    # Given
+    import main
+    os.environ["OFFLINE_DEBUG"] = "true"
+    engines = []
+    plan_charging = main.plan_charging
+
+    def recording_plan_charging(*args, **kwargs):
+        engines.append((kwargs['engine'], kwargs['max_charge_windows']))
+        return plan_charging(*args, **kwargs)
+
+    monkeypatch.setattr(main, 'plan_charging', recording_plan_charging)
+    event_data = {"msg": "calculate", "data": "", "engine": "exact", "max_charge_windows": 2}
+
+    # When
+    handler(event_data, None)
+
+    # Then
+    assert engines == [('exact', 2)]
@@ -625,6 +625,37 @@ def test_extract_half_hour_data(giv_energy_usage_data, extract_half_hour_data_re
     assert actual_result == expected_result
 
 
+def test_decode_energy_flows(giv_energy_usage_data, extract_half_hour_data_result):
+    # Given
+    input_data = giv_energy_usage_data
+
+    # When
+    flows, times = decode_energy_flows(input_data, [0, 3, 5])
+
+    # Then
+    assert flows.shape == (4, 96, 3)
+    assert flows.sum(axis=2).tolist() == extract_half_hour_data_result
+    assert times[0].strftime('%H:%M') == '00:00'
+    assert times[-1].strftime('%H:%M') == '23:30'
+    assert len(input_data[0]) == 97
+
+
+def test_decode_energy_flows_pads_a_short_day(giv_energy_usage_data, extract_half_hour_data_result):
+    # Given
+    short_day = dict(list(giv_energy_usage_data[1].items())[:40])
+    input_data = [short_day] + giv_energy_usage_data[1:]
+
+    # When
+    flows, times = decode_energy_flows(input_data, [0, 3, 5])
+
+    # Then
+    assert flows.shape == (4, 96, 3)
+    assert flows[0, :40].sum(axis=1).tolist() == extract_half_hour_data_result[1][:40]
+    assert np.isnan(flows[0, 40:]).all()
+    assert flows[1:].sum(axis=2).tolist() == extract_half_hour_data_result[1:]
+    assert len(times) == 96
+
+
 def test_add_to_df(giv_energy_usage_data, extract_half_hour_data_result):
     # Given
     input_data = giv_energy_usage_data
@@ -639,3 +670,228 @@ def test_add_to_df(giv_energy_usage_data, extract_half_hour_data_result):
     expected_result = False
 
     assert actual_result == expected_result
+
+
+def test_simulate_running_battery_capacity():
+    # Given
+    charged_energy = [0.5, -1.3, -1.3, 1.0, 6.0]
+
+    # When
+    running, corrected = simulate_running_battery_capacity(charged_energy, 7.0, 9.0, 3.6)
+
+    # Then
+    assert running.tolist() == pytest.approx([6.5, 7.8, 8.5, 6.2, 0.2])
+    assert corrected.tolist() == pytest.approx([0.5, -1.3, -0.7, 2.3, 6.0])
+
+
+def test_simulate_running_battery_capacity_clamps_at_zero():
+    # Given
+    charged_energy = [1.0, 2.0, 0.5]
+
+    # When
+    running, corrected = simulate_running_battery_capacity(charged_energy, 1.5, 9.0, 3.6)
+
+    # Then
+    assert running.tolist() == pytest.approx([0.5, 0.0, 0.0])
+    assert corrected.tolist() == pytest.approx(charged_energy)
+
+
+def test_simulate_from_slot_settles_where_the_levels_meet_again():
+    # Given
+    import main
+    charged_energy = np.array([0.5, 1.0, 3.0, 3.0, 0.5, 0.5])
+    running, corrected = simulate_running_battery_capacity(charged_energy, 5.0, 9.0, 3.6)
+    charged_energy[1] -= 1.8
+    expected_running, expected_corrected = simulate_running_battery_capacity(charged_energy, 5.0, 9.0, 3.6)
+    running[5] = -1.0
+
+    # When
+    main._simulate_from_slot(charged_energy, running, corrected, 1, 5.0, 9.0, 3.6, settle=True)
+
+    # Then
+    # the battery empties in slot 3 either way, so the slots after it aren't visited
+    assert running[:5].tolist() == pytest.approx(expected_running[:5].tolist())
+    assert running[5] == -1.0
+    assert corrected.tolist() == pytest.approx(expected_corrected.tolist())
+
+
+def test_calculate_running_battery_capacity():
+    # Given
+    df = pd.DataFrame({'charged_energy': [0.5, -1.3, -1.3, 1.0, 6.0]})
+
+    # When
+    actual_result = calculate_running_battery_capacity(df, 7.0, 9.0, 3.6)
+
+    # Then
+    assert list(actual_result.columns) == ['charged_energy', 'running_battery_capacity']
+    assert actual_result['running_battery_capacity'].tolist() == pytest.approx([6.5, 7.8, 8.5, 6.2, 0.2])
+
+
+def test_determine_optimal_charging_periods_exact_engine():
+    # Given
+    df = pd.DataFrame({'energy': [0.5, 0.5, 1.0, 1.0, 1.0, 1.0],
+                       'value_inc_vat': [30, 10, 5, 20, 1, 40]})
+
+    # When
+    actual_result = determine_optimal_charging_periods(df, 4.0, 9.0, 2.0, 3.6, engine='exact')
+
+    # Then
+    assert {'charge', 'charged_energy', 'running_battery_capacity'} <= set(actual_result.columns)
+    assert actual_result['charge'].tolist() == [False, False, True, False, True, False]
+    assert actual_result['running_battery_capacity'].iloc[2:].min() >= 2.0
+
+
+def test_determine_optimal_charging_periods_heap_repair_matches_dataframe_repair():
+    # Given
+    rng = np.random.default_rng(7)
+    df = pd.DataFrame({'energy': rng.uniform(0, 1.5, 96),
+                       'value_inc_vat': rng.uniform(-2, 40, 96).round(2)})
+
+    # When
+    expected_result = determine_optimal_charging_periods(df.copy(), 0.5, 9.2, 2, 3.6, repair='dataframe')
+    actual_result = determine_optimal_charging_periods(df.copy(), 0.5, 9.2, 2, 3.6, repair='heap')
+
+    # Then
+    pd.testing.assert_frame_equal(actual_result, expected_result)
+
+
+def test_greedy_engine_plans_the_whole_of_a_longer_horizon():
+    # Given
+    rng = np.random.default_rng(3)
+    df = pd.DataFrame({'energy': rng.uniform(0, 1.5, 94),
+                       'value_inc_vat': rng.uniform(-2, 40, 94).round(2)})
+
+    # When
+    actual_result = determine_optimal_charging_periods(df.copy(), 1.0, 9.2, 2, 3.6)
+
+    # Then
+    assert len(actual_result) == 94
+    assert actual_result['running_battery_capacity'].iloc[2:].min() >= 2
+    assert actual_result['charge'].iloc[48:].any()
+
+
+def test_greedy_engine_charges_less_today_when_tomorrow_is_cheaper():
+    # Given
+    today = [30.0] * 48
+    df = pd.DataFrame({'energy': [0.3] * 94})
+
+    # When
+    flat = determine_optimal_charging_periods(df.assign(value_inc_vat=today + [30.0] * 46), 9.0, 9.2, 2, 3.6)
+    cheap_tomorrow = determine_optimal_charging_periods(df.assign(value_inc_vat=today + [2.0] * 46),
+                                                        9.0, 9.2, 2, 3.6)
+
+    # Then
+    assert cheap_tomorrow['running_battery_capacity'].iloc[2:].min() >= 2
+    assert cheap_tomorrow['charge'].iloc[:48].sum() < flat['charge'].iloc[:48].sum()
+
+
+def test_exact_engine_plans_the_whole_horizon():
+    # Given, tomorrow is far cheaper than today
+    df = pd.DataFrame({'energy': [0.3] * 94,
+                       'value_inc_vat': [30.0] * 48 + [2.0] * 46})
+
+    # When
+    actual_result = determine_optimal_charging_periods(df, 9.0, 9.2, 2, 3.6, engine='exact')
+
+    # Then
+    assert len(actual_result) == 94
+    assert actual_result['running_battery_capacity'].iloc[2:].min() >= 2
+    assert actual_result['charge'].iloc[:48].sum() < actual_result['charge'].iloc[48:].sum()
+
+
+def test_tile_daily_profile_repeats_the_same_slot_of_the_day():
+    # Given
+    df = pd.DataFrame({'timer': np.arange(4, 60) * 0.5,
+                       'hours': [f"{(i // 2) % 24:02d}:{(i % 2) * 30:02d}" for i in range(4, 60)],
+                       'energy': np.arange(4, 60) / 10})
+
+    # When
+    actual_result = tile_daily_profile(df, 94)
+
+    # Then
+    assert len(actual_result) == 94
+    assert actual_result['timer'].tolist() == (np.arange(4, 98) * 0.5).tolist()
+    assert actual_result['hours'].iloc[56:].tolist() == actual_result['hours'].iloc[8:46].tolist()
+    assert actual_result['energy'].iloc[56:].tolist() == actual_result['energy'].iloc[8:46].tolist()
+    pd.testing.assert_frame_equal(actual_result.iloc[:56], df)
+
+
+class FakeEnergyFlows:
+    """
+    Stand in for GivEnergy that generates energy-flows responses for any date range.
+    Requests longer than 2 days leave out the half hours on missing_dates
+    """
+    def __init__(self, missing_dates=()):
+        self.inverter_serial_number = 'EA2302G694'
+        self.requests = []
+        self.missing_dates = missing_dates
+
+    def get_energy_usage(self, start_date, end_date, e_types):
+        self.requests.append((start_date, end_date))
+        start = datetime.strptime(start_date, '%Y-%m-%d')
+        slots = (datetime.strptime(end_date, '%Y-%m-%d') - start).days * 48 + 1
+        data = {}
+        for i in range(slots):
+            slot_start = start + timedelta(minutes=30 * i)
+            if slots > 97 and slot_start.strftime('%Y-%m-%d') in self.missing_dates:
+                continue
+            data[str(len(data))] = {'start_time': slot_start.strftime('%Y-%m-%d %H:%M'),
+                                    'end_time': (slot_start + timedelta(minutes=30)).strftime('%Y-%m-%d %H:%M'),
+                                    'data': {str(e_type): round(((slot_start.day + slot_start.hour) % 7) * 0.1, 2)
+                                             for e_type in e_types}}
+        return {'data': data}
+
+    def get_energy_usage_ranges(self, date_ranges, e_types, max_workers=None, raise_errors=True):
+        return [self.get_energy_usage(dates['start_date'], dates['end_date'], e_types) for dates in date_ranges]
+
+
+def test_get_energy_usage_span_matches_individual_requests():
+    # Given
+    previous_dates = [{'start_date': f'2024-03-{day:02d}', 'end_date': f'2024-03-{day + 2:02d}'}
+                      for day in range(20, 1, -1)]
+
+    # When
+    expected_result = extract_half_hour_data(get_energy_usage_days(FakeEnergyFlows(), previous_dates, [0, 1, 2],
+                                                                   single_span=False))
+    giv_energy = FakeEnergyFlows()
+    actual_result = extract_half_hour_data(get_energy_usage_span(giv_energy, previous_dates, [0, 1, 2],
+                                                                 max_span_days=14))
+
+    # Then
+    assert actual_result == expected_result
+    assert giv_energy.requests == [('2024-03-02', '2024-03-16'), ('2024-03-16', '2024-03-22')]
+
+
+def test_get_energy_usage_span_requests_missing_ranges_individually():
+    # Given
+    previous_dates = [{'start_date': f'2024-03-{day:02d}', 'end_date': f'2024-03-{day + 2:02d}'}
+                      for day in range(10, 1, -1)]
+    giv_energy = FakeEnergyFlows(missing_dates=('2024-03-11',))
+
+    # When
+    actual_result = get_energy_usage_span(giv_energy, previous_dates, [0, 1, 2], max_span_days=7)
+
+    # Then
+    assert giv_energy.requests[2:] == [('2024-03-10', '2024-03-12'), ('2024-03-09', '2024-03-11')]
+    assert all(len(day) == 97 for day in actual_result)
+
+
+def test_get_energy_usage_from_store_only_requests_missing_days(tmp_path):
+    # Given
+    previous_dates = [{'start_date': f'2024-03-{day:02d}', 'end_date': f'2024-03-{day + 2:02d}'}
+                      for day in range(10, 1, -1)]
+    history_store = EnergyHistoryStore(str(tmp_path / 'history.sqlite'))
+    expected_result = extract_half_hour_data(get_energy_usage_days(FakeEnergyFlows(), previous_dates, [0, 3, 5],
+                                                                   single_span=False))
+
+    # When
+    cold = FakeEnergyFlows()
+    cold_result = extract_half_hour_data(get_energy_usage_from_store(cold, history_store, previous_dates, [0, 3, 5]))
+    warm = FakeEnergyFlows()
+    warm_result = extract_half_hour_data(get_energy_usage_from_store(warm, history_store, previous_dates, [0, 3, 5]))
+
+    # Then
+    assert cold.requests == [('2024-03-02', '2024-03-13')]
+    assert warm.requests == []
+    assert cold_result == expected_result
+    assert warm_result == expected_result
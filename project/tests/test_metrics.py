@@ -0,0 +1,84 @@
+import json
+
+import pandas as pd
+import pytest
+
+import main
+from project import metrics
+from project.api import http_session
+from project.metrics import Metrics, validate_emf_record
+
+
+@pytest.fixture()
+def run_metrics():
+    yield metrics.start_invocation('calculate', enabled=True)
+    metrics.start_invocation(None, enabled=False)
+
+
+def test_records_are_valid_emf(run_metrics):
+    # Given
+    with run_metrics.stage('optimize'):
+        pass
+    timed_sum = run_metrics.timed('forecast', sum)
+    timed_sum([1, 2])
+    run_metrics.put('slots_charged', 6)
+    http_session._record('api.octopus.energy', 0.2, 1024)
+    http_session._record('api.octopus.energy', 0.4, 2048, error=True)
+
+    # When
+    lines = []
+    records = run_metrics.flush(write=lines.append)
+
+    # Then
+    assert len(lines) == 2
+    for line in lines:
+        validate_emf_record(line)
+    stages, octopus = [json.loads(line) for line in lines]
+    assert stages['Command'] == 'calculate'
+    assert stages['slots_charged'] == 6
+    assert {'optimize_ms', 'forecast_ms', 'total_ms'} <= set(stages)
+    assert octopus['Api'] == 'Octopus'
+    assert octopus['http_calls'] == 2
+    assert octopus['http_errors'] == 1
+    assert octopus['http_bytes'] == 3072
+    assert octopus['http_max_ms'] == pytest.approx(400)
+    assert octopus['_aws']['CloudWatchMetrics'][0]['Dimensions'] == [['Command', 'Api']]
+    assert records[0] == stages
+
+
+def test_disabled_metrics_do_nothing():
+    # Given
+    run_metrics = Metrics('update', enabled=False)
+
+    # When
+    with run_metrics.stage('inverter_update'):
+        run_metrics.put('slots_charged', 1)
+
+    # Then
+    assert run_metrics.timed('forecast', sum) is sum
+    assert run_metrics.flush(write=pytest.fail) == []
+
+
+def test_validate_emf_record_rejects_missing_values():
+    # Given
+    record = {'_aws': {'Timestamp': 1, 'CloudWatchMetrics': [{'Namespace': 'SmartPower', 'Dimensions': [['Command']],
+                                                              'Metrics': [{'Name': 'total_ms', 'Unit': 'Milliseconds'}]}]},
+              'Command': 'calculate'}
+
+    # When / Then
+    with pytest.raises(ValueError, match='total_ms'):
+        validate_emf_record(record)
+
+
+@pytest.mark.parametrize('repair', ['heap', 'dataframe'])
+def test_greedy_engine_records_repair_rounds(run_metrics, repair):
+    # Given
+    df = pd.DataFrame({'energy': [0.5, 0.5, 1.0, 1.0, -3.0, -3.0],
+                       'value_inc_vat': [30.0, 40.0, 35.0, 45.0, 5.0, 6.0]})
+
+    # When
+    actual_result = main.determine_optimal_charging_periods(df, 3.0, 9.0, 2, 3.6, repair=repair)
+
+    # Then
+    assert actual_result['charge'].tolist() == [True, False, True, False, True, True]
+    assert run_metrics.values['repair_rounds'] == 2
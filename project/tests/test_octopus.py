@@ -0,0 +1,143 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from project.api import octopus as octopus_module
+from project.api.octopus import AgileRates, Octopus, published_until
+
+
+def make_rates(start, slots):
+    return [{'value_inc_vat': float(i),
+             'valid_from': (start + timedelta(minutes=30 * i)).strftime('%Y-%m-%dT%H:%M:%SZ'),
+             'valid_to': (start + timedelta(minutes=30 * (i + 1))).strftime('%Y-%m-%dT%H:%M:%SZ')}
+            for i in range(slots)]
+
+
+@pytest.fixture()
+def tariff_requests(monkeypatch, tmp_path):
+    """
+    Serve rates up to the end of the published day, tomorrow only after 16:00 UK time
+    """
+    monkeypatch.setattr(octopus_module, 'tariff_cache_path', str(tmp_path / 'tariff_cache.json'))
+    monkeypatch.setattr(octopus_module, '_tariff_cache', {})
+    requests = []
+    published = {'until': datetime(2024, 3, 5)}
+
+    def get_tariff_data(self, period_from=None, period_to=None):
+        requests.append((period_from, period_to))
+        end = min(period_to, published['until'])
+        slots = max(int((end - period_from).total_seconds() // 1800), 0)
+        # the API returns the newest rates first
+        return {'results': make_rates(period_from, slots)[::-1]}
+
+    monkeypatch.setattr(Octopus, 'get_tariff_data', get_tariff_data)
+    return requests, published
+
+
+def test_get_agile_rates_only_requests_when_new_prices_can_exist(tariff_requests):
+    # Given
+    requests, published = tariff_requests
+    octopus = Octopus(False, 'api_key')
+    period_from = datetime(2024, 3, 4, 10)
+
+    # When
+    first = octopus.get_agile_rates(period_from, period_from + timedelta(hours=24), now=datetime(2024, 3, 4, 10))
+    cached = octopus.get_agile_rates(period_from, period_from + timedelta(hours=24), now=datetime(2024, 3, 4, 15))
+    published['until'] = datetime(2024, 3, 6)
+    refreshed = octopus.get_agile_rates(period_from, period_from + timedelta(hours=24),
+                                        now=datetime(2024, 3, 4, 16, 5))
+
+    # Then
+    assert requests == [(datetime(2024, 3, 4, 10), datetime(2024, 3, 6)),
+                        (datetime(2024, 3, 5), datetime(2024, 3, 6))]
+    assert len(first) == len(cached) == 28
+    assert len(refreshed) == 48
+    assert refreshed.results[0]['valid_from'] == '2024-03-04T10:00:00Z'
+
+
+def test_get_agile_rates_checks_again_when_fetched_before_publication(tariff_requests):
+    # Given
+    requests, published = tariff_requests
+    octopus = Octopus(False, 'api_key')
+    period_from = datetime(2024, 3, 4, 16)
+    early = octopus.get_agile_rates(period_from, period_from + timedelta(hours=24), now=datetime(2024, 3, 4, 16, 5))
+
+    # When
+    throttled = octopus.get_agile_rates(period_from, period_from + timedelta(hours=24),
+                                        now=datetime(2024, 3, 4, 16, 10))
+    published['until'] = datetime(2024, 3, 6)
+    refreshed = [octopus.get_agile_rates(period_from + timedelta(hours=hours), period_from + timedelta(hours=24),
+                                         now=period_from + timedelta(hours=hours))
+                 for hours in (0.5, 2, 7.5)]
+
+    # Then
+    assert len(requests) == 2
+    assert requests[1] == (datetime(2024, 3, 5), datetime(2024, 3, 6))
+    assert len(early) == len(throttled) == 16
+    assert [len(rates) for rates in refreshed] == [47, 44, 33]
+
+
+def test_get_agile_rates_reads_the_cache_file(tariff_requests, monkeypatch):
+    # Given
+    requests, published = tariff_requests
+    published['until'] = datetime(2024, 3, 6)
+    period_from = datetime(2024, 3, 4, 18)
+    Octopus(False, 'api_key').get_agile_rates(period_from, period_from + timedelta(hours=24),
+                                              now=datetime(2024, 3, 4, 17))
+    monkeypatch.setattr(octopus_module, '_tariff_cache', {})
+
+    # When
+    rates = Octopus(False, 'api_key').get_agile_rates(period_from + timedelta(hours=1),
+                                                      period_from + timedelta(hours=25), now=datetime(2024, 3, 4, 19))
+
+    # Then
+    assert len(requests) == 1
+    assert len(rates) == 48
+
+
+def test_agile_rates_slot_index():
+    # Given
+    rates = AgileRates(make_rates(datetime(2024, 3, 4, 10), 4)[::-1])
+
+    # When / Then
+    assert rates.slot_index(datetime(2024, 3, 4, 10)) == 0
+    assert rates.slot_index(datetime(2024, 3, 4, 11, 15)) == 2
+    assert rates.slot_index(datetime(2024, 3, 4, 9, 59)) is None
+    assert rates.slot_index(datetime(2024, 3, 4, 12)) is None
+
+
+def test_published_until_follows_uk_time():
+    # When / Then
+    assert published_until(datetime(2024, 1, 10, 12)) == datetime(2024, 1, 10, 23)
+    assert published_until(datetime(2024, 1, 10, 16)) == datetime(2024, 1, 11, 23)
+    assert published_until(datetime(2024, 7, 10, 14)) == datetime(2024, 7, 10, 22)
+    assert published_until(datetime(2024, 7, 10, 15)) == datetime(2024, 7, 11, 22)
+
+
+def test_get_historic_rates_follows_pages(monkeypatch):
+    # Given
+    rates = make_rates(datetime(2024, 3, 4), 5)
+    pages = {None: {'results': rates[:3], 'next': 'https://api.octopus.energy/page2'},
+             'https://api.octopus.energy/page2': {'results': rates[3:], 'next': None}}
+    requests = []
+
+    class Response:
+        def __init__(self, page):
+            self.page = page
+
+        def json(self):
+            return self.page
+
+    def request(method, url, **kwargs):
+        requests.append(kwargs['params'])
+        return Response(pages[url if 'page2' in url else None])
+
+    monkeypatch.setattr(octopus_module.http_session, 'request', request)
+
+    # When
+    actual_result = Octopus(False, 'key').get_historic_rates(datetime(2024, 3, 4), datetime(2024, 3, 4, 2, 30))
+
+    # Then
+    assert len(actual_result) == 5
+    assert requests[0]['page_size'] == octopus_module.historic_page_size
+    assert requests[1] is None
@@ -0,0 +1,135 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+import main
+from project import profiles as profiles_module
+from project.history_store import EnergyHistoryStore
+from project.profiles import ProfileAggregator, ProfileWindow
+
+
+@pytest.fixture()
+def profile_store(tmp_path, monkeypatch):
+    monkeypatch.setattr(profiles_module, 'profile_store_path', str(tmp_path / 'profiles.json'))
+    profiles_module.clear_profiles()
+    yield tmp_path / 'profiles.json'
+    profiles_module.clear_profiles()
+
+
+def test_profile_window_evicts_by_size_and_keeps_running_sum():
+    # Given
+    window = ProfileWindow(3, 30)
+
+    # When
+    for day in range(5):
+        window.add(f'2024-03-0{day + 1}', np.full(48, float(day)))
+
+    # Then
+    assert len(window) == 3
+    assert window.mean() == pytest.approx(np.full(48, 3.0))
+    assert window.quantile(0.5) == pytest.approx(np.full(48, 3.0))
+
+
+def test_profile_window_evicts_days_older_than_span():
+    # Given
+    window = ProfileWindow(4, 28)
+    window.add('2024-03-01', np.ones(48))
+
+    # When
+    window.add('2024-03-29', np.full(48, 3.0))
+
+    # Then
+    assert len(window) == 1
+    assert window.mean() == pytest.approx(np.full(48, 3.0))
+
+
+def test_profile_aggregator_matches_recomputed_means():
+    # Given
+    rng = np.random.default_rng(1)
+    start = datetime(2024, 3, 1)
+    dates = [(start + timedelta(days=day)).strftime('%Y-%m-%d') for day in range(60)]
+    consumption = rng.random((60, 48))
+    solar = rng.random((60, 48))
+    profiles = ProfileAggregator(weeks=4, solar_days=40)
+
+    # When
+    for date, day_consumption, day_solar in zip(dates, consumption, solar):
+        profiles.add_day(date, day_consumption, day_solar)
+
+    # Then
+    assert profiles.solar_profile() == pytest.approx(solar[-40:].mean(axis=0))
+    assert profiles.solar_profile(0.9) == pytest.approx(np.quantile(solar[-40:], 0.9, axis=0))
+    # 2024-04-29 is the last day added, a Monday, so the last 4 Mondays are every 7th day back from it
+    assert profiles.consumption_profile('2024-05-06') == pytest.approx(consumption[[59, 52, 45, 38]].mean(axis=0))
+    assert profiles.consumption_profile('2024-05-06', 0.5) == \
+        pytest.approx(np.median(consumption[[59, 52, 45, 38]], axis=0))
+
+
+def test_profile_aggregator_ignores_days_already_added():
+    # Given
+    profiles = ProfileAggregator()
+    profiles.add_day('2024-03-02', np.ones(48), np.ones(48))
+
+    # When
+    added = profiles.add_day('2024-03-01', np.zeros(48), np.zeros(48))
+
+    # Then
+    assert added is False
+    assert profiles.solar_profile() == pytest.approx(np.ones(48))
+
+
+def test_profile_aggregator_missing_dates():
+    # Given
+    profiles = ProfileAggregator(weeks=1, solar_days=3)
+
+    # When / Then
+    assert profiles.missing_dates('2024-03-10') == [f'2024-03-{day:02d}' for day in range(4, 11)]
+    profiles.add_day('2024-03-08', np.ones(48), np.ones(48))
+    assert profiles.missing_dates('2024-03-10') == ['2024-03-09', '2024-03-10']
+
+
+def test_profiles_persist_to_file(profile_store):
+    # Given
+    profiles = profiles_module.load_profiles('EA1')
+    profiles.add_day('2024-03-01', np.full(48, 2.0), np.ones(48))
+    profiles_module.save_profiles()
+
+    # When
+    profiles_module._profiles.clear()
+    actual_result = profiles_module.load_profiles('EA1')
+
+    # Then
+    assert actual_result is not profiles
+    assert actual_result.last_date == '2024-03-01'
+    assert actual_result.consumption_profile('2024-03-08') == pytest.approx(np.full(48, 2.0))
+    assert actual_result.solar_profile() == pytest.approx(np.ones(48))
+
+
+def test_analyse_energy_profiles_reads_only_new_days(profile_store, tmp_path):
+    # Given
+    history_store = EnergyHistoryStore(str(tmp_path / 'history.sqlite'))
+    start = datetime.combine(datetime.today().date(), datetime.min.time()) - timedelta(days=50)
+    history_store.save_energy_flows('EA1', {
+        str(i): {'start_time': (start + timedelta(minutes=30 * i)).strftime('%Y-%m-%d %H:%M'),
+                 'end_time': (start + timedelta(minutes=30 * (i + 1))).strftime('%Y-%m-%d %H:%M'),
+                 'data': {'0': 0.1, '1': 0.2, '2': 0.0, '3': 0.3, '5': 0.4}}
+        for i in range(50 * 48 + 1)})
+
+    class FakeGivEnergy:
+        inverter_serial_number = 'EA1'
+
+        def get_energy_usage_ranges(self, *args, **kwargs):
+            raise AssertionError("every day is in the history store")
+
+    time_offsets = {'giv_energy_time': 0, 'local_time': 0}
+
+    # When
+    df_consumption, df_solar = main.analyse_energy_profiles(FakeGivEnergy(), 4, 40, time_offsets, history_store)
+
+    # Then
+    assert df_consumption['avg_consumption_kwh'].tolist() == pytest.approx([0.8] * len(df_consumption.index))
+    assert df_solar['avg_production_kwh'].tolist() == pytest.approx([0.3] * len(df_solar.index))
+    assert df_consumption['timer'].tolist() == df_solar['timer'].tolist()
+    assert profiles_module.load_profiles('EA1').missing_dates(
+        (datetime.today() - timedelta(days=1)).strftime('%Y-%m-%d')) == []
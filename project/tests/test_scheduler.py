@@ -0,0 +1,82 @@
+from datetime import datetime
+
+from project.api.scheduler import LocalSchedulerClient, OneShotScheduler, next_occurrence
+
+aws_fields = {'region': 'eu-west-2', 'account_id': '1'}
+
+
+def make_windows(*times):
+    return [{'from_hours_giv': start, 'too_hours_giv': end, 'from_hours_aws': start, 'too_hours_aws': end}
+            for start, end in times]
+
+
+def test_next_occurrence_rolls_over_midnight():
+    # When / Then
+    assert next_occurrence('17:30', datetime(2024, 3, 4, 16, 10)) == datetime(2024, 3, 4, 17, 30)
+    assert next_occurrence('02:00', datetime(2024, 3, 4, 16, 10)) == datetime(2024, 3, 5, 2, 0)
+    assert next_occurrence('16:10', datetime(2024, 3, 4, 16, 10)) == datetime(2024, 3, 5, 16, 10)
+
+
+def test_schedule_windows_registers_every_update_at_once():
+    # Given
+    client = LocalSchedulerClient()
+    scheduler = OneShotScheduler(client, 'arn:aws:iam::1:role/scheduler')
+    windows = make_windows(('23:00', '23:30'), ('01:00', '02:00'), ('04:00', '05:00'), ('13:00', '14:00'),
+                           ('15:00', '15:30'))
+
+    # When
+    actual_result = scheduler.schedule_windows(windows, 2, aws_fields, now=datetime(2024, 3, 4, 22, 0))
+
+    # Then
+    assert len(actual_result['created']) == 2
+    assert client.calls == {'list_schedules': 1, 'create_schedule': 2, 'delete_schedule': 0}
+    assert client.due_events(datetime(2024, 3, 5, 1, 59)) == []
+    assert client.due_events(datetime(2024, 3, 5, 2, 0)) == [{'msg': 'update', 'data': windows[2:4], 'chain': False}]
+    assert client.due_events(datetime(2024, 3, 5, 14, 0)) == [{'msg': 'update', 'data': windows[4:], 'chain': False}]
+
+
+def test_sync_is_idempotent_and_deletes_stale_schedules():
+    # Given
+    client = LocalSchedulerClient()
+    scheduler = OneShotScheduler(client, 'arn:aws:iam::1:role/scheduler')
+    now = datetime(2024, 3, 4, 16, 30)
+    first = [('18:00', {'msg': 'update', 'data': make_windows(('19:00', '19:30'))}),
+             ('20:00', {'msg': 'update', 'data': make_windows(('21:00', '21:30'))})]
+    scheduler.sync(first, aws_fields, now)
+
+    # When
+    repeated = scheduler.sync(first, aws_fields, now)
+    replanned = scheduler.sync(first[:1], aws_fields, now)
+
+    # Then
+    assert repeated == {'created': [], 'deleted': []}
+    assert replanned['created'] == []
+    assert len(replanned['deleted']) == 1
+    assert client.calls['create_schedule'] == 2
+    assert [name for _, name in client.schedules] == scheduler.list_schedule_names()
+    assert len(client.schedules) == 1
+
+
+def test_sync_treats_a_schedule_that_already_fired_as_deleted():
+    # Given
+    client = LocalSchedulerClient()
+    scheduler = OneShotScheduler(client, 'arn:aws:iam::1:role/scheduler')
+    scheduler.sync([('18:00', {'msg': 'update', 'data': make_windows(('19:00', '19:30'))})], aws_fields,
+                   datetime(2024, 3, 4, 16, 30))
+    list_schedule_names = scheduler.list_schedule_names
+
+    def list_then_fire():
+        names = list_schedule_names()
+        # the schedule fires and deletes itself before sync gets to it
+        client.due_events(datetime(2024, 3, 4, 18, 0))
+        return names
+
+    scheduler.list_schedule_names = list_then_fire
+
+    # When
+    actual_result = scheduler.sync([], aws_fields, datetime(2024, 3, 4, 17, 59))
+
+    # Then
+    assert len(actual_result['deleted']) == 1
+    assert client.calls['delete_schedule'] == 1
+    assert client.schedules == {}
@@ -0,0 +1,112 @@
+from datetime import datetime
+
+import numpy as np
+import pytest
+import pytz
+
+from project import solar_geometry
+
+
+@pytest.fixture()
+def table_directory(tmp_path, monkeypatch):
+    monkeypatch.setattr(solar_geometry, 'solar_table_directory', str(tmp_path))
+    solar_geometry.clear_solar_tables()
+    yield tmp_path
+    solar_geometry.clear_solar_tables()
+
+
+def test_table_slots_index_by_utc_day_of_leap_year():
+    # When / Then
+    assert solar_geometry.table_slots(datetime(2025, 1, 1, 0, 0), 2).tolist() == [0, 1]
+    assert solar_geometry.table_slots(datetime(2025, 3, 1, 12, 45), 1).tolist() == [60 * 48 + 25]
+    assert solar_geometry.table_slots(datetime(2025, 12, 31, 23, 30), 2).tolist() == [366 * 48 - 1, 0]
+
+
+def test_table_slots_skip_29_february_outside_leap_years():
+    # When / Then
+    assert solar_geometry.table_slots(datetime(2025, 2, 28, 23, 30), 2).tolist() == [59 * 48 - 1, 60 * 48]
+    assert solar_geometry.table_slots(datetime(2024, 2, 28, 23, 30), 2).tolist() == [59 * 48 - 1, 59 * 48]
+
+
+def test_table_slots_converts_local_time_to_utc():
+    # Given
+    midnight = pytz.timezone('Europe/London').localize(datetime(2025, 7, 1))
+
+    # When
+    actual_result = solar_geometry.table_slots(midnight, 1)
+
+    # Then
+    assert actual_result.tolist() == [solar_geometry.table_slots(datetime(2025, 6, 30, 23), 1)[0]]
+
+
+def test_clearsky_production_from_saved_table(table_directory, monkeypatch):
+    # Given
+    monkeypatch.setattr(solar_geometry, 'pvlib', None)
+    table = np.zeros((3, 366 * 48), dtype=np.float32)
+    table[2] = 500
+    np.save(solar_geometry.solar_table_path(54.0, -2.8), table)
+
+    # When
+    actual_result = solar_geometry.clearsky_production(datetime(2025, 6, 1, 12), 4, 4.0, 54.0, -2.8)
+
+    # Then
+    assert actual_result == pytest.approx([4.0 * 0.5 * solar_geometry.performance_ratio * 0.5] * 4)
+
+
+def test_clearsky_production_without_table_or_pvlib(table_directory, monkeypatch):
+    # Given
+    monkeypatch.setattr(solar_geometry, 'pvlib', None)
+
+    # When
+    actual_result = solar_geometry.clearsky_production(datetime(2025, 6, 1, 12), 4, 4.0, 54.0, -2.8)
+
+    # Then
+    assert actual_result is None
+
+
+def test_build_solar_table_command_without_pvlib(table_directory, monkeypatch):
+    # Given
+    from tools import build_solar_table
+    monkeypatch.setattr(solar_geometry, 'pvlib', None)
+
+    # When
+    actual_result = build_solar_table.main_cli(['--directory', str(table_directory)])
+
+    # Then
+    assert actual_result == 1
+    assert list(table_directory.iterdir()) == []
+
+
+def test_build_solar_table_is_saved_and_reused(table_directory):
+    pytest.importorskip('pvlib')
+
+    # When
+    table = solar_geometry.load_solar_table(54.0466, -2.8007)
+    solar_geometry.clear_solar_tables()
+    actual_result = solar_geometry.load_solar_table(54.0466, -2.8007)
+
+    # Then
+    assert table.shape == (3, 366 * 48)
+    assert np.array_equal(actual_result, table)
+    midsummer_noon = solar_geometry.table_slots(datetime(2024, 6, 21, 12, 0), 1)[0]
+    midwinter_midnight = solar_geometry.table_slots(datetime(2024, 12, 21, 0, 0), 1)[0]
+    assert table[0, midsummer_noon] > 55
+    assert table[2, midsummer_noon] > 700
+    assert table[2, midwinter_midnight] == 0
+
+
+def test_analyse_clearsky_production_halves_clear_sky_for_the_bias(table_directory, monkeypatch):
+    # Given
+    import main
+    monkeypatch.setattr(solar_geometry, 'pvlib', None)
+    table = np.zeros((3, 366 * 48), dtype=np.float32)
+    table[2] = 1000
+    np.save(solar_geometry.solar_table_path(solar_geometry.solar_latitude, solar_geometry.solar_longitude), table)
+
+    # When
+    actual_result = main.analyse_clearsky_production({'giv_energy_time': 0, 'local_time': 0}, 2.0)
+
+    # Then
+    assert actual_result['avg_production_kwh'].tolist() == \
+        pytest.approx([2.0 * solar_geometry.performance_ratio * 0.5 * 0.5] * len(actual_result.index))
+    assert actual_result['timer'].max() == 47.5
@@ -0,0 +1,294 @@
+"""
+Offline benchmarks for the stages of main.calculate_charge_windows.
+
+Every stage runs on the offline fixtures in project/example_responses, or on synthetic data scaled from them,
+so no API keys or network are needed. Run from the repository root:
+
+    python -m tools.benchmark --output benchmark.json
+    python -m tools.benchmark --baseline benchmark.json --threshold 0.25
+
+Results are written as JSON. Every run is compared with a baseline, tools/benchmark_baseline.json unless
+--baseline names another or --no-baseline is given. Any stage whose median time is more than threshold slower
+than the baseline is reported as a regression and the exit code is 1. The committed baseline is refreshed with
+--no-baseline --output tools/benchmark_baseline.json on the machine the benchmarks are compared on.
+"""
+import argparse
+import copy
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+import main
+from project.api.forecast import Forecast
+from project.api.octopus import AgileRates
+from project.example_responses.example_data_handler import GivEnergyData
+
+default_slots = [48, 480, 2000, 10000]
+default_days = [4, 14, 44]
+default_repeat = 5
+# the exact engine is a dynamic program over every slot, it is only timed up to this horizon by default
+default_exact_max_slots = 2000
+# results committed with the repository that runs are compared with
+default_baseline_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+
+time_offsets = {'local_time': 0, 'octopus_time': 0, 'giv_energy_time': 0, 'aws': 0}
+
+battery_remaining_capacity = 4.0
+battery_max_capacity = 9.5
+battery_charge_rate_hourly = 3.6
+
+
+class FixtureForecast(Forecast):
+    """
+    Offline forecast that serves the fixture's days as whichever dates are asked for
+    """
+    def __init__(self):
+        super().__init__(True, None)
+
+    def iter_forecast_periods(self, location, dates):
+        fixture_days = super().iter_forecast_periods(location, [period['value'] for period in self._fixture_periods()])
+        for date, (_, period) in zip(dates, fixture_days):
+            yield date, period
+
+    def _fixture_periods(self):
+        return self.get_forecast_location(None)['SiteRep']['DV']['Location']['Period']
+
+
+class SyntheticOctopus:
+    """
+    Serves slots Agile rates starting from whichever period is asked for
+    """
+    def __init__(self, slots, seed=0):
+        self.prices = synthetic_prices(slots, seed)
+
+    def get_agile_rates(self, period_from, period_to):
+        return AgileRates([{'value_exc_vat': price / 1.05,
+                            'value_inc_vat': price,
+                            'valid_from': (period_from + timedelta(minutes=30 * i)).strftime('%Y-%m-%dT%H:%M:%SZ'),
+                            'valid_to': (period_from + timedelta(minutes=30 * (i + 1))).strftime('%Y-%m-%dT%H:%M:%SZ'),
+                            'payment_method': None}
+                           for i, price in enumerate(self.prices)])
+
+
+def synthetic_prices(slots, seed=0):
+    """
+    Agile like prices in pence, cheap overnight, a 16:00 - 19:00 peak and the occasional negative slot
+    """
+    random = np.random.default_rng(seed)
+    hour = (np.arange(slots) % 48) / 2
+    prices = 18 + 8 * np.sin((hour - 9) / 24 * 2 * np.pi) + random.normal(0, 3, slots)
+    prices[(hour >= 16) & (hour < 19)] += 15
+    prices[random.random(slots) < 0.01] = -2
+    return np.round(prices, 2)
+
+
+def synthetic_energy_usage(days, seed=0):
+    """
+    days energy-flows responses shaped like the fixture, with each value scaled by random noise
+    """
+    random = np.random.default_rng(seed)
+    fixture = GivEnergyData.energy_usage()['data']
+    responses = []
+    for _ in range(days):
+        response = copy.deepcopy(fixture)
+        for half_hour in response.values():
+            for flow_type, value in half_hour['data'].items():
+                half_hour['data'][flow_type] = round(value * random.uniform(0.5, 1.5), 2)
+        responses.append(response)
+    return responses
+
+
+def synthetic_energy_result(slots, seed=0):
+    """
+    The frame calculate_battery_depletion_time returns, for a horizon of slots half hours
+    """
+    random = np.random.default_rng(seed)
+    timer = np.arange(slots) * 0.5
+    hour = timer % 24
+    solar = np.clip(np.sin((hour - 6) / 12 * np.pi), 0, None) * random.uniform(0, 1.2, slots)
+    consumption = 0.2 + 0.3 * ((hour >= 17) & (hour < 22)) + random.uniform(0, 0.2, slots)
+    start = datetime(2024, 7, 1)
+    return pd.DataFrame({'timer': timer,
+                         'hours': [(start + timedelta(minutes=30 * i)).time() for i in range(slots)],
+                         'energy': np.round(consumption - solar, 3)})
+
+
+def synthetic_agile_data(slots, seed=0):
+    """
+    The frame get_agile_data returns, without its 48 slot cut off
+    """
+    start = pd.Timestamp(2024, 7, 1)
+    valid_from = start + pd.to_timedelta(np.arange(slots) * 30, unit='min')
+    return pd.DataFrame({'value_inc_vat': synthetic_prices(slots, seed),
+                         'valid_from_giv': valid_from,
+                         'valid_to_giv': valid_from + pd.Timedelta(minutes=30)})
+
+
+def time_stage(function, setup=None, repeat=default_repeat):
+    """
+    Run function repeat times, calling setup before each run outside the timer. Returns the timings in seconds
+    """
+    timings = []
+    for _ in range(repeat):
+        arguments = setup() if setup is not None else ()
+        start = time.perf_counter()
+        function(*arguments)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def run_benchmarks(slots=None, days=None, repeat=default_repeat, exact_max_slots=default_exact_max_slots):
+    """
+    Time each stage of the calculate pipeline, returning a list of result dicts
+    """
+    slots = slots or default_slots
+    days = days or default_days
+    cases = []
+
+    for day_count in days:
+        energy_usage = synthetic_energy_usage(day_count)
+        cases.append(('extract_half_hour_data', {'days': day_count},
+                      lambda data: main.add_to_df(*main.extract_half_hour_data(data), time_offsets),
+                      lambda data=energy_usage: (copy.deepcopy(data),)))
+        cases.append(('decode_energy_flows', {'days': day_count},
+                      lambda data: main.add_to_df(*_summed(main.decode_energy_flows(data, [0, 3, 5])), time_offsets),
+                      lambda data=energy_usage: (data,)))
+
+    cases.append(('analyse_forecast', {}, main.analyse_forecast, lambda: (FixtureForecast(),)))
+    cases.append(('get_agile_data', {}, main.get_agile_data,
+                  lambda: (SyntheticOctopus(main.planning_horizon_slots), time_offsets)))
+
+    for slot_count in slots:
+        energy_result, agile_data = synthetic_energy_result(slot_count), synthetic_agile_data(slot_count)
+        cases.append(('concat_data_sources', {'slots': slot_count}, main.concat_data_sources,
+                      lambda a=energy_result, b=agile_data: (a, b)))
+
+        insights = main.concat_data_sources(energy_result, agile_data)
+        engines = [('greedy', 'heap'), ('greedy', 'dataframe')]
+        if slot_count <= exact_max_slots:
+            engines.append(('exact', None))
+        for engine, repair in engines:
+            params = {'slots': slot_count, 'engine': engine}
+            if repair is not None:
+                params['repair'] = repair
+            cases.append(('determine_optimal_charging_periods', params,
+                          lambda df, engine=engine, repair=repair: main.determine_optimal_charging_periods(
+                              df, battery_remaining_capacity, battery_max_capacity, main.lowest_charge_threshold,
+                              battery_charge_rate_hourly, engine=engine, repair=repair or 'heap'),
+                          lambda df=insights: (df.copy(),)))
+
+        charged = main.determine_optimal_charging_periods(insights.copy(), battery_remaining_capacity,
+                                                          battery_max_capacity, main.lowest_charge_threshold,
+                                                          battery_charge_rate_hourly)
+        charged = charged[charged['charge'] == True]
+        cases.append(('prepare_time_windows_for_givenergy', {'slots': slot_count},
+                      main.prepare_time_windows_for_givenergy,
+                      lambda df=charged: (df.copy(), time_offsets)))
+
+    results = []
+    for stage, params, function, setup in cases:
+        timings = time_stage(function, setup, repeat)
+        results.append({'stage': stage,
+                        'params': params,
+                        'repeat': repeat,
+                        'min_seconds': min(timings),
+                        'median_seconds': statistics.median(timings),
+                        'mean_seconds': statistics.fmean(timings)})
+        logging.info(f"{stage} {params}: median {statistics.median(timings) * 1000:.2f} ms")
+    return results
+
+
+def _summed(decoded):
+    flows, times = decoded
+    return flows.sum(axis=2), times
+
+
+def result_key(result):
+    return result['stage'], json.dumps(result['params'], sort_keys=True)
+
+
+def compare_results(results, baseline, threshold=0.25, min_seconds=0.001):
+    """
+    Compare median times with a baseline run. A stage regresses when it is more than threshold slower,
+    stages faster than min_seconds in both runs are ignored as noise. Returns a list of comparison dicts
+    """
+    baseline_results = {result_key(result): result for result in baseline['results']}
+    comparisons = []
+    for result in results:
+        previous = baseline_results.get(result_key(result))
+        if previous is None:
+            continue
+        ratio = result['median_seconds'] / previous['median_seconds'] if previous['median_seconds'] else float('inf')
+        noise = max(result['median_seconds'], previous['median_seconds']) < min_seconds
+        comparisons.append({'stage': result['stage'],
+                            'params': result['params'],
+                            'baseline_seconds': previous['median_seconds'],
+                            'median_seconds': result['median_seconds'],
+                            'ratio': ratio,
+                            'regression': not noise and ratio > 1 + threshold})
+    return comparisons
+
+
+def environment():
+    return {'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__}
+
+
+def parse_list(value):
+    return [int(item) for item in value.split(',') if item]
+
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output', help="file to write the JSON results to, printed when not given")
+    parser.add_argument('--baseline', default=default_baseline_path,
+                        help="JSON results of an earlier run to compare against")
+    parser.add_argument('--no-baseline', dest='baseline', action='store_const', const=None,
+                        help="don't compare with a baseline")
+    parser.add_argument('--threshold', type=float, default=0.25, help="allowed slow down before a regression")
+    parser.add_argument('--repeat', type=int, default=default_repeat)
+    parser.add_argument('--slots', type=parse_list, default=default_slots, help="comma separated horizons")
+    parser.add_argument('--days', type=parse_list, default=default_days, help="comma separated history depths")
+    parser.add_argument('--exact-max-slots', type=int, default=default_exact_max_slots)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    # the pipeline's own logging would drown out the timings
+    logging.getLogger('main').setLevel(logging.ERROR)
+    logging.getLogger('project').setLevel(logging.ERROR)
+
+    report = {'environment': environment(),
+              'results': run_benchmarks(args.slots, args.days, args.repeat, args.exact_max_slots)}
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        report['comparison'] = compare_results(report['results'], baseline, args.threshold)
+        regressions = [comparison for comparison in report['comparison'] if comparison['regression']]
+        for comparison in regressions:
+            logging.warning(f"Regression {comparison['stage']} {comparison['params']}: "
+                            f"{comparison['baseline_seconds'] * 1000:.2f} ms -> "
+                            f"{comparison['median_seconds'] * 1000:.2f} ms")
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main_cli())
@@ -0,0 +1,35 @@
+"""
+Builds the clear sky solar table for a site and saves it where project.solar_geometry reads it from.
+
+Needs pvlib, which the function itself doesn't, so the Docker image runs it in a build stage and ships the table.
+Run from the repository root:
+
+    python -m tools.build_solar_table
+    python -m tools.build_solar_table --latitude 54.0466 --longitude -2.8007 --directory project/solar_tables
+"""
+import argparse
+import sys
+
+from project import solar_geometry
+
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--latitude', type=float, default=solar_geometry.solar_latitude)
+    parser.add_argument('--longitude', type=float, default=solar_geometry.solar_longitude)
+    parser.add_argument('--directory', default=solar_geometry.solar_table_directory,
+                        help="directory to save the table in")
+    args = parser.parse_args(argv)
+
+    if solar_geometry.pvlib is None:
+        print("pvlib isn't installed, install it to build the solar table", file=sys.stderr)
+        return 1
+    solar_geometry.solar_table_directory = args.directory
+    path = solar_geometry.solar_table_path(args.latitude, args.longitude)
+    solar_geometry._save_table(path, solar_geometry.build_solar_table(args.latitude, args.longitude))
+    print(f"Saved the solar table to {path}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main_cli())
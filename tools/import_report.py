@@ -0,0 +1,97 @@
+"""
+Import time report for the Lambda's cold start, per handler command.
+
+Each command's imports run in a fresh interpreter with python -X importtime, so nothing is already loaded.
+Run from the repository root:
+
+    python -m tools.import_report
+    python -m tools.import_report --command update --top 20 --output imports.json
+
+The exit code is 1 if a command imports a module it shouldn't, such as pandas on the update path.
+"""
+import argparse
+import json
+import subprocess
+import sys
+
+# the statements each handler command runs before doing any work
+command_imports = {'update': "import lambda_handler",
+                   'calculate': "import lambda_handler; import main; import project.api.sns_email",
+                   'batch': "import lambda_handler; import project.fleet"}
+
+# top level packages a command must not import
+forbidden_imports = {'update': ['pandas', 'numpy', 'pytz', 'main']}
+
+
+def profile_imports(statement):
+    """
+    Run statement in a new interpreter with -X importtime, returning a list of
+    {'module', 'self_us', 'cumulative_us', 'depth'} in import order
+    """
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement],
+                             capture_output=True, text=True, check=True)
+    imports = []
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        imports.append({'module': name.strip(),
+                        'self_us': int(self_us),
+                        'cumulative_us': int(cumulative_us),
+                        'depth': (len(name) - len(name.lstrip())) // 2})
+    return imports
+
+
+def summarise_imports(imports, top=10):
+    """
+    Total import time, the slowest top level packages and every module that was imported
+    """
+    packages = {}
+    for entry in imports:
+        package = entry['module'].split('.')[0]
+        packages[package] = packages.get(package, 0) + entry['self_us']
+    slowest = sorted(packages.items(), key=lambda item: item[1], reverse=True)[:top]
+    return {'total_ms': sum(entry['self_us'] for entry in imports) / 1000,
+            'modules': len(imports),
+            'slowest_packages': [{'package': package, 'ms': us / 1000} for package, us in slowest],
+            'imported': sorted({entry['module'] for entry in imports})}
+
+
+def report(commands=None, top=10):
+    """
+    Profile each command's imports, returning a dict keyed by command
+    """
+    results = {}
+    for command in commands or command_imports:
+        summary = summarise_imports(profile_imports(command_imports[command]), top)
+        imported_packages = {module.split('.')[0] for module in summary['imported']}
+        summary['forbidden'] = sorted(imported_packages & set(forbidden_imports.get(command, [])))
+        results[command] = summary
+    return results
+
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--command', action='append', choices=list(command_imports),
+                        help="command to profile, all of them when not given")
+    parser.add_argument('--top', type=int, default=10, help="number of slowest packages to list")
+    parser.add_argument('--output', help="file to write the JSON report to")
+    args = parser.parse_args(argv)
+
+    results = report(args.command, args.top)
+    for command, summary in results.items():
+        print(f"{command}: {summary['total_ms']:.1f} ms importing {summary['modules']} modules")
+        for package in summary['slowest_packages']:
+            print(f"    {package['package']:<24} {package['ms']:8.1f} ms")
+        if summary['forbidden']:
+            print(f"    imports {', '.join(summary['forbidden'])}, which it shouldn't")
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({command: {key: value for key, value in summary.items() if key != 'imported'}
+                       for command, summary in results.items()}, file, indent=2)
+    return 1 if any(summary['forbidden'] for summary in results.values()) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main_cli())